@@ -3,7 +3,6 @@ import time
 import importlib
 import traceback
 
-import pickle
 import json
 
 import holoviews as hv
@@ -15,7 +14,10 @@ pn.extension()
 from bokeh.server.contexts import BokehSessionContext
 
 from sips_modules.global_utils import get_id_token, get_pn_id_token
-from sips_modules.PlateClass import Library
+from sips_modules.PlateClass import Library, warmup_kernels
+from sips_modules.archive_utils import is_archive, save_archive, load_archive, append_archive, list_archive_plates
+from sips_modules.snapshot_utils import save_snapshot, load_snapshot
+from sips_modules.session_store import SessionStore
 #Load config and setup environment
 with open('./assets/config.json', 'r') as f:
     config = json.load(f)
@@ -37,11 +39,9 @@ def SIPS():
     ### Planned Features:
     * **General**
         * Improved loading display
-        * Multithreaded processing for increased speed
     * **File Loading**
         * Folder dropping
     * **MS-FIT**
-        * Peak drift correction
         * Show all integrated peak overlay
         * Split peak detection
     * **AReS**
@@ -63,6 +63,8 @@ def SIPS():
     welcome_sidebar = """<h2>Instructions will be displayed here</h2>"""
 
     library: Library = pn.state.cache['id_tokens'][get_pn_id_token()]['library']
+    #Autosave reads the library from this session's event loop
+    session_store.attach_document(get_pn_id_token(), pn.state.curdoc)
 
     #Setup sidebar info
     sidebar_info = pn.pane.Markdown(welcome_sidebar)
@@ -74,12 +76,14 @@ def SIPS():
     check_bin_button = pn.widgets.Button(name='Check .bins')
     load_bin_button = pn.widgets.Button(name='Load .bin')
     save_bin_button = pn.widgets.Button(name='Save .bin')
+    append_bin_button = pn.widgets.Button(name='Append to .bin')
     bin_selection = pn.widgets.Select()
+    bin_plate_selection = pn.widgets.MultiChoice(placeholder="All plates")
     bin_save_name = pn.widgets.TextInput()
 
-    check_pkl_button = pn.widgets.Button(name="Check .pkls")
-    load_pkl_button = pn.widgets.Button(name="Load .pkl")
-    save_pkl_button = pn.widgets.Button(name="Save .pkl")
+    check_pkl_button = pn.widgets.Button(name="Check snapshots")
+    load_pkl_button = pn.widgets.Button(name="Load snapshot")
+    save_pkl_button = pn.widgets.Button(name="Save snapshot")
     pkl_selection = pn.widgets.Select()
     pkl_save_name = pn.widgets.TextInput()
 
@@ -112,16 +116,47 @@ def SIPS():
                 filename = bin_save_name.value
                 if not filename.endswith(".bin"):
                     filename += ".bin"
-            library.save_binary(f"../archives/{filename}")
+            save_archive(library, f"../archives/{filename}")
             status_text.value = 'Done saving!'
         except Exception as e:
             status_text.value = "save_bin_button_callback: " + str(e)
             debug_text.value += traceback.format_exc() + "\n\n"
     save_bin_button.on_click(save_bin_button_callback)
 
+    def append_bin_button_callback(event):
+        try:
+            #Add any plates which aren't in the selected archive yet
+            file_path = f"../archives/{bin_selection.value}"
+            archive_plates = list_archive_plates(file_path)
+            new_plates = [x for x in library if x not in archive_plates]
+            append_archive(library, file_path, new_plates)
+            bin_plate_selection.options = archive_plates + new_plates
+            status_text.value = f'Appended {len(new_plates)} plates!'
+        except Exception as e:
+            status_text.value = "append_bin_button_callback: " + str(e)
+            debug_text.value += traceback.format_exc() + "\n\n"
+    append_bin_button.on_click(append_bin_button_callback)
+
+    def bin_selection_callback(event):
+        try:
+            file_path = f"../archives/{event.new}"
+            if (event.new is not None) and is_archive(file_path):
+                bin_plate_selection.param.update({'options': list_archive_plates(file_path), 'value': [], 'disabled': False})
+            else:
+                #Legacy .bins can only be loaded whole
+                bin_plate_selection.param.update({'options': [], 'value': [], 'disabled': True})
+        except Exception as e:
+            status_text.value = "bin_selection_callback: " + str(e)
+            debug_text.value += traceback.format_exc() + "\n\n"
+    bin_selection.param.watch(bin_selection_callback, ['value'])
+
     def load_bin_callback(event):
         try:
-            library.load_binary(f"../archives/{bin_selection.value}")
+            file_path = f"../archives/{bin_selection.value}"
+            if is_archive(file_path):
+                load_archive(library, file_path, plates=(bin_plate_selection.value if len(bin_plate_selection.value) > 0 else None), lazy=True)
+            else:
+                library.load_binary(file_path, lazy=True)
             #TODO: Put code here to populate the selector drop downs appropriately.
             status_text.value = 'Done loading!'
         except Exception as e:
@@ -132,7 +167,7 @@ def SIPS():
 
     def scan_pkl_callback(event):
         try:
-            pkl_selection.options = [x for x in os.listdir('../archives/') if x.endswith('.pkl')]
+            pkl_selection.options = [x for x in os.listdir('../archives/') if x.endswith('.snap')]
         except Exception as e:
             status_text.value = "scan_pkl_callback: " + str(e)
             debug_text.value += traceback.format_exc() + "\n\n"
@@ -140,13 +175,12 @@ def SIPS():
 
     def save_pkl_button_callback(event):
         try:
-            filename = "test.pkl"
+            filename = "test.snap"
             if pkl_save_name.value != "":
                 filename = pkl_save_name.value
-                if not filename.endswith(".pkl"):
-                    filename += ".pkl"
-            with open(f"../archives/{filename}", 'wb') as f:
-                pickle.dump(library, f)
+                if not filename.endswith(".snap"):
+                    filename += ".snap"
+            save_snapshot(library, f"../archives/{filename}")
             status_text.value = 'Done saving!'
         except Exception as e:
             status_text.value = "save_pkl_button_callback: " + str(e)
@@ -155,8 +189,8 @@ def SIPS():
 
     def load_pkl_callback(event):
         try:
-            with open(f"../archives/{pkl_selection.value}", 'rb') as f:
-                library.set_cache_lib(pickle.load(f))
+            #Replaces the session's plates in place, so every module sees the loaded library
+            load_snapshot(library, f"../archives/{pkl_selection.value}")
             status_text.value = 'Done loading!'
         except Exception as e:
             status_text.value = "load_pkl_callback: " + str(e)
@@ -181,8 +215,8 @@ def SIPS():
 
     admin_box = pn.Column(
         pn.Row(library_tree_button, test_button),
-        pn.Row(check_bin_button, bin_selection, load_bin_button),
-        pn.Row(bin_save_name, save_bin_button),
+        pn.Row(check_bin_button, bin_selection, bin_plate_selection, load_bin_button),
+        pn.Row(bin_save_name, save_bin_button, append_bin_button),
         pn.Row(check_pkl_button, pkl_selection, load_pkl_button),
         pn.Row(pkl_save_name, save_pkl_button),
         load_direct_button,
@@ -272,40 +306,54 @@ def SIPS():
 def on_session_created_callback(session_context: BokehSessionContext):
     id_token = get_id_token(session_context)
     print(f"CREATED: {id_token}")
-    if id_token not in pn.state.cache['id_tokens'].keys():
-        pn.state.cache['id_tokens'][id_token] = {
-            'lifetime': time.time() + 1000000, #Save tokens for approximately one week
-            'library': Library()
-        }
-        status_text.value = "Created new library"
-    else:
+    if session_store.open_session(id_token):
         status_text.value = "Loaded previous state"
-        #Refresh token lifetime
-        pn.state.cache['id_tokens'][id_token]['lifetime'] = time.time() + 1000000
-        #TODO: Eventually, load library data here
+    else:
+        status_text.value = "Created new library"
 pn.state.on_session_created(on_session_created_callback)
 
 def on_session_destroyed_callback(session_context: BokehSessionContext):
     id_token = get_id_token(session_context)
     print(f"DESTROYED: {id_token}")
-    #TODO: Eventually, store library data here in user folder
+    session_store.close_session(id_token)
 pn.state.on_session_destroyed(on_session_destroyed_callback)
 
 #Server launch initialization
 pn.state.cache['id_tokens'] = {}
-
-app = pn.serve(
-    {"SIPS": SIPS},
-    port=9999,
-    websocket_origin=os.getenv('ALLOWED_ORIGINS').split(','),
-    static_dirs={'assets': './assets'},
-    basic_auth='./assets/credentials.json',
-    cookie_secret=os.getenv('COOKIE_SECRET'),
-    basic_login_template='./assets/login_page.html',
-    #websocket_max_message_size=1000000000,
-    #warm=True,
-    autoreload=True,
-    title="SIPS",
-    show=False,
-    start=True,
-)
\ No newline at end of file
+session_store = SessionStore(
+    pn.state.cache['id_tokens'],
+    store_dir=config.get('session_dir', '../sessions'),
+    memory_budget=int(config.get('session_memory_budget_mb', 4096)) << 20,
+    lifetime=config.get('session_lifetime', 1000000), #Keep idle users for approximately one week
+    reap_interval=config.get('session_reap_interval', 300),
+    autosave_interval=config.get('autosave_interval', 30),
+    compact_ratio=config.get('autosave_compact_ratio', 1.0),
+    spool_lifetime=config.get('upload_spool_lifetime', 3600), #Keep unfinished uploads resumable for an hour
+)
+
+#Guarded so worker processes spawned for parallel processing don't relaunch the server
+if __name__ == '__main__':
+    #Compile numba kernels now, instead of on the first user's integration
+    print(f"Numba kernels ready in {warmup_kernels():.2f} s")
+
+    #Saves idle libraries to disk and evicts them from memory, and removes users past their lifetime
+    session_store.start()
+    try:
+        app = pn.serve(
+            {"SIPS": SIPS},
+            port=9999,
+            websocket_origin=os.getenv('ALLOWED_ORIGINS').split(','),
+            static_dirs={'assets': './assets'},
+            basic_auth='./assets/credentials.json',
+            cookie_secret=os.getenv('COOKIE_SECRET'),
+            basic_login_template='./assets/login_page.html',
+            #websocket_max_message_size=1000000000,
+            #warm=True,
+            autoreload=True,
+            title="SIPS",
+            show=False,
+            start=True,
+        )
+    finally:
+        #Keep every library in memory across the restart
+        session_store.stop()
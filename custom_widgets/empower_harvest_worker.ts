@@ -74,13 +74,16 @@ function harvest_empower_data(){
                             let diff = Math.abs(arr[0] - target)
                             let best = 0
                             for (let i = 1; i < arr.length; i++){
-                                if (Math.abs(arr[i] - target) < diff){
+                                const test_diff = Math.abs(arr[i] - target)
+                                if (test_diff < diff){
+                                    diff = test_diff
                                     best = i
                                 }
                             }
                             return best
                         }
-                        let closest_wl_ind = find_closest(file.wavelengths, target)
+                        //Column 0 is time, so the wavelengths/m/z values start at column 1
+                        let closest_wl_ind = 1 + find_closest(file.wavelengths, target)
                         results.push([file.sample_name, file.well, compound, new_tag, parsed_content[0], parsed_content[closest_wl_ind]])
                     } else {
                         let parsed_content = parse_data(content.split(/[\x0D\x0a]+/g).slice(2, -1))
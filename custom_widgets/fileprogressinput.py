@@ -1,6 +1,9 @@
 from panel.widgets.base import Widget
 from . import fileprogressinput_model
 import param
+import numpy as np
+
+from typing import List
 
 class FileProgressInput(Widget):
     _widget_type = fileprogressinput_model.FileProgressInput
@@ -22,7 +25,30 @@ class FileProgressInput(Widget):
 
     harvest = param.Boolean(default=False)
     transfered_text = param.List(item_type=list)
-    transfered_data = param.List(item_type=list)
+    transfered_dtype = param.String(default="float32")
+    transfered_index = param.List(item_type=list)
+    transfered_buffer = param.Bytes(default=b"")
+
+    server_parse = param.Boolean(default=False)
+    chunk_size = param.Integer(default=4194304)
+    upload_name = param.String(default="")
+    upload_index = param.Integer(default=0)
+    upload_offset = param.Integer(default=0)
+    upload_final = param.Boolean(default=False)
+    upload_chunk = param.Bytes(default=b"")
+    upload_count = param.Integer(default=0)
+    upload_ack = param.Integer(default=0)
+    upload_request = param.String(default="")
+    upload_manifest = param.List(item_type=list)
+    upload_resume = param.List(item_type=int)
+
+    def get_transfered_arrays(self) -> List[np.ndarray]:
+        """Returns each uploaded block as a 2D (rows, columns) view into the received buffer, without copying it"""
+        dtype = np.dtype(self.transfered_dtype)
+        return [
+            np.frombuffer(self.transfered_buffer, dtype=dtype, count=n_rows*n_cols, offset=offset).reshape(n_rows, n_cols)
+            for offset, n_rows, n_cols in self.transfered_index
+        ]
 
     #transfered_data = param.List(item_type=param.List(item_type=[
     #    param.String(default=""),
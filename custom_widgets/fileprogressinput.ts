@@ -23,6 +23,25 @@ interface AB1File extends File{
     results: [number[], number[], number[], number[], number[], number[], number[], number[]]
 }
 
+//Packs blocks of equal length rows into a single binary buffer, so they are sent to the server as raw bytes instead of JSON numbers
+//Each block's [byte offset, rows, columns] is recorded in the index, with blocks aligned to 8 bytes
+function pack_arrays(blocks: ArrayLike<number>[][], array_type: Float32ArrayConstructor | Uint16ArrayConstructor): {buffer: ArrayBuffer, index: number[][]} {
+    const item_size = array_type.BYTES_PER_ELEMENT
+    const index: number[][] = []
+    let n_bytes = 0
+    for (const block of blocks){
+        const n_cols = (block.length > 0) ? block[0].length : 0
+        index.push([n_bytes, block.length, n_cols])
+        n_bytes += Math.ceil((block.length * n_cols * item_size) / 8) * 8
+    }
+    const buffer = new ArrayBuffer(n_bytes)
+    blocks.forEach((block, i) => {
+        const view = new array_type(buffer, index[i][0], index[i][1] * index[i][2])
+        block.forEach((row, j) => view.set(row, j * index[i][2]))
+    })
+    return {buffer, index}
+}
+
 class WorkerPool {
     max_workers: number
     worker_pool: Worker[]
@@ -97,10 +116,20 @@ export class FileProgressInputView extends InputWidgetView {
     current_progress: number
 
     worker_pool: WorkerPool
+    ack_resolve: (() => void) | null = null
 
     connect_signals(): void {
         super.connect_signals()
 
+        this.connect(this.model.properties.upload_ack.change, () => {
+            //The server has stored the last chunk, so the next one can be sent
+            if (this.ack_resolve != null){
+                const resolve = this.ack_resolve
+                this.ack_resolve = null
+                resolve()
+            }
+        });
+
         this.connect(this.model.properties.harvest.change, () => {
             this.current_progress = 0;
             this.model.setv({
@@ -327,6 +356,53 @@ export class FileProgressInputView extends InputWidgetView {
         })
     }
 
+    _send_upload_request(request: string, values: {[key: string]: unknown}): Promise<void> {
+        //Sends part of an upload to the server, resolving once the server has handled it
+        const acked = new Promise<void>((resolve) => {
+            this.ack_resolve = resolve
+        })
+        this.model.setv({
+            ...values,
+            upload_request: request,
+            upload_count: this.model.upload_count + 1
+        })
+        return acked
+    }
+
+    async _upload_raw_files(files: FileList): Promise<void> {
+        //Sends the files to the server as-is, one chunk at a time, waiting for the server to store each chunk before reading the next
+        //The server replies to the manifest with how much of each file it already has, so an interrupted upload resumes instead of starting over
+        const chunk_size = this.model.chunk_size
+        await this._send_upload_request('manifest', {
+            upload_manifest: Array.from(files).map((file) => [file.name, String(file.size), String(file.lastModified)])
+        })
+        const resume_offsets = this.model.upload_resume
+        const total_size = Array.from(files).reduce((total, file) => total + file.size, 0)
+        let sent_size = resume_offsets.reduce((total, offset) => total + offset, 0)
+        for (let i = 0; i < files.length; i++){
+            const file = files[i]
+            let offset = resume_offsets[i]
+            if ((offset >= file.size) && (file.size > 0)){
+                continue
+            }
+            do {
+                const chunk = await file.slice(offset, offset + chunk_size).arrayBuffer()
+                await this._send_upload_request('chunk', {
+                    upload_name: file.name,
+                    upload_index: i,
+                    upload_offset: offset,
+                    upload_final: (offset + chunk_size) >= file.size,
+                    upload_chunk: chunk
+                })
+                offset += chunk_size
+                sent_size += chunk.byteLength
+                this.model.setv({
+                    progress_percent: Math.round((100 * sent_size) / Math.max(total_size, 1))
+                })
+            } while (offset < file.size)
+        }
+    }
+
     determine_harvest_params(files: FileList): void{
         //Make sure all the file extensions are the same
         const ext = files[0].name.split('.').pop()
@@ -342,6 +418,22 @@ export class FileProgressInputView extends InputWidgetView {
         //Choose what to do based on file type
         switch (ext){
             case 'arw':
+                if (this.model.server_parse){
+                    //The server parses the files, so they only need to be uploaded
+                    this.model.setv({
+                        progress_percent: 0,
+                        progress_status: 'Uploading files...'
+                    })
+                    this._upload_raw_files(files).then(() => {
+                        this.model.setv({
+                            file_type: 'Empower',
+                            progress_state: 1,
+                            progress_percent: -1,
+                            progress_status: 'Parameters extracted!  Please input harvesting info.'
+                        })
+                    })
+                    break;
+                }
                 const self = this;
                 function _extract_empower_params(file: EmpowerFile, content: string): Promise<EmpowerFile>{
                     return new Promise<EmpowerFile>((resolve, reject) => {
@@ -605,6 +697,16 @@ export class FileProgressInputView extends InputWidgetView {
                         console.log(harvest_compounds)
                         console.log(harvest_sources)
                         console.log(harvest_targets)
+                        if (this.model.server_parse){
+                            //The files are already on the server, so just tell it what to extract
+                            this.model.setv({
+                                transfered_text: [harvest_compounds, harvest_sources, harvest_targets.map(String)],
+                                progress_state: 3,
+                                progress_percent: 0,
+                                progress_status: 'Harvesting requested data...'
+                            })
+                            return
+                        }
                         //Now, we can read the files
                         this.model.setv({
                             progress_percent: 0,
@@ -803,20 +905,52 @@ export class FileProgressInputView extends InputWidgetView {
                                 })
                             }
 
-                            async function _harvest_empower_file(content: string, harvest_compounds: string[], harvest_sources: string[], harvest_targets: number[]): Promise<[string, string, string, string, number[], number[]][]> {
+                            async function _harvest_empower_file(content: string, harvest_compounds: string[], harvest_sources: string[], harvest_targets: number[]): Promise<[string, string, string, string, ArrayLike<number>, ArrayLike<number>][]> {
                                 return new Promise((resolve) => {
                                     //const self = this
-                                    function progress_resolve(parsed_data: [string, string, string, string, number[], number[]][]): void{
+                                    function progress_resolve(parsed_data: [string, string, string, string, ArrayLike<number>, ArrayLike<number>][]): void{
                                         resolve(parsed_data)
                                     }
 
-                                    function parse_data(array: string[]): number[][] {
-                                        let values = array.map(line => {
-                                            return line.split(/\s+/g).map(num => {
-                                              return parseFloat(num)
-                                          })
+                                    //Parses only the requested columns of the data lines, in a single pass over the lines
+                                    //Each line's column offsets are found by walking its whitespace just far enough to reach the last requested column
+                                    function parse_columns(lines: string[], columns: number[]): Float64Array[] {
+                                        const last_column = Math.max(...columns)
+                                        const parsed = columns.map(() => new Float64Array(lines.length))
+                                        const is_space = (char: string) => (char === '\t') || (char === ' ')
+                                        lines.forEach((line, row) => {
+                                            let start = 0
+                                            for (let column = 0; column <= last_column; column++){
+                                                let end = start
+                                                while ((end < line.length) && !is_space(line[end])){
+                                                    end++
+                                                }
+                                                columns.forEach((requested, i) => {
+                                                    if (requested == column){
+                                                        parsed[i][row] = parseFloat(line.substring(start, end))
+                                                    }
+                                                })
+                                                start = end
+                                                while ((start < line.length) && is_space(line[start])){
+                                                    start++
+                                                }
+                                            }
                                         })
-                                        return values.map((_, colIndex) => values.map(row => row[colIndex]));
+                                        return parsed
+                                    }
+
+                                    //Find the closest wavelength or m/z to the target
+                                    function find_closest(arr: number[], target: number): number{
+                                        let diff = Math.abs(arr[0] - target)
+                                        let best = 0
+                                        for (let i = 1; i < arr.length; i++){
+                                            const test_diff = Math.abs(arr[i] - target)
+                                            if (test_diff < diff){
+                                                diff = test_diff
+                                                best = i
+                                            }
+                                        }
+                                        return best
                                     }
 
                                     //Re-extract our relevant parameters from the header
@@ -874,15 +1008,14 @@ export class FileProgressInputView extends InputWidgetView {
 
 
                                     console.log("Extracting data")
-                                    //Go through all our harvested sources
-                                    let results: [string, string, string, string, number[], number[]][] = []
+                                    //Go through all our harvested sources, and work out which column each one needs
+                                    let requests: [string, string, number][] = []
                                     for (let i = 0; i < harvest_sources.length; i++){
                                         //Check if the file source matches
                                         if (harvest_sources[i] == tag){
                                             let compound = harvest_compounds[i]
                                             //Check for 3D or 2D data
                                             if (wavelengths.length > 0){
-                                                let parsed_content = parse_data(content_lines.slice(4, -1))
                                                 let target = harvest_targets[i]
                                                 //Make our tag more descriptive
                                                 let new_tag = ""
@@ -891,26 +1024,22 @@ export class FileProgressInputView extends InputWidgetView {
                                                 } else {
                                                     new_tag = `XAC ${target} nm`
                                                 }
-                                                //Find the closest wavelength or m/z to the target
-                                                function find_closest(arr: number[], target: number): number{
-                                                    let diff = Math.abs(arr[0] - target)
-                                                    let best = 0
-                                                    for (let i = 1; i < arr.length; i++){
-                                                        if (Math.abs(arr[i] - target) < diff){
-                                                            best = i
-                                                        }
-                                                    }
-                                                    return best
-                                                }
-                                                let closest_wl_ind = find_closest(wavelengths, target)
-                                                results.push([sample_name, well, compound, new_tag, parsed_content[0], parsed_content[closest_wl_ind]])
+                                                //Column 0 is time, so the wavelengths/m/z values start at column 1
+                                                requests.push([compound, new_tag, 1 + find_closest(wavelengths, target)])
                                             } else {
-                                                let parsed_content = parse_data(content_lines.slice(2, -1))
-                                                //Easy push
-                                                results.push([sample_name, well, compound, tag, parsed_content[0], parsed_content[1]])
+                                                requests.push([compound, tag, 1])
                                             }
                                         }
                                     }
+                                    //Parse the file once for every compound it's harvested for
+                                    let results: [string, string, string, string, ArrayLike<number>, ArrayLike<number>][] = []
+                                    if (requests.length > 0){
+                                        const columns = [0, ...new Set(requests.map((request) => request[2]))]
+                                        const parsed_content = parse_columns(content_lines.slice((wavelengths.length > 0) ? 4 : 2, -1), columns)
+                                        requests.forEach(([compound, new_tag, column]) => {
+                                            results.push([sample_name, well, compound, new_tag, parsed_content[0], parsed_content[columns.indexOf(column)]])
+                                        })
+                                    }
                                     progress_resolve(results)
                                 });
                             }
@@ -922,19 +1051,23 @@ export class FileProgressInputView extends InputWidgetView {
                                 progress_percent: Math.round(100 * this.current_progress)
                             })
                             return parsed_content
-                        })).then((result: ([string, string, string, string, number[], number[]][][])) =>{
+                        })).then((result: ([string, string, string, string, ArrayLike<number>, ArrayLike<number>][][])) =>{
                             console.log("Reshaping data")
                             console.log(result)
                             let results = result.reduce((accumulator, value) => accumulator.concat(value), [])
-                            let results_trans = results[0].map((_, colIndex) => results.map(row => row[colIndex]));
+                            let results_trans = [0, 1, 2, 3].map(colIndex => results.map(row => row[colIndex]));
+                            //Send each chromatogram's time and intensity as one float32 block of a single binary buffer
+                            const packed = pack_arrays(results.map(row => [row[4], row[5]]), Float32Array)
                             this.model.setv({
                                 progress_percent: -1,
                                 progress_status: 'Uploading data.  Please wait...'
                             })
                             console.log("Uploading data")
                             this.model.setv({
-                                transfered_text: results_trans.slice(0,4),
-                                transfered_data: results_trans.slice(4),
+                                transfered_text: results_trans,
+                                transfered_dtype: 'float32',
+                                transfered_index: packed.index,
+                                transfered_buffer: packed.buffer,
                             })
                             this.model.setv({
                                 progress_state: 2,
@@ -969,9 +1102,12 @@ export class FileProgressInputView extends InputWidgetView {
                     bin_data.push(ab1_file.results)
 
                 })
+                const packed = pack_arrays(bin_data, Uint16Array)
                 this.model.setv({
                     transfered_text: [sample_names],
-                    transfered_data: bin_data,
+                    transfered_dtype: 'uint16',
+                    transfered_index: packed.index,
+                    transfered_buffer: packed.buffer,
                 })
                 this.model.setv({
                     progress_state: 2,
@@ -994,7 +1130,21 @@ export namespace FileProgressInput {
     file_type: p.Property<string>,
     harvest: p.Property<boolean>,
     transfered_text: p.Property<string[][]>,
-    transfered_data: p.Property<number[][][]>
+    transfered_dtype: p.Property<string>,
+    transfered_index: p.Property<number[][]>,
+    transfered_buffer: p.Property<ArrayBuffer>,
+    server_parse: p.Property<boolean>,
+    chunk_size: p.Property<number>,
+    upload_name: p.Property<string>,
+    upload_index: p.Property<number>,
+    upload_offset: p.Property<number>,
+    upload_final: p.Property<boolean>,
+    upload_chunk: p.Property<ArrayBuffer>,
+    upload_count: p.Property<number>,
+    upload_ack: p.Property<number>,
+    upload_request: p.Property<string>,
+    upload_manifest: p.Property<string[][]>,
+    upload_resume: p.Property<number[]>
   }
 }
 
@@ -1010,7 +1160,7 @@ export class FileProgressInput extends InputWidget {
 
   static {
     this.prototype.default_view = FileProgressInputView
-    this.define<FileProgressInput.Props>(({Number, String, Boolean, Array, Tuple}) => ({
+    this.define<FileProgressInput.Props>(({Number, String, Boolean, Array, Tuple, Bytes}) => ({
         multiple:         [ Boolean, false ],
         progress_state:   [ Number, 0],
         progress_percent: [ Number, 0],
@@ -1018,7 +1168,21 @@ export class FileProgressInput extends InputWidget {
         file_type:        [ String, "" ],
         harvest:          [ Boolean, false ],
         transfered_text:  [ Array(Tuple(String)), [[""]]],
-        transfered_data:  [ Array(Array(Tuple(Number))), [[[0]]] ]
+        transfered_dtype: [ String, "float32" ],
+        transfered_index: [ Array(Array(Number)), [] ],
+        transfered_buffer: [ Bytes, new ArrayBuffer(0) ],
+        server_parse:     [ Boolean, false ],
+        chunk_size:       [ Number, 4194304 ],
+        upload_name:      [ String, "" ],
+        upload_index:     [ Number, 0 ],
+        upload_offset:    [ Number, 0 ],
+        upload_final:     [ Boolean, false ],
+        upload_chunk:     [ Bytes, new ArrayBuffer(0) ],
+        upload_count:     [ Number, 0 ],
+        upload_ack:       [ Number, 0 ],
+        upload_request:   [ String, "" ],
+        upload_manifest:  [ Array(Array(String)), [] ],
+        upload_resume:    [ Array(Number), [] ]
     }))
   }
 }
\ No newline at end of file
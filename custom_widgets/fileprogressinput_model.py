@@ -1,4 +1,4 @@
-from bokeh.core.properties import List, String, Bool, Int, Float, Dict
+from bokeh.core.properties import List, String, Bool, Int, Float, Dict, Bytes
 from bokeh.models import InputWidget
 
 class FileProgressInput(InputWidget):
@@ -18,7 +18,24 @@ class FileProgressInput(InputWidget):
 
     harvest = Bool(default=False)
     transfered_text = List(List(String(default=""), default=[]), default=[])
-    transfered_data = List(List(List(Float(default=0), default=[]), default=[]), default=[])
+    #Uploaded arrays, packed into one binary buffer with a [byte offset, rows, columns] index entry per block
+    transfered_dtype = String(default="float32")
+    transfered_index = List(List(Int), default=[])
+    transfered_buffer = Bytes(default=b"")
+
+    #Raw file upload for server-side parsing, sent one chunk at a time and acknowledged by the server
+    server_parse = Bool(default=False)
+    chunk_size = Int(default=4194304)
+    upload_name = String(default="")
+    upload_index = Int(default=0)
+    upload_offset = Int(default=0)
+    upload_final = Bool(default=False)
+    upload_chunk = Bytes(default=b"")
+    upload_count = Int(default=0)
+    upload_ack = Int(default=0)
+    upload_request = String(default="")
+    upload_manifest = List(List(String), default=[])
+    upload_resume = List(Int, default=[])
     #transfered_data = List(List(String(default=""), default=[]), default=[[]])
     #transfered_data = List(List(Float(default=0), default=[]), default=[[]])
     #file_content = String(default = "")
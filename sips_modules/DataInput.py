@@ -3,11 +3,17 @@ import numpy as np
 import panel as pn
 
 import traceback
+from functools import partial
 
 from custom_widgets.fileprogressinput import FileProgressInput
 from custom_widgets.dataselectiontable import DataSelectionTable
 from .PlateClass import *
-from .global_utils import get_pn_id_token
+from .global_utils import get_pn_id_token, JobRunner
+from .empower_utils import EmpowerIngest
+from .parallel_utils import get_process_pool
+
+#Uploads with at least this many files are parsed on the process pool
+PARALLEL_INGEST_MIN_FILES = 8
 
 sidebar_text = """### Data Input
 SIPS takes the following data as inputs and file formats:
@@ -62,7 +68,10 @@ class module_class:
         library: Library = pn.state.cache['id_tokens'][get_pn_id_token()]['library']
         try:
             #Input declarations and section assembly
-            fi_multi_upload = FileProgressInput(name='bk_fi_multi_upload', width=300, height=450, multiple=True)
+            fi_multi_upload = FileProgressInput(name='bk_fi_multi_upload', width=300, height=450, multiple=True, server_parse=True)
+            #Empower files are uploaded raw and parsed here, instead of in the browser.  Kept with the user's library, so
+            #an upload cut off by a dropped connection can resume in the next session.
+            ingest: EmpowerIngest = pn.state.cache['id_tokens'][get_pn_id_token()].setdefault('ingest', EmpowerIngest())
 
             fi_plate_name = pn.widgets.TextInput(name='New plate name:', width=200)
             fi_add_plate_button = pn.widgets.Button(name='Add Plate', button_type='primary', width=200)
@@ -173,6 +182,64 @@ class module_class:
         fi_delete_plate_button.on_click(fi_delete_plate_watchdog)
         
         #File upload and parsing
+        #Harvesting server-parsed files runs in the background, so the progress bar updates while the files are read
+        jobs = JobRunner(self.status_text, self.progress_bar, self.debug_text)
+
+        def store_empower_records(plate, records, library_compounds: set, plate_compounds: set):
+            #Adds (sample name, well, compound, source, time, intensity) records to a plate, skipping compounds a well already has
+            #The compound sets mirror library.compounds and the plate's compounds, so each record is checked in constant time
+            wells = library[plate].wells
+            for sample_name, well, compound, source, time, intensity in records:
+                if well not in wells:
+                    library[plate].add_well(well)
+                if compound not in wells[well].chromatograms:
+                    wells[well].add_chromatogram(compound, time, intensity, sample_name, source)
+                    if compound not in library_compounds:
+                        library_compounds.add(compound)
+                        library.compounds.append(compound)
+                    if compound not in plate_compounds:
+                        plate_compounds.add(compound)
+                        library[plate].compounds.append(compound)
+
+        def submit_harvest(plate, compounds, sources, targets):
+            library_compounds = set(library.compounds)
+            plate_compounds = set(library[plate].compounds)
+            #Parse larger uploads on the process pool
+            executor = get_process_pool() if len(ingest.headers) >= PARALLEL_INGEST_MIN_FILES else None
+            def finish_harvest():
+                #Keep whatever was added, even if the harvest stopped part way, and go back to idle
+                library[plate].pack()
+                fi_multi_upload.progress_state = 0
+            def work(job):
+                try:
+                    for n_done, n_total, records in ingest.iter_harvest(compounds, sources, [float(x) for x in targets], executor=executor):
+                        #Each file's chromatograms are added on the session's event loop as soon as it's parsed
+                        jobs.call_soon(partial(store_empower_records, plate, records, library_compounds, plate_compounds))
+                        job.set_progress(n_done, n_total)
+                finally:
+                    jobs.call_soon(finish_harvest)
+            def apply(result):
+                #The raw files aren't needed once they're in the library
+                ingest.reset()
+                self.status_text.value = "Done loading data!"
+            if jobs.submit(f"Harvesting {plate}", work, apply) is None:
+                fi_multi_upload.progress_state = 0
+
+        def fi_upload_request_received(event):
+            try:
+                if fi_multi_upload.upload_request == 'manifest':
+                    #Tell the browser how much of each file is already here, so it only sends the rest
+                    fi_multi_upload.upload_resume = ingest.start_upload(fi_multi_upload.upload_manifest)
+                else:
+                    ingest.add_chunk(fi_multi_upload.upload_name, fi_multi_upload.upload_offset, fi_multi_upload.upload_chunk, fi_multi_upload.upload_final)
+            except Exception as e:
+                self.status_text.value = "fi_upload_request_received: " + str(e)
+                self.debug_text.value += traceback.format_exc() + "\n\n"
+            finally:
+                #Always acknowledge, so the browser doesn't wait forever on a bad file
+                fi_multi_upload.upload_ack += 1
+        fi_multi_upload.param.watch(fi_upload_request_received, ['upload_count'], onlychanged=False)
+
         def fi_upload_state_changed(event):
             try:
                 if event.new == 1:
@@ -180,6 +247,10 @@ class module_class:
                     fi_compound_input_module.visible = False
                     fi_alignment_input_module.visible = False
                     if fi_multi_upload.file_type == "Empower":
+                        if fi_multi_upload.server_parse:
+                            possible_sources, wavelengths_3d = ingest.get_sources()
+                            fi_target_table.param.update(possible_sources=possible_sources, wavelengths_3d=wavelengths_3d, curr_page=0)
+                            fi_target_table.update_sources = not fi_target_table.update_sources
                         fi_compound_input_module.visible = True
                     elif fi_multi_upload.file_type == "FASTA":
                         fi_alignment_parent_entry.options = sorted([x[0] for x in fi_multi_upload.transfered_text])
@@ -224,21 +295,13 @@ class module_class:
                     #Go through the received data and store it
                     plate = self.fi_plate_selector.value
                     if fi_multi_upload.file_type == "Empower":
-                        for i in range(len(fi_multi_upload.transfered_text[0])):
-                            sample_name = fi_multi_upload.transfered_text[0][i]
-                            well = fi_multi_upload.transfered_text[1][i]
-                            compound = fi_multi_upload.transfered_text[2][i]
-                            source = fi_multi_upload.transfered_text[3][i]
-                            time = np.array(fi_multi_upload.transfered_data[0][i], dtype=np.float32)
-                            intensity = np.array(fi_multi_upload.transfered_data[1][i], dtype=np.float32)
-                            if well not in library[plate]:
-                                library[plate].add_well(well)
-                            if compound not in library[plate][well]:
-                                library[plate][well].add_chromatogram(compound, time, intensity, sample_name, source)
-                                if compound not in library.compounds:
-                                    library.compounds.append(compound)
-                                if compound not in library[plate].compounds:
-                                    library[plate].compounds.append(compound)
+                        transfered_arrays = fi_multi_upload.get_transfered_arrays()
+                        store_empower_records(plate, [
+                            (*[fi_multi_upload.transfered_text[j][i] for j in range(4)], *transfered_arrays[i])
+                            for i in range(len(fi_multi_upload.transfered_text[0]))
+                        ], set(library.compounds), set(library[plate].compounds))
+                        #Pack the plate's chromatograms into contiguous per-compound storage
+                        library[plate].pack()
                     elif fi_multi_upload.file_type == "FASTA":
                         for i in range(len(fi_multi_upload.transfered_text)):
                             sample_name = fi_multi_upload.transfered_text[i][0]
@@ -270,9 +333,10 @@ class module_class:
                                     library[plate][well].add_sequencing()
                                 library[plate][well].sequencing.add_alignment(seq, read_dir)
                     elif fi_multi_upload.file_type == "AB1":
+                        transfered_arrays = fi_multi_upload.get_transfered_arrays()
                         for i in range(len(fi_multi_upload.transfered_text[0])):
                             sample_name = fi_multi_upload.transfered_text[0][i]
-                            ab1_data = np.array(fi_multi_upload.transfered_data[i], dtype=np.uint16)
+                            ab1_data = transfered_arrays[i]
                             well = sample_name[fi_alignment_well_row_index.value]
                             if fi_alignment_well_leading_zero.value:
                                 well += sample_name[fi_alignment_well_column_index.value:fi_alignment_well_column_index.value+2]
@@ -299,6 +363,14 @@ class module_class:
                     #Go back to idle
                     self.status_text.value = "Done loading data!"
                     fi_multi_upload.progress_state = 0
+                elif event.new == 3:
+                    #Harvest the requested compounds from the files uploaded for server-side parsing
+                    plate = self.fi_plate_selector.value
+                    if fi_multi_upload.file_type == "Empower":
+                        submit_harvest(plate, *fi_multi_upload.transfered_text)
+                    else:
+                        self.status_text.value = "Done loading data!"
+                        fi_multi_upload.progress_state = 0
             except Exception as e:
                 self.status_text.value = "fi_upload_state_changed: " + str(e)
                 self.debug_text.value += traceback.format_exc() + "\n\n"
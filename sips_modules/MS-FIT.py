@@ -5,19 +5,23 @@ from io import StringIO
 import param
 import panel as pn
 
-from scipy.ndimage import gaussian_filter1d
 from scipy.integrate import simpson
 
 import traceback
 
 import holoviews as hv
 from holoviews import opts
-from holoviews.streams import Stream, DoubleTap, SingleTap, BoundsX
+from holoviews.streams import Stream, DoubleTap, SingleTap, BoundsX, RangeX, Pipe
 
 from bokeh import palettes
 
-from .PlateClass import Library
-from .global_utils import get_pn_id_token
+from .PlateClass import Library, smoothing_cache
+from .global_utils import get_pn_id_token, RefreshScheduler, JobRunner
+from .parallel_utils import compute_peak_results
+from .export_utils import EXPORT_FORMATS, export_results
+from .alignment_utils import get_drift_offsets
+from .plot_utils import get_overlay_bins, get_visible_range, minmax_decimation_indices, get_integration_geometry
+from .plot_utils import WELL_PLATE_LAYOUTS, get_row_label, get_well_id, parse_well_id, get_plate_layout, palette_to_lut, colorize_plate
 
 
 sidebar_text = """### MS-FIT
@@ -43,6 +47,7 @@ The workflow for processing data is as follows:
 * If available, slope/intercept information from a standard curve can also be provided
 * Select an integration region in the upper plot using the "Box Select" tool
 * If the peaks are poorly grouped, you can use "Drift Corr." to align the peaks and re-specify the integration region
+  * Peaks within the integration region are aligned to the median chromatogram, or to the well chosen in "Align to" (e.g. the parent)
 * Run an initial integration, then select a few wells to see how well the integration performed
 * If the peak edges are very far from the peak, you can increase "Friction Threshold" to reduce by how much the initial bounds are moved
 * If your peak is co-eluting, "Drop baseline" can be used to avoid steep baselines
@@ -54,6 +59,7 @@ The workflow for processing data is as follows:
   * "CWT Min Scale" specifies the minimum scale used in the CWT analysis.  The smaller the value, the more small features will be considered peaks
   * "CWT Max Scale" specifies the maximum scale used in the CWT analysis.  The larger the value, the more large features will be considered peaks
   * "CWT Neighborhood" specifies how many neighboring pixles are checked when searching for local minima/maxima.  Increasing this can reduce the number of false peaks/edges
+  * "Windowed CWT" limits the CWT analysis to the region around the integration bounds, which is much faster for long chromatograms.  Uncheck to analyze the full chromatogram.
   * "CWT Analysis" shows the CWT analysis data for a single selected well.  Detected peaks are indicated by yellow regions, while detected valleys (peak edges) are indicated by dark blue regions.
     * Ideally, you should see a strong yellow region flanked by strong dark blue regions.  If you don't see this, try increasing the "Smoothing Factor" to make the peaks more gaussian in shape.
 """
@@ -98,6 +104,7 @@ class module_class:
         pp_cwt_min_scale_input = pn.widgets.IntInput(name='CWT Min Scale', value=1, start=1, end=97, width=80)
         pp_cwt_max_scale_input = pn.widgets.IntInput(name='CWT Max Scale', value=60, start=20, end=100, width=80)
         pp_cwt_neighborhood_input = pn.widgets.IntInput(name='CWT Neighborhood', value=1, start=1, end=49, width=80)
+        pp_cwt_window_checkbox = pn.widgets.Checkbox(name='Windowed CWT', value=True, width=80)
         pp_friction_input = pn.widgets.FloatInput(name='Friction Threshold', value=0.00, step=0.001, start=0.000, end=1.000, width=80)
         pp_stcurve_slope = pn.widgets.FloatInput(name='Slope', width=80)
         pp_stcurve_intercept = pn.widgets.FloatInput(name='Intercept', width=80)
@@ -107,9 +114,11 @@ class module_class:
         pp_drift_correct_plate_button = pn.widgets.Button(name='Plate', width=80, disabled=True, button_type='primary')
         pp_clear_drift_correct_selection_button = pn.widgets.Button(name='Clear Sel.', width=80, disabled=True, button_type='danger')
         pp_clear_drift_correct_plate_button = pn.widgets.Button(name='Clear Plate', width=80, button_type='danger')
+        pp_drift_reference_selector = pn.widgets.Select(name='Align to', options=['Median'], value='Median', width=80)
         pp_integrate_selection_button = pn.widgets.Button(name='Selected', width=80, disabled=True, button_type='primary')
         pp_integrate_plate_button = pn.widgets.Button(name='Plate', width=80, disabled=True, button_type='primary')
         pp_integrate_library_button = pn.widgets.Button(name='Library', width=80, disabled=True, button_type='primary')
+        pp_cancel_job_button = pn.widgets.Button(name='Cancel', width=80, disabled=True, button_type='danger')
         
         pp_peak_source_display = pn.widgets.TextInput(name='Source', width=150, disabled=True)
         pp_peak_rt_display = pn.widgets.TextInput(name='Retention Time', width=150, disabled=True)
@@ -122,32 +131,8 @@ class module_class:
 
         def download_data_csv_callback():
             try:
-                #First, get all our compounds
-                compounds = set()
-                for plate in library:
-                    for well in library[plate]:
-                        compounds.update(set(library[plate][well]))
-                columns = ['Plate', 'Well', 'Sample'] + list(compounds)
-                n_columns = len(columns)
-                #Harvest our data
-                well_order = [f"{chr(65+i)}{str(j).zfill(2)}" for j in range(1,13) for i in range(8)]
-                data = []
-                for plate in library:
-                    for well in well_order:
-                        if well in library[plate]:
-                            data.append(['' for _ in range(n_columns)])
-                            data[-1][0] = plate
-                            data[-1][1] = well
-                            
-                            for compound in library[plate][well]:
-                                if library[plate][well][compound].sample_name != None:
-                                    data[-1][2] = library[plate][well][compound].sample_name
-                                data[-1][columns.index(compound)] = library[plate][well][compound].peak_area
-                #Send a stream to the file download widget
-                sio = StringIO()
-                pd.DataFrame(data, columns=columns).to_csv(sio, index=False)
-                sio.seek(0)
-                return sio
+                #Tidy table of every chromatogram's results, read in bulk from the plates' tables
+                return export_results(library, pp_download_format.value)
             except Exception as e:
                 self.status_text.value = "download_data_csv_callback: " + str(e)
                 self.debug_text.value += traceback.format_exc() + "\n\n"
@@ -156,10 +141,12 @@ class module_class:
         pp_download_csv_button = pn.widgets.FileDownload(
             name='Download',
             callback=download_data_csv_callback, filename='library_integration_data.csv',
-            width = 125, button_type='primary', label='Download .csv'
+            width = 125, button_type='primary', label='Download'
         )
 
-        pp_download_filename = pn.widgets.TextInput(name='Filename:', placeholder='library_integration_data.csv', width=200)
+        pp_download_filename = pn.widgets.TextInput(name='Filename:', placeholder='library_integration_data', width=200)
+        pp_download_format = pn.widgets.Select(name='Format:', options=list(EXPORT_FORMATS), value='csv', width=100,
+            visible=len(EXPORT_FORMATS) > 1)
         
         def download_data_plate_callback():
             try:
@@ -204,12 +191,14 @@ class module_class:
             def __init__(self, outer_instance, **params):
                 super().__init__(**params)
                 self.outer_instance = outer_instance
+                self.color_lut = palette_to_lut(self.color_map)
+                #Plate data is only sent to the plot when it changes, and the plot updates its existing source in place
+                self.layout = WELL_PLATE_LAYOUTS[0]
+                self.plate_data = None
+                self.plate_pipe = Pipe(data=None)
                 #Setup plate overlay with grid
-                self.grid = hv.Path(
-                    [[(i, -0.5), (i, 7.5)] for i in np.arange(-0.5, 12.5)] + 
-                    [[(-0.5, i), (11.5, i)] for i in np.arange(-0.5, 8.5)]
-                    ).opts(line_color='k', line_width=3)
-                self.plate_plot = hv.DynamicMap(self.plate_plot_dmap, streams=[Stream.define('Next')()]).opts(framewise=True)
+                self.grid = hv.DynamicMap(self.grid_dmap, streams=[self.plate_pipe])
+                self.plate_plot = hv.DynamicMap(self.plate_plot_dmap, streams=[self.plate_pipe]).opts(framewise=True)
                 self.highlight_plot = hv.DynamicMap(self.highlight_dmap, streams=[Stream.define('Next')()]).opts(framewise=True)
                 self.plot = (self.plate_plot * self.grid * self.highlight_plot).opts(xlabel="", ylabel="", xaxis='top', toolbar=None, default_tools=[])
                 
@@ -221,93 +210,101 @@ class module_class:
                 
             def tap_select(self, x, y):
                 plate = self.outer_instance.pp_plate_selector.value
-                well = f"{chr(int(72-np.round(y, 0)))}{str(int(np.round(x, 0)+1)).zfill(2)}"
+                n_rows, n_cols = self.layout
+                row = n_rows - 1 - int(np.round(y, 0))
+                col = int(np.round(x, 0))
+                if (row < 0) or (row >= n_rows) or (col < 0) or (col >= n_cols):
+                    return
+                well = get_well_id(row, col)
                 print(well)
                 if well in self.well_list:
                     del self.well_list[self.well_list.index(well)]
-                    selection_view.update_overlay_plot()
-                    selection_view.integration_statistics_plot.event()
-                    self.highlight_plot.event()
-                    selection_change()
+                    refresh.mark('highlight', 'overlay', 'statistics', 'selection')
                 else:
-                    if well in self.outer_instance.library[plate]:
+                    if well in library[plate]:
                         self.well_list.append(well)
-                        selection_view.update_overlay_plot()
-                        selection_view.integration_statistics_plot.event()
-                        self.highlight_plot.event()
-                        selection_change()
+                        refresh.mark('highlight', 'overlay', 'statistics', 'selection')
 
             def double_tap_clear(self, x, y):
                 self.well_list = []
-                selection_view.update_overlay_plot()
-                selection_view.integration_statistics_plot.event()
-                self.highlight_plot.event()
-                selection_change()
+                refresh.mark('highlight', 'overlay', 'statistics', 'selection')
+
+            def get_dimensions(self, n_rows: int, n_cols: int):
+                return hv.Dimension('plate_col', range=(-0.5, n_cols-0.5)), hv.Dimension('plate_row', range=(-0.5, n_rows-0.5))
 
             def highlight_dmap(self):
+                n_rows, n_cols = self.layout
+                plate_col, plate_row = self.get_dimensions(n_rows, n_cols)
+                plots = []
                 try:
-                    plate_row = hv.Dimension('plate_row', range=(-0.5, 7.5))
-                    plate_col = hv.Dimension('plate_col', range=(-0.5, 11.5))
-                    plots = []
                     if self.well_list == []:
                         plots.append([(0,0),(0,0)])
                     else:
                         for well in self.well_list:
-                            x = int(well[1:])-1.5
-                            y = 72.5-ord(well[0])
+                            row, col = parse_well_id(well)
+                            x = col - 0.5
+                            y = n_rows - 0.5 - row
                             plots.append([(x,y),(x+1,y),(x+1,y-1),(x,y-1),(x,y)])
                 except Exception as e:
                     self.outer_instance.status_text.value = "highlight_dmap: " + str(e)
                     self.outer_instance.debug_text.value += traceback.format_exc() + "\n\n"
                 return hv.Path(plots).opts(line_color='white', line_width=3).redim(x=plate_col, y=plate_row)
 
-            def plate_plot_dmap(self):
-                rgb_data = np.full((8, 12, 3), 127, dtype=np.uint8)
-                plate_row = hv.Dimension('plate_row', range=(-0.5, 7.5))
-                plate_col = hv.Dimension('plate_col', range=(-0.5, 11.5))
+            def grid_dmap(self, data):
+                n_rows, n_cols = WELL_PLATE_LAYOUTS[0] if data is None else data[0]
+                plate_col, plate_row = self.get_dimensions(n_rows, n_cols)
+                return hv.Path(
+                    [[(i, -0.5), (i, n_rows-0.5)] for i in np.arange(-0.5, n_cols+0.5)] + 
+                    [[(-0.5, i), (n_cols-0.5, i)] for i in np.arange(-0.5, n_rows+0.5)]
+                    ).opts(line_color='k', line_width=3 if n_cols <= 12 else 1).redim(x=plate_col, y=plate_row)
+
+            def get_plate_data(self):
+                """Returns the plate layout, the peak area of each well position (NaN if not integrated), and which positions have the compound"""
+                plate_selection = self.outer_instance.pp_plate_selector.value
+                compound_selection = self.outer_instance.pp_compound_selector.value
+                if (plate_selection == "") or (compound_selection == "") or (plate_selection == None) or (compound_selection == None):
+                    return None
+                layout = get_plate_layout(library[plate_selection])
+                values = np.full(layout, np.nan)
+                present = np.zeros(layout, dtype=bool)
+                #Read the peak areas straight out of the plate's result columns
+                table = library[plate_selection].get_table(compound_selection)
+                if len(table) > 0:
+                    rows, cols = np.array([parse_well_id(well) for well in table.well_ids]).T
+                    present[rows, cols] = True
+                    values[rows, cols] = table.get_column('peak_area')
+                return layout, values, present
+
+            def update_plate_plot(self):
+                """Sends the plate data to the heatmap, if it has changed since it was last sent"""
                 try:
-                    #Harvest data
-                    row_cols = []
-                    acts = []
-                    plate_selection = self.outer_instance.pp_plate_selector.value
-                    compound_selection = self.outer_instance.pp_compound_selector.value
-                    if (plate_selection != "") and (compound_selection != "") and (plate_selection != None) and (compound_selection != None):
-                        #Cycle through all wells present in plate
-                        for well in self.outer_instance.library[plate_selection]:
-                            #Make sure the compound is in the well
-                            if compound_selection in self.outer_instance.library[plate_selection][well]:
-                                #Check if we have actually integrated the well
-                                if self.outer_instance.library[plate_selection][well][compound_selection].peak_area != None:
-                                    #Store the indexing as well as the value for coloring
-                                    row_cols.append((ord(well[0])-65, int(well[1:]) - 1))
-                                    acts.append(self.outer_instance.library[plate_selection][well][compound_selection].peak_area)
-                                else:
-                                    #Set the well to white to indicate it is not integrated
-                                    rgb_data[ord(well[0])-65, int(well[1:]) - 1] = [255, 255, 255]
-                        #Only color if we have wells to color
-                        if len(acts) > 0:
-                            if len(acts) == 1:
-                                #Fix single well to highest value
-                                acts = np.array([255]).astype(np.uint8)
-                            else:
-                                #Normalize
-                                acts = np.array(acts)
-                                acts = np.round(255 * (acts - acts.min()) / (acts.max() - acts.min() + 1E-32), 0).astype(np.uint8)
-                            #Make color grid
-                            for i in range(acts.size):
-                                hex_color = self.color_map[acts[i]][1:]
-                                rgb_data[*row_cols[i], :] = [int(hex_color[i:i+2], 16) for i in range(0,6,2)]
-                    return hv.RGB(rgb_data, bounds=((-0.5,-0.5,11.5,7.5))).opts(
-                        xticks=[(i, str(i+1)) for i in range(12)],
-                        yticks=[(i, chr(72-i)) for i in range(8)], 
-                    ).redim(x=plate_col, y=plate_row)
+                    data = self.get_plate_data()
+                    if (data is None) and (self.plate_data is None):
+                        return
+                    if (data is not None) and (self.plate_data is not None) and (data[0] == self.plate_data[0]) and \
+                            np.array_equal(data[1], self.plate_data[1], equal_nan=True) and np.array_equal(data[2], self.plate_data[2]):
+                        return
+                    self.plate_data = data
+                    self.layout = WELL_PLATE_LAYOUTS[0] if data is None else data[0]
+                    self.plate_pipe.send(data)
+                except Exception as e:
+                    self.outer_instance.status_text.value = "update_plate_plot: " + str(e)
+                    self.outer_instance.debug_text.value += traceback.format_exc() + "\n\n"
+
+            def plate_plot_dmap(self, data):
+                n_rows, n_cols = WELL_PLATE_LAYOUTS[0] if data is None else data[0]
+                plate_col, plate_row = self.get_dimensions(n_rows, n_cols)
+                rgb_data = np.full((n_rows, n_cols, 3), 127, dtype=np.uint8)
+                try:
+                    if data is not None:
+                        rgb_data = colorize_plate(data[1], data[2], self.color_lut)
                 except Exception as e:
                     self.outer_instance.status_text.value = "plate_plot_dmap: " + str(e)
                     self.outer_instance.debug_text.value += traceback.format_exc() + "\n\n"
-                    return hv.RGB(rgb_data, bounds=((-0.5,-0.5,11.5,7.5))).opts(
-                        xticks=[(i, str(i+1)) for i in range(12)],
-                        yticks=[(i, chr(72-i)) for i in range(8)], 
-                    ).redim(x=plate_col, y=plate_row)
+                return hv.RGB(rgb_data, bounds=((-0.5, -0.5, n_cols-0.5, n_rows-0.5))).opts(
+                    xticks=[(i, str(i+1)) for i in range(n_cols)],
+                    yticks=[(i, get_row_label(n_rows-1-i)) for i in range(n_rows)], 
+                ).redim(x=plate_col, y=plate_row)
                 
         plate_view = PlateView(outer_instance=self)
 
@@ -321,7 +318,10 @@ class module_class:
                 self.update_overlay_plot_stream = Stream.define('flag', flag=False)()
                 self.selection_stream = BoundsX(boundsx=(0,0))
                 self.selection_stream.param.watch(self.range_selection_input, ['boundsx'], onlychanged=False)
-                self.overlay_plot = hv.DynamicMap(self.overlay_plot_dmap, streams=[self.selection_stream, self.update_overlay_plot_stream]).opts(framewise=True, tools=['hover', 'xbox_select', 'box_zoom'])
+                #Zoom range, so the overlay is only sent at the resolution visible in the plot
+                self.range_stream = RangeX()
+                self.overlay_width = 500
+                self.overlay_plot = hv.DynamicMap(self.overlay_plot_dmap, streams=[self.selection_stream, self.update_overlay_plot_stream, self.range_stream]).opts(framewise=True, tools=['hover', 'xbox_select', 'box_zoom'])
                 self.integration_statistics_plot = hv.DynamicMap(self.integration_statistics_dmap, streams=[Stream.define('Next')()]).opts(framewise=True)
                 self.integration_region_plot = hv.DynamicMap(self.selection_plot_dmap, streams=[self.selection_stream]).opts(framewise=True)
                 self.plot = (self.integration_region_plot * self.overlay_plot * self.integration_statistics_plot).opts(show_legend=False, framewise=True).opts(
@@ -333,7 +333,7 @@ class module_class:
             def update_overlay_plot(self):
                 self.update_overlay_plot_stream.event(flag=not self.update_overlay_plot_stream.flag)
             
-            def overlay_plot_dmap(self, **kwargs):
+            def overlay_plot_dmap(self, x_range=None, **kwargs):
                 try:
                     plate = self.outer_instance.pp_plate_selector.value
                     compound = self.outer_instance.pp_compound_selector.value
@@ -344,21 +344,33 @@ class module_class:
                         plots['N/A'] = hv.Curve((np.zeros(1), np.zeros(1)))
                     else:
                         self.outer_instance.status_text.value = "Generating curves..."
-                        #Grab all our possible wells
-                        well_list = self.outer_instance.library[plate]
+                        #Grab all our possible wells that have the compound
+                        table = library[plate].get_table(compound)
+                        well_list = table.well_ids
                         #If we've made a selection, reduce what we are viewing to the selection
                         if plate_view.well_list != []:
                             well_list = [x for x in well_list if x in plate_view.well_list]
-                        #Go through all our wells that we have requested to plot
-                        for i, well in enumerate(well_list, 1):
-                            #Make sure the compound is in the well
-                            if compound in self.outer_instance.library[plate][well]:
-                                #Get our time and smoothed chromatogram
-                                x = self.outer_instance.library[plate][well][compound].time + self.outer_instance.library[plate][well][compound].drift_offset
-                                y = gaussian_filter1d(self.outer_instance.library[plate][well][compound].intensity, pp_sigma_input.value)
-                                #Add the chromatogram curve to our dictionary
-                                plots[well] = hv.Curve((x,y))
-                            self.outer_instance.progress_bar.value = int(np.round((i * 100) / len(well_list)))
+                        rows = {well: i for i, well in enumerate(table.well_ids)}
+                        chroms = [table.chromatograms[rows[well]] for well in well_list]
+                        drift_offsets = np.array([chrom.drift_offset for chrom in chroms])
+                        #Only send the min/max of each bin of the visible range, which looks the same at the plot's resolution
+                        n_bins = get_overlay_bins(len(well_list), self.overlay_width)
+                        if table.shared_time and (len(chroms) > 0):
+                            #Decimate all of the smoothed chromatograms together
+                            y = smoothing_cache.get_many([chrom.intensity for chrom in chroms], pp_sigma_input.value)
+                            start, end = get_visible_range(table.time, x_range, drift_offsets)
+                            inds = minmax_decimation_indices(y, start, end, n_bins)
+                            x = table.time[inds] + drift_offsets[:,np.newaxis]
+                            y = np.take_along_axis(y, inds, axis=1)
+                            for i, well in enumerate(well_list):
+                                plots[well] = hv.Curve((x[i], y[i]))
+                        else:
+                            for i, (well, chrom) in enumerate(zip(well_list, chroms)):
+                                y = smoothing_cache.get(chrom.intensity, pp_sigma_input.value)[np.newaxis]
+                                start, end = get_visible_range(chrom.time, x_range, drift_offsets[i:i+1])
+                                inds = minmax_decimation_indices(y, start, end, n_bins)[0]
+                                plots[well] = hv.Curve((chrom.time[inds] + drift_offsets[i], y[0,inds]))
+                        self.outer_instance.progress_bar.value = 100
                         self.outer_instance.status_text.value = f"Displaying overlay..."
                     #Display our overlaid plots
                     return hv.NdOverlay(plots)
@@ -371,49 +383,36 @@ class module_class:
                 try:
                     plate = self.outer_instance.pp_plate_selector.value
                     compound = self.outer_instance.pp_compound_selector.value
-                    plots = []
+                    polygons = []
+                    lines = np.zeros((0, 2))
+                    alpha_val = 1
                     #Make sure we have stuff to actually plot, or return an empty plot if not
-                    if (plate == "") or (compound == "") or (plate == None) or (compound == None) or (len(plate_view.well_list) == 0) or (len(plate_view.well_list) > 10):
-                        plots = [
-                            hv.Area(([0], [0], [0]), kdims='x', vdims=['y', 'y1']),
-                            hv.Curve({'x': [0], 'y':[0]}),
-                            hv.Curve({'x': [0], 'y': [0]})
-                        ]
-                    else:
-                        plots = []
-                        alpha_val = 1/len(plate_view.well_list)
-                        for i, well in enumerate(plate_view.well_list, 1):
-                            #Make sure the compound is in the well
-                            if compound in self.outer_instance.library[plate][well]:
-                                #Make sure the well has integration statistics to plot
-                                if self.outer_instance.library[plate][well][compound].peak_area != None:
-                                    #Get the time and chromatogram
-                                    lr_inds = self.outer_instance.library[plate][well][compound].peak_bound_inds
-                                    x = (self.outer_instance.library[plate][well][compound].time + self.outer_instance.library[plate][well][compound].drift_offset)[lr_inds[0]:lr_inds[1]]
-                                    y_top = self.outer_instance.library[plate][well][compound].intensity[lr_inds[0]:lr_inds[1]]
-                                    #Make our baseline
-                                    slope = (y_top[-1] - y_top[0]) / (x[-1] - x[0])
-                                    intercept = y_top[-1] - (slope * x[-1])
-                                    baseline_y = (slope * x) + intercept
-                                    #Get our height line index
-                                    midpoint_ind = np.argmin(np.abs(x - self.outer_instance.library[plate][well][compound].rt))
-                                    #Add our plots
-                                    plots += [
-                                        hv.Area((x, baseline_y, y_top), kdims='x', vdims=['y', 'y1']).opts(color='#808080', alpha=alpha_val),
-                                        hv.Curve((x, baseline_y)).opts(color='#FF0000', alpha=alpha_val),
-                                        hv.Curve(([x[midpoint_ind], x[midpoint_ind]], [baseline_y[midpoint_ind], y_top[midpoint_ind]])).opts(color='#FF0000', alpha=alpha_val)
-                                    ]
-                            self.outer_instance.progress_bar.value = int(np.round((i * 100) / len(plate_view.well_list)))
-                    #Display our overlaid plots
-                    return hv.Overlay(plots)
+                    if (plate != "") and (compound != "") and (plate != None) and (compound != None) and (len(plate_view.well_list) > 0):
+                        table = library[plate].get_table(compound)
+                        selected = set(plate_view.well_list)
+                        #Only draw selected wells which have integration statistics to plot
+                        rows = np.array([i for i, well in enumerate(table.well_ids) if well in selected], dtype=np.int64)
+                        bounds = table.get_column('peak_bound_inds')[rows]
+                        rows = rows[~np.isnan(table.get_column('peak_area')[rows]) & (bounds[:,0] >= 0)]
+                        if rows.size > 0:
+                            polygons, lines = get_integration_geometry(
+                                table.time if table.shared_time else table.time[rows],
+                                table.intensity[rows],
+                                table.get_column('drift_offset')[rows],
+                                table.get_column('peak_bound_inds')[rows],
+                                table.get_column('rt')[rows]
+                            )
+                        #Keep overlapping wells see-through, without the lines vanishing for large selections
+                        alpha_val = max(1/len(plate_view.well_list), 0.05)
+                    #All wells are drawn with one area glyph and one line glyph, no matter how many are selected
+                    return hv.Overlay([
+                        hv.Polygons(polygons).opts(color='#808080', line_alpha=0, alpha=alpha_val),
+                        hv.Path([lines]).opts(color='#FF0000', alpha=alpha_val)
+                    ])
                 except Exception as e:
-                    self.outer_instance.status_text.value = "overlay_plot_dmap: " + str(e)
+                    self.outer_instance.status_text.value = "integration_statistics_dmap: " + str(e)
                     self.outer_instance.debug_text.value += traceback.format_exc() + "\n\n"
-                    return hv.Overlay([
-                            hv.Area(([0], [0], [0]), kdims='x', vdims=['y', 'y1']),
-                            hv.Curve({'x': [0], 'y':[0]}),
-                            hv.Curve({'x': [0], 'y': [0]})
-                        ])
+                    return hv.Overlay([hv.Polygons([]), hv.Path([np.zeros((0, 2))])])
             
             def selection_plot_dmap(self, boundsx):
                 return hv.VSpan(boundsx[0], boundsx[1])
@@ -425,7 +424,7 @@ class module_class:
                         pp_right_bound.value = event.new[1]
                         pp_rt_input.value = (event.new[0] + event.new[1]) / 2
                         pp_rt_tolerance.value = (event.new[1] - event.new[0]) / 2
-                        selection_change()
+                        refresh.mark('selection')
                 except Exception as e:
                     self.outer_instance.status_text.value = "range_selection_input: " + str(e)
                     self.outer_instance.debug_text.value += traceback.format_exc() + "\n\n"
@@ -454,10 +453,12 @@ class module_class:
                     library[plate][well][compound].cwt_min_scale = pp_cwt_min_scale_input.value
                     library[plate][well][compound].cwt_max_scale = pp_cwt_max_scale_input.value
                     library[plate][well][compound].cwt_neighborhood = pp_cwt_neighborhood_input.value
+                    library[plate][well][compound].cwt_window = pp_cwt_window_checkbox.value
                     library[plate][well][compound].peak_bound_inds = [
                         np.argmin(np.abs(pp_left_bound.value - library[plate][well][compound].time)), 
                         np.argmin(np.abs(pp_right_bound.value - library[plate][well][compound].time))
                     ]
+                    library[plate][well][compound].update_table(['rt', 'peak_bound_inds'])
                     #Perform CWT peak finding workflow
                     smoothed_chromatogram = library[plate][well][compound].gaussian_smoothing()
                     second_deriv = library[plate][well][compound].second_deriv(smoothed_chromatogram)
@@ -470,21 +471,23 @@ class module_class:
                     span = library[plate][well][compound].peak_bound_inds[1] - library[plate][well][compound].peak_bound_inds[0]
                     mask = (minima_inds[:,1] >= (library[plate][well][compound].peak_bound_inds[0] - span)) & (minima_inds[:,1] <= (library[plate][well][compound].peak_bound_inds[1] + span))
                     minima_inds = minima_inds[mask,:]
-                    #Figure out bounds with appropriate padding
-                    time_per_pixel = (library[plate][well][compound].time[-1] - library[plate][well][compound].time[0]) / cwtmatr.shape[1]
+                    #Figure out bounds with appropriate padding, only covering the CWT window if one is used
+                    window_start, window_end = library[plate][well][compound].get_cwt_window()
+                    window_time = library[plate][well][compound].time[window_start:window_end]
+                    time_per_pixel = (window_time[-1] - window_time[0]) / cwtmatr.shape[1]
                     bounds = [
-                        library[plate][well][compound].time[0] - (time_per_pixel/2),
+                        window_time[0] - (time_per_pixel/2),
                         pp_cwt_min_scale_input.value - 0.5,
-                        library[plate][well][compound].time[-1] + (time_per_pixel/2),
+                        window_time[-1] + (time_per_pixel/2),
                         pp_cwt_max_scale_input.value + 0.5
                     ]
                     #Map minima and maxima indicies to time values
                     minima_inds = minima_inds.astype(np.float32)
                     minima_inds[:,0] += pp_cwt_min_scale_input.value
-                    minima_inds[:,1] = minima_inds[:,1] * time_per_pixel + library[plate][well][compound].time[0]
+                    minima_inds[:,1] = (minima_inds[:,1] - window_start) * time_per_pixel + window_time[0]
                     maxima_inds = maxima_inds.astype(np.float32)
                     maxima_inds[:,0] += pp_cwt_min_scale_input.value
-                    maxima_inds[:,1] = maxima_inds[:,1] * time_per_pixel + library[plate][well][compound].time[0]
+                    maxima_inds[:,1] = (maxima_inds[:,1] - window_start) * time_per_pixel + window_time[0]
                     
                     
             except Exception as e:
@@ -511,6 +514,7 @@ class module_class:
                     pp_integrate_selection_button,
                     pp_integrate_plate_button,
                     pp_integrate_library_button,
+                    pp_cancel_job_button,
                 ),
                 pn.Column(
                     pn.pane.Markdown("<b>Drift Corr.</b></br> "),
@@ -518,6 +522,7 @@ class module_class:
                     pp_drift_correct_plate_button,
                     pp_clear_drift_correct_selection_button,
                     pp_clear_drift_correct_plate_button,
+                    pp_drift_reference_selector,
                 )
             )
         )
@@ -530,7 +535,7 @@ class module_class:
             pn.pane.Markdown('<b>Fine Region Control</b>'),
             pn.Row(pp_rt_input, pp_rt_tolerance, pp_left_bound, pp_right_bound),
             pn.pane.Markdown('<b>CWT Analysis</b>'),
-            pn.Row(pp_cwt_min_scale_input, pp_cwt_max_scale_input, pp_cwt_neighborhood_input),
+            pn.Row(pp_cwt_min_scale_input, pp_cwt_max_scale_input, pp_cwt_neighborhood_input, pp_cwt_window_checkbox),
             pp_cwt_analysis_button,
             cwt_analysis_plot.opts(width=500, height=250)
         ), title='Advanced', sizing_mode='stretch_width', collapsed=True)
@@ -540,13 +545,14 @@ class module_class:
                 self.pp_plate_selector, 
                 self.pp_compound_selector,
                 pp_download_filename,
+                pp_download_format,
                 pp_download_csv_button,
             ), 
             pn.Row(
                 pp_param_control_box, 
                 pn.Column(
                     pn.pane.Markdown("<b>Use the \"Box Select\" tool on the right to click-drag an integration region</b>"),
-                    selection_view.plot.opts(width=500, height=250),
+                    selection_view.plot.opts(width=selection_view.overlay_width, height=250),
                     pn.pane.Markdown("<b>Click to show well chromatogram.  Double click to clear</b>"),
                     plate_view.plot.opts(width=500, height=325),
                     pp_advanced_options
@@ -618,23 +624,16 @@ class module_class:
                     else:
                         pp_peak_stcurve_area.value = "N/A"
                 else:
-                    n_wells = len(disp_well_list)
-                    rts = np.zeros(n_wells)
-                    areas = np.zeros(n_wells)
-                    heights = np.zeros(n_wells)
-                    snrs = np.zeros(n_wells)
-                    stcurve_areas = np.zeros(n_wells)
-                    all_stcurve = True
+                    #Read the selected rows straight out of the plate's result columns
+                    table = library[plate].get_table(compound)
+                    rows = [table.well_ids.index(well) for well in disp_well_list]
+                    rts = table.get_column('peak_rt')[rows]
+                    areas = table.get_column('peak_area')[rows]
+                    heights = table.get_column('peak_height')[rows]
+                    snrs = table.get_column('peak_snr')[rows]
+                    stcurve_areas = table.get_column('peak_stcurve_area')[rows]
+                    all_stcurve = not np.isnan(stcurve_areas).any()
                     pp_peak_source_display.value = ", ".join([library[plate][well][compound].source for well in disp_well_list])
-                    for i, well in enumerate(disp_well_list):
-                        rts[i] = library[plate][well][compound].peak_rt
-                        areas[i] = library[plate][well][compound].peak_area
-                        heights[i] = library[plate][well][compound].peak_height
-                        snrs[i] = library[plate][well][compound].peak_snr
-                        if library[plate][well][compound].peak_stcurve_area != None:
-                            stcurve_areas[i] = library[plate][well][compound].peak_stcurve_area
-                        else:
-                            all_stcurve = False
                     pp_peak_rt_display.value = out_format(np.average(rts), np.std(rts))
                     pp_peak_area_display.value = out_format(np.average(areas), np.std(areas))
                     pp_peak_height_display.value = out_format(np.average(heights), np.std(heights))
@@ -644,14 +643,28 @@ class module_class:
                     else:
                         pp_peak_stcurve_area.value = "N/A"
 
+        #Views are refreshed through the scheduler, so one user action only renders each of them once
+        refresh = RefreshScheduler({
+            'plate': plate_view.update_plate_plot,
+            'highlight': plate_view.highlight_plot.event,
+            'overlay': selection_view.update_overlay_plot,
+            'statistics': selection_view.integration_statistics_plot.event,
+            'selection': selection_change,
+        }, self.status_text, self.debug_text)
+        #Integration and drift correction run in the background, so the session stays usable (and cancellable) while they run
+        jobs = JobRunner(self.status_text, self.progress_bar, self.debug_text, pp_cancel_job_button)
+
         def pp_download_filename_watchdog(event):
-            if (event.new == "") or (event.new == None):
-                pp_download_csv_button.filename = 'library_integration_data.csv'
-            elif not event.new.endswith('.csv'):
-                pp_download_csv_button.filename = f"{event.new}.csv"
+            extension = f".{pp_download_format.value}"
+            filename = pp_download_filename.value
+            if (filename == "") or (filename == None):
+                pp_download_csv_button.filename = f"library_integration_data{extension}"
+            elif not filename.endswith(extension):
+                pp_download_csv_button.filename = f"{filename}{extension}"
             else:
-                pp_download_csv_button.filename = event.new
+                pp_download_csv_button.filename = filename
         pp_download_filename.param.watch(pp_download_filename_watchdog, ['value'], onlychanged=False)
+        pp_download_format.param.watch(pp_download_filename_watchdog, ['value'])
 
         def pp_plate_selector_watchdog(event):
             try:
@@ -662,6 +675,10 @@ class module_class:
                     else:
                         new_sele = compounds[0]
                     self.pp_compound_selector.param.update({'options': compounds, 'value': new_sele})
+                    #Drift correction can align to the median trace or to a chosen (e.g. parent) well
+                    reference_options = ['Median'] + sorted(library[event.new].wells, key=lambda x: parse_well_id(x)[::-1])
+                    reference = pp_drift_reference_selector.value if pp_drift_reference_selector.value in reference_options else 'Median'
+                    pp_drift_reference_selector.param.update({'options': reference_options, 'value': reference})
             except Exception as e:
                 self.status_text.value = "pp_plate_selector_watchdog: " + str(e)
                 self.debug_text.value += f"Plate: >{event.new}\t>{type(event.new)}"
@@ -680,10 +697,8 @@ class module_class:
                                 del plate_view.well_list[i]
                             elif event.new not in library[plate][plate_view.well_list[i]]:
                                 del plate_view.well_list[i]
-                        plate_view.highlight_plot.event()
-                    plate_view.plate_plot.event()
-                    selection_view.update_overlay_plot()
-                    selection_view.integration_statistics_plot.event()
+                        refresh.mark('highlight')
+                    refresh.mark('plate', 'overlay', 'statistics', 'selection')
             except Exception as e:
                 self.debug_text.value += f"Well: {event.new}\t{type(event.new)}"
                 self.status_text.value = "pp_compound_selector_watchdog: " + str(e)
@@ -692,72 +707,59 @@ class module_class:
 
         def pp_sigma_input_watchdog(event):
             try:
-                selection_view.update_overlay_plot()
+                #Wait for the user to stop editing before re-smoothing the overlay
+                refresh.mark('overlay', delay=300)
             except Exception as e:
                 self.status_text.value = "pp_sigma_input_watchdog: " + str(e)
                 self.debug_text.value += traceback.format_exc() + "\n\n"
         pp_sigma_input.param.watch(pp_sigma_input_watchdog, ['value'], onlychanged=False)
 
+        def get_processing_parameters(use_stcurve: bool) -> dict:
+            #Keyword arguments for Chromatogram.set_processing_parameters() from the current inputs
+            parameters = dict(
+                rt=pp_rt_input.value,
+                rt_tolerance=pp_rt_tolerance.value,
+                initial_left_bound=pp_left_bound.value,
+                initial_right_bound=pp_right_bound.value,
+                sigma=pp_sigma_input.value,
+                cwt_min_scale=pp_cwt_min_scale_input.value,
+                cwt_max_scale=pp_cwt_max_scale_input.value,
+                cwt_neighborhood=pp_cwt_neighborhood_input.value,
+                friction_threshold=pp_friction_input.value,
+                drop_baseline=pp_drop_baseline_checkbox.value,
+                cwt_window=pp_cwt_window_checkbox.value
+            )
+            if use_stcurve and (pp_stcurve_slope.value != 0) and (pp_stcurve_slope.value != None) and (pp_stcurve_intercept.value != None):
+                parameters['stcurve_slope'] = pp_stcurve_slope.value
+                parameters['stcurve_intercept'] = pp_stcurve_intercept.value
+            return parameters
+
+        def submit_integration(name: str, chromatograms: list, parameters: dict, use_pool: bool):
+            def work(job):
+                return compute_peak_results(chromatograms, parameters, use_pool=use_pool, progress_callback=job.set_progress)
+            def apply(results):
+                for chrom, values in zip(chromatograms, results):
+                    chrom.set_peak_results(values)
+                refresh.mark('plate', 'statistics', 'selection')
+                self.status_text.value = f"Done integrating {name}!"
+            jobs.submit(f"Integrating {name}", work, apply)
+
         def pp_integrate_selection_button_callback(event):
             try:
-                self.status_text.value = "Integrating selected wells..."
                 plate = self.pp_plate_selector.value
                 compound = self.pp_compound_selector.value
-                for i, well in enumerate(plate_view.well_list, 1):
-                    if compound in library[plate][well]:
-                        stcurve_slope = None
-                        stcurve_intercept = None
-                        if (pp_stcurve_slope.value != 0) and (pp_stcurve_slope.value != None) and (pp_stcurve_intercept.value != None):
-                            stcurve_slope = pp_stcurve_slope.value
-                            stcurve_intercept = pp_stcurve_intercept.value
-                        library[plate][well][compound].set_processing_parameters(
-                            pp_rt_input.value,
-                            pp_rt_tolerance.value,
-                            pp_left_bound.value,
-                            pp_right_bound.value,
-                            pp_sigma_input.value,
-                            pp_cwt_min_scale_input.value,
-                            pp_cwt_max_scale_input.value,
-                            pp_cwt_neighborhood_input.value,
-                            pp_friction_input.value,
-                            pp_drop_baseline_checkbox.value,
-                            stcurve_slope,
-                            stcurve_intercept
-                        )
-                        library[plate][well][compound].process_peak()
-                    self.progress_bar.value = int(np.round((100 * i) / len(library[plate])))
-                selection_view.integration_statistics_plot.event()
-                plate_view.plate_plot.event()
-                self.status_text.value = "Done integrating well!"
+                chromatograms = library[plate].get_chromatograms(compound, plate_view.well_list)
+                submit_integration("selected wells", chromatograms, get_processing_parameters(True), False)
             except Exception as e:
-                self.status_text.value = "pp_integrate_plate_button_callback: " + str(e)
+                self.status_text.value = "pp_integrate_selection_button_callback: " + str(e)
                 self.debug_text.value += traceback.format_exc() + "\n\n"
         pp_integrate_selection_button.on_click(pp_integrate_selection_button_callback)
 
         def pp_integrate_plate_button_callback(event):
             try:
-                self.status_text.value = "Integrating plate..."
                 plate = self.pp_plate_selector.value
                 compound = self.pp_compound_selector.value
-                for i, well in enumerate(library[plate], 1):
-                    if compound in library[plate][well]:
-                        library[plate][well][compound].set_processing_parameters(
-                            pp_rt_input.value,
-                            pp_rt_tolerance.value,
-                            pp_left_bound.value,
-                            pp_right_bound.value,
-                            pp_sigma_input.value,
-                            pp_cwt_min_scale_input.value,
-                            pp_cwt_max_scale_input.value,
-                            pp_cwt_neighborhood_input.value,
-                            pp_friction_input.value,
-                            pp_drop_baseline_checkbox.value
-                        )
-                        library[plate][well][compound].process_peak()
-                    self.progress_bar.value = int(np.round((100 * i) / len(library[plate])))
-                selection_view.integration_statistics_plot.event()
-                plate_view.plate_plot.event()
-                self.status_text.value = "Done integrating plate!"
+                submit_integration("plate", library[plate].get_chromatograms(compound), get_processing_parameters(False), True)
             except Exception as e:
                 self.status_text.value = "pp_integrate_plate_button_callback: " + str(e)
                 self.debug_text.value += traceback.format_exc() + "\n\n"
@@ -765,111 +767,78 @@ class module_class:
 
         def pp_integrate_library_button_callback(event):
             try:
-                self.status_text.value = "Integrating library..."
                 compound = self.pp_compound_selector.value
-                for i, plate in enumerate(library):
-                    for j, well in enumerate(library[plate], 1):
-                        if compound in library[plate][well]:
-                            library[plate][well][compound].set_processing_parameters(
-                                pp_rt_input.value,
-                                pp_rt_tolerance.value,
-                                pp_left_bound.value,
-                                pp_right_bound.value,
-                                pp_sigma_input.value,
-                                pp_cwt_min_scale_input.value,
-                                pp_cwt_max_scale_input.value,
-                                pp_cwt_neighborhood_input.value,
-                                pp_friction_input.value,
-                                pp_drop_baseline_checkbox.value
-                            )
-                            library[plate][well][compound].process_peak()
-                        self.progress_bar.value = int(np.round(100 * ((i/len(library)) + ((1/len(library)) * (j/len(library[plate]))))))
-                selection_view.integration_statistics_plot.event()
-                plate_view.plate_plot.event()
-                self.status_text.value = "Done integrating library!"
+                submit_integration("library", library.get_chromatograms(compound), get_processing_parameters(False), True)
             except Exception as e:
                 self.status_text.value = "pp_integrate_library_button_callback: " + str(e)
                 self.debug_text.value += traceback.format_exc() + "\n\n"
         pp_integrate_library_button.on_click(pp_integrate_library_button_callback)
 
-        def pp_drift_correct_selection_button_callback(event):
-            plate = self.pp_plate_selector.value
-            compound = self.pp_compound_selector.value
+        def submit_drift_correction(name: str, plate: str, compound: str, wells: list):
             sigma = pp_sigma_input.value
-            n_wells = len(plate_view.well_list)
-            if n_wells < 2:
-                self.status_text.value = "At least 2 wells must be selected for drift correction"
-            else:
-                self.status_text.value = "Determining average maxima position..."
-                self.progress_bar.value = 0
-                maxima_times = []
-                for i, well in enumerate(plate_view.well_list):
-                    if compound in library[plate][well]:
-                        time_start_ind = np.argmin(np.abs(pp_left_bound.value - library[plate][well][compound].time))
-                        time_end_ind = np.argmin(np.abs(pp_right_bound.value - library[plate][well][compound].time))
-                        maxima_times.append(library[plate][well][compound].time[
-                                time_start_ind + np.argmax(gaussian_filter1d(library[plate][well][compound].intensity, sigma)[time_start_ind:time_end_ind])
-                            ])
-                        self.progress_bar.value = int(np.round((100 * (i+1)) / (n_wells*2)))
-                self.status_text.value = "Applying drift correction..."
-                average_time = np.average(maxima_times)
-                n_wells = len(maxima_times)
-                for i, well in enumerate(plate_view.well_list):
-                    if compound in library[plate][well]:
-                        library[plate][well][compound].drift_offset = (average_time - maxima_times[i])
-                        self.progress_bar.value = int(np.round((100 * (i+1+n_wells)) / (n_wells*2)))
-                selection_view.update_overlay_plot()
-                selection_view.integration_statistics_plot.event()
-                self.status_text.value = "Done applying drift correction to selection!"
+            left_bound = pp_left_bound.value
+            right_bound = pp_right_bound.value
+            #Rows are looked up by well, so wells without the compound can't shift the others' offsets
+            table = library[plate].get_table(compound)
+            row_index = {well: i for i, well in enumerate(table.well_ids)}
+            rows = np.array([row_index[well] for well in wells if well in row_index], dtype=np.int64)
+            if rows.size < 2:
+                raise ValueError(f"At least 2 wells with {compound} are needed for drift correction")
+            reference = pp_drift_reference_selector.value
+            if (reference != 'Median') and (reference not in row_index):
+                raise ValueError(f"Reference well {reference} doesn't have {compound}")
+            reference_row = None if reference == 'Median' else row_index[reference]
+            def work(job):
+                job.set_progress(0, 1)
+                offsets = get_drift_offsets(table.time, table.intensity, table.lengths, rows, left_bound, right_bound, sigma, reference_row)
+                return [(table.chromatograms[row], float(offset)) for row, offset in zip(rows, offsets)]
+            def apply(offsets):
+                for chrom, drift_offset in offsets:
+                    chrom.set_drift_offset(drift_offset)
+                refresh.mark('overlay', 'statistics')
+                self.status_text.value = f"Done applying drift correction to {name}!"
+            jobs.submit(f"Drift correcting {name}", work, apply)
+
+        def pp_drift_correct_selection_button_callback(event):
+            try:
+                plate = self.pp_plate_selector.value
+                compound = self.pp_compound_selector.value
+                if len(plate_view.well_list) < 2:
+                    self.status_text.value = "At least 2 wells must be selected for drift correction"
+                else:
+                    submit_drift_correction("selection", plate, compound, list(plate_view.well_list))
+            except Exception as e:
+                self.status_text.value = "pp_drift_correct_selection_button_callback: " + str(e)
+                self.debug_text.value += traceback.format_exc() + "\n\n"
         pp_drift_correct_selection_button.on_click(pp_drift_correct_selection_button_callback)
 
         def pp_drift_correct_plate_button_callback(event):
-            plate = self.pp_plate_selector.value
-            compound = self.pp_compound_selector.value
-            sigma = pp_sigma_input.value
-            n_wells = len(library[plate])
-            if n_wells < 2:
-                self.status_text.value = "At least 2 wells must be present for drift correction"
-            else:
-                self.status_text.value = "Determining average maxima position..."
-                self.progress_bar.value = 0
-                maxima_times = []
-                for i, well in enumerate(library[plate]):
-                    if compound in library[plate][well]:
-                        time_start_ind = np.argmin(np.abs(pp_left_bound.value - library[plate][well][compound].time))
-                        time_end_ind = np.argmin(np.abs(pp_right_bound.value - library[plate][well][compound].time))
-                        maxima_times.append(library[plate][well][compound].time[
-                                time_start_ind + np.argmax(gaussian_filter1d(library[plate][well][compound].intensity, sigma)[time_start_ind:time_end_ind])
-                            ])
-                    self.progress_bar.value = int(np.round((100 * (i+1)) / (n_wells*2)))
-                self.status_text.value = "Applying drift correction..."
-                average_time = np.average(maxima_times)
-                n_wells = len(maxima_times)
-                for i, well in enumerate(library[plate]):
-                    if compound in library[plate][well]:
-                        library[plate][well][compound].drift_offset = (average_time - maxima_times[i])
-                        self.progress_bar.value = int(np.round((100 * (i+1+n_wells)) / (n_wells*2)))
-                selection_view.update_overlay_plot()
-                selection_view.integration_statistics_plot.event()
-                self.status_text.value = "Done applying drift correction to selection!"
+            try:
+                plate = self.pp_plate_selector.value
+                compound = self.pp_compound_selector.value
+                if len(library[plate]) < 2:
+                    self.status_text.value = "At least 2 wells must be present for drift correction"
+                else:
+                    submit_drift_correction("plate", plate, compound, list(library[plate]))
+            except Exception as e:
+                self.status_text.value = "pp_drift_correct_plate_button_callback: " + str(e)
+                self.debug_text.value += traceback.format_exc() + "\n\n"
         pp_drift_correct_plate_button.on_click(pp_drift_correct_plate_button_callback)
 
         def pp_clear_drift_correct_selection_button_callback(event):
             plate = self.pp_plate_selector.value
             compound = self.pp_compound_selector.value
             for well in plate_view.well_list:
-                library[plate][well][compound].drift_offset = 0
-            selection_view.update_overlay_plot()
-            selection_view.integration_statistics_plot.event()
+                library[plate][well][compound].set_drift_offset(0)
+            refresh.mark('overlay', 'statistics')
         pp_clear_drift_correct_selection_button.on_click(pp_clear_drift_correct_selection_button_callback)
 
         def pp_clear_drift_correct_plate_button_callback(event):
             plate = self.pp_plate_selector.value
             compound = self.pp_compound_selector.value
             for well in library[plate]:
-                library[plate][well][compound].drift_offset = 0
-            selection_view.update_overlay_plot()
-            selection_view.integration_statistics_plot.event()
+                library[plate][well][compound].set_drift_offset(0)
+            refresh.mark('overlay', 'statistics')
         pp_clear_drift_correct_plate_button.on_click(pp_clear_drift_correct_plate_button_callback)
 
         def pp_cwt_analysis_button_callback(event):
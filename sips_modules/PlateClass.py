@@ -1,33 +1,256 @@
 import numpy as np
 import param
 
+import os
+import mmap
+import weakref
+import threading
+from collections import OrderedDict
+
 from numba import jit, prange
 
 from scipy.ndimage import gaussian_filter1d
-from scipy.signal import cwt, ricker
+from scipy.fft import rfft, irfft, next_fast_len
 from scipy.integrate import simpson
 
-from typing import Tuple, Optional
+from functools import lru_cache
+from time import perf_counter
+
+from typing import Tuple, Optional, List, Callable, BinaryIO, Iterable
 
 def orient(p1, p2, p3):
     return (float(p2[1] - p1[1]) * (p3[0] - p2[0])) - (float(p2[0] - p1[0]) * (p3[1] - p2[1]))
 
-@jit(nopython=True, parallel=True)
-def faster_cwt_neighborhood(cwtarr, stride, maxima, minima, cwt_neighborhood=1):
-    n_rows = int(cwtarr.size / stride)
-    for i in prange(1, stride-cwt_neighborhood):
-        for j in prange(1, n_rows-cwt_neighborhood):
-            max_flag = True
-            min_flag = True
-            center = stride*j + i
-            for ni in prange(-cwt_neighborhood, cwt_neighborhood+1):
-                for nj in prange(-cwt_neighborhood, cwt_neighborhood+1):
-                    if cwtarr[center] < cwtarr[stride*(j+nj) + (i+ni)]:
-                        max_flag = False
-                    if cwtarr[center] > cwtarr[stride*(j+nj) + (i+ni)]:
-                        min_flag = False
-            minima[center] = min_flag
-            maxima[center] = max_flag
+@jit(nopython=True, nogil=True, cache=True)
+def running_extremes(src, half_width, max_out, min_out, prefix_max, suffix_max, prefix_min, suffix_min):
+    #Sliding window max/min over [i-half_width, i+half_width] (clipped at the edges) using the van Herk/Gil-Werman algorithm
+    #Work buffers must hold src.size + 2*half_width values, and cost is O(n) no matter how wide the window is
+    n = src.size
+    width = 2*half_width + 1
+    n_padded = n + 2*half_width
+    block_pos = 0
+    for p in range(n_padded):
+        if (p >= half_width) and (p < n + half_width):
+            v_max = src[p - half_width]
+            v_min = v_max
+        else:
+            v_max = -np.inf
+            v_min = np.inf
+        if block_pos == 0:
+            prefix_max[p] = v_max
+            prefix_min[p] = v_min
+        else:
+            prefix_max[p] = max(prefix_max[p-1], v_max)
+            prefix_min[p] = min(prefix_min[p-1], v_min)
+        block_pos += 1
+        if block_pos == width:
+            block_pos = 0
+    for p in range(n_padded-1, -1, -1):
+        if (p >= half_width) and (p < n + half_width):
+            v_max = src[p - half_width]
+            v_min = v_max
+        else:
+            v_max = -np.inf
+            v_min = np.inf
+        if (p == n_padded-1) or ((p + 1) % width == 0):
+            suffix_max[p] = v_max
+            suffix_min[p] = v_min
+        else:
+            suffix_max[p] = max(suffix_max[p+1], v_max)
+            suffix_min[p] = min(suffix_min[p+1], v_min)
+    for i in range(n):
+        max_out[i] = max(suffix_max[i], prefix_max[i + width - 1])
+        min_out[i] = min(suffix_min[i], prefix_min[i + width - 1])
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def cwt_extrema_filter(cwtmatrs, cwt_neighborhood=1):
+    #Finds CWT cells that are the maximum/minimum of their (2n+1)x(2n+1) neighborhood using separable running max/min filters
+    #Returns: minima coordinates, minima offsets, maxima coordinates, maxima offsets
+    #Coordinates are int32 [Scale, Time index] rows, with coordinates for matrix b in rows offsets[b]:offsets[b+1]
+    n_batch, n_scales, n_times = cwtmatrs.shape
+    n_lines = n_batch * n_scales
+    #Running extremes along time for each scale row
+    time_max = np.empty_like(cwtmatrs)
+    time_min = np.empty_like(cwtmatrs)
+    for b in prange(n_batch):
+        work = np.empty((4, n_times + 2*cwt_neighborhood), dtype=cwtmatrs.dtype)
+        for j in range(n_scales):
+            running_extremes(cwtmatrs[b, j, :], cwt_neighborhood, time_max[b, j, :], time_min[b, j, :], work[0], work[1], work[2], work[3])
+    #Running extremes of those along scale, worked in blocks of time columns to reuse buffers
+    block_size = 256
+    n_blocks = (n_times + block_size - 1) // block_size
+    window_max = np.empty_like(cwtmatrs)
+    window_min = np.empty_like(cwtmatrs)
+    for k in prange(n_batch * n_blocks):
+        b = k // n_blocks
+        work = np.empty((4, n_scales + 2*cwt_neighborhood), dtype=cwtmatrs.dtype)
+        column = np.empty((3, n_scales), dtype=cwtmatrs.dtype)
+        for i in range((k % n_blocks) * block_size, min(((k % n_blocks) + 1) * block_size, n_times)):
+            column[0] = time_max[b, :, i]
+            running_extremes(column[0], cwt_neighborhood, column[1], column[2], work[0], work[1], work[2], work[3])
+            window_max[b, :, i] = column[1]
+            column[0] = time_min[b, :, i]
+            running_extremes(column[0], cwt_neighborhood, column[1], column[2], work[0], work[1], work[2], work[3])
+            window_min[b, :, i] = column[2]
+    #Count extrema per line, then gather their coordinates, skipping the outer cells as the original search did
+    max_counts = np.zeros(n_lines + 1, dtype=np.int64)
+    min_counts = np.zeros(n_lines + 1, dtype=np.int64)
+    for k in prange(n_lines):
+        b = k // n_scales
+        j = k % n_scales
+        if (j >= 1) and (j < n_scales - cwt_neighborhood):
+            for i in range(1, n_times - cwt_neighborhood):
+                if cwtmatrs[b, j, i] == window_max[b, j, i]:
+                    max_counts[k+1] += 1
+                if cwtmatrs[b, j, i] == window_min[b, j, i]:
+                    min_counts[k+1] += 1
+    max_offsets = np.cumsum(max_counts)
+    min_offsets = np.cumsum(min_counts)
+    maxima = np.empty((max_offsets[-1], 2), dtype=np.int32)
+    minima = np.empty((min_offsets[-1], 2), dtype=np.int32)
+    for k in prange(n_lines):
+        b = k // n_scales
+        j = k % n_scales
+        max_pos = max_offsets[k]
+        min_pos = min_offsets[k]
+        if (j >= 1) and (j < n_scales - cwt_neighborhood):
+            for i in range(1, n_times - cwt_neighborhood):
+                if cwtmatrs[b, j, i] == window_max[b, j, i]:
+                    maxima[max_pos, 0] = j
+                    maxima[max_pos, 1] = i
+                    max_pos += 1
+                if cwtmatrs[b, j, i] == window_min[b, j, i]:
+                    minima[min_pos, 0] = j
+                    minima[min_pos, 1] = i
+                    min_pos += 1
+    return minima, min_offsets[::n_scales], maxima, max_offsets[::n_scales]
+
+def warmup_kernels() -> float:
+    """Function to compile all numba kernels for the dtypes used during processing, so the first integration isn't slow
+
+    Kernels are cached on disk (cache=True), so after the first server start this only loads the compiled code.
+
+    Returns:
+        float: Seconds taken to compile/load the kernels
+    """
+    start = perf_counter()
+    #float64 CWT matrix stacks and integer neighborhood, both contiguous and as the column slices of FFT output from batch_cwt()
+    cwtmatrs = np.zeros((1, 3, 16), dtype=np.float64)
+    cwt_extrema_filter(cwtmatrs, 1)
+    cwt_extrema_filter(cwtmatrs[..., :8], 1)
+    return perf_counter() - start
+
+def ricker_wavelet(points: int, a: float) -> np.ndarray:
+    """Function to generate a Ricker ("Mexican hat") wavelet, matching the deprecated scipy.signal.ricker
+
+    Args:
+        points (int): Number of points in the wavelet
+        a (float): Width parameter of the wavelet
+
+    Returns:
+        np.ndarray: Wavelet of length points
+    """
+    A = 2 / (np.sqrt(3 * a) * (np.pi**0.25))
+    wsq = a**2
+    vec = np.arange(0, points) - (points - 1.0) / 2
+    xsq = vec**2
+    mod = (1 - xsq / wsq)
+    gauss = np.exp(-xsq / (2 * wsq))
+    return A * mod * gauss
+
+@lru_cache(maxsize=32)
+def ricker_filter_bank(n_points: int, min_scale: int, max_scale: int, wavelet_points: int) -> Tuple[np.ndarray, int]:
+    """Function to build (and cache) the FFT of a Ricker wavelet filter bank for a signal length and scale range
+
+    Each wavelet is truncated to min(10*width, wavelet_points) points as in scipy.signal.cwt, and circularly shifted so
+    the first n_points of the inverse transform are the centered ("same" mode) convolution for every scale.
+
+    Args:
+        n_points (int): Length of the signals to be transformed
+        min_scale (int): Minimum wavelet width (inclusive)
+        max_scale (int): Maximum wavelet width (exclusive)
+        wavelet_points (int): Length of the full chromatogram, which sets the wavelet truncation
+
+    Returns: bank, n_fft
+        bank: Read-only complex array of filter spectra with shape [Scale, Frequency]
+        n_fft: FFT length the bank was built for
+    """
+    widths = np.arange(min_scale, max_scale)
+    n_fft = next_fast_len(n_points + min(10 * int(widths[-1]), wavelet_points) - 1, real=True)
+    padded = np.zeros((widths.size, n_fft), dtype=np.float64)
+    for ind, width in enumerate(widths):
+        n_wavelet = min(10 * width, wavelet_points)
+        padded[ind, :n_wavelet] = ricker_wavelet(n_wavelet, width)[::-1]
+        padded[ind] = np.roll(padded[ind], -((n_wavelet - 1) // 2))
+    bank = rfft(padded, n_fft, axis=-1)
+    bank.flags.writeable = False
+    return bank, n_fft
+
+def batch_cwt(signals: np.ndarray, min_scale: int, max_scale: int, wavelet_points: Optional[int]=None) -> np.ndarray:
+    """Function to perform a Ricker wavelet CWT on a stack of signals using a cached FFT filter bank
+
+    Args:
+        signals (np.ndarray): 2D array of signals, one per row
+        min_scale (int): Minimum wavelet width (inclusive)
+        max_scale (int): Maximum wavelet width (exclusive)
+        wavelet_points (int, optional): Wavelet truncation length if signals are slices of longer chromatograms
+
+    Returns:
+        np.ndarray: 3D array of CWT matricies with shape [Signal, Scale, Time index]
+    """
+    n_points = signals.shape[-1]
+    if wavelet_points is None:
+        wavelet_points = n_points
+    bank, n_fft = ricker_filter_bank(n_points, min_scale, max_scale, wavelet_points)
+    spectra = rfft(signals.astype(np.float64), n_fft, axis=-1)
+    return irfft(spectra[:, np.newaxis, :] * bank, n_fft, axis=-1)[..., :n_points]
+
+def windowed_batch_cwt(signals: np.ndarray, min_scale: int, max_scale: int, window_start: int, window_end: int) -> np.ndarray:
+    """Function to perform a Ricker wavelet CWT on a stack of signals, only over a window of time indicies
+
+    The signals are padded by half the longest wavelet on each side of the window, so the returned columns
+    are identical to the same columns of the full transform from batch_cwt.
+
+    Args:
+        signals (np.ndarray): 2D array of signals, one per row
+        min_scale (int): Minimum wavelet width (inclusive)
+        max_scale (int): Maximum wavelet width (exclusive)
+        window_start (int): First time index of the window
+        window_end (int): Time index after the end of the window
+
+    Returns:
+        np.ndarray: 3D array of CWT matricies with shape [Signal, Scale, Time index - window_start]
+    """
+    n_points = signals.shape[-1]
+    pad = (min(10 * (max_scale - 1), n_points) // 2) + 1
+    start = max(window_start - pad, 0)
+    end = min(window_end + pad, n_points)
+    return batch_cwt(signals[:, start:end], min_scale, max_scale, n_points)[..., window_start-start:window_end-start]
+
+def cwt_extrema_indices(maxima: np.ndarray, minima: np.ndarray, cwt_offset: int=0, search_range: Optional[Tuple[int, int]]=None) -> Tuple[np.ndarray, np.ndarray]:
+    """Function to prepare CWT maxima/minima coordinates from cwt_extrema_filter for peak scoring
+
+    Args:
+        maxima (np.ndarray): int32 [Scale, Time index] coordinates of CWT maxima
+        minima (np.ndarray): int32 [Scale, Time index] coordinates of CWT minima
+        cwt_offset (int): Time index of the first CWT column, for windowed CWT matricies
+        search_range (Tuple[int, int], optional): Inclusive time index range to keep minima/maxima from
+
+    Returns: minima_inds, maxima_inds
+        minima_inds: Minima indicies as [Scale, Time index]
+        maxima_inds: Maxima indicies as [Scale, Time index], restricted to maxima flanked by minima
+    """
+    maxima_inds = maxima[::-1].copy() #[Scale, Time index]
+    minima_inds = minima.copy() #[Scale, Time index]
+    maxima_inds[:,1] += cwt_offset
+    minima_inds[:,1] += cwt_offset
+    if search_range is not None:
+        maxima_inds = maxima_inds[(maxima_inds[:,1] >= search_range[0]) & (maxima_inds[:,1] <= search_range[1])]
+        minima_inds = minima_inds[(minima_inds[:,1] >= search_range[0]) & (minima_inds[:,1] <= search_range[1])]
+    #Remove any maxima that do not have a minima flanking on one side
+    maxima_inds = maxima_inds[(np.min(minima_inds[:,1]) < maxima_inds[:,1]) &
+                                  (maxima_inds[:,1] < np.max(minima_inds[:,1]))]
+    return minima_inds, maxima_inds
 
 class ChromatogramMismatchError(Exception):
     pass
@@ -42,6 +265,13 @@ class SequencingDataError(Exception):
 class SequencingDisplayError(Exception):
     pass
 
+#Chromatogram parameters needed to rerun peak processing, and the parameters it produces
+PROCESSING_PARAMETER_NAMES = ('drift_offset', 'sigma', 'cwt_min_scale', 'cwt_max_scale', 'cwt_neighborhood', 'cwt_window', 'friction_threshold',
+    'rt', 'rt_tolerance', 'drop_baseline', 'stcurve_slope', 'stcurve_intercept', 'peak_bound_inds')
+PEAK_RESULT_NAMES = ('rt', 'peak_area', 'peak_rt', 'peak_bound_inds', 'peak_background', 'peak_height', 'peak_snr', 'peak_stcurve_area')
+#Chromatogram parameters kept as dense columns by ChromatogramTable, with NaN in place of None
+TABLE_COLUMN_NAMES = ('drift_offset', 'rt', 'peak_area', 'peak_rt', 'peak_background', 'peak_height', 'peak_snr', 'peak_stcurve_area')
+
 def save_str_bin(input: str) -> bytes:
     """Function to convert a string to binary
 
@@ -53,6 +283,17 @@ def save_str_bin(input: str) -> bytes:
     """
     return np.uint32(len(input)).tobytes() + bytes(input, 'utf-8')
 
+def write_str_bin(f: BinaryIO, input: str) -> None:
+    """Function to write a string to a binary stream
+
+    Args:
+        f (BinaryIO): Stream to write to
+        input (str): String to be written, stored with its number of bytes at the start
+    """
+    bstr = bytes(input, 'utf-8')
+    f.write(np.uint32(len(bstr)).tobytes())
+    f.write(bstr)
+
 def read_str_bin(bin_data: np.ndarray, offset: int) -> Tuple[str, int]:
     """Function to read a string from a binary file
 
@@ -85,6 +326,17 @@ def save_arr_bin(arr: np.ndarray, dtype: np.dtype) -> bytes:
         b = arr.astype(dtype)
     return np.uint32(b.size).tobytes() + b.tobytes()
 
+def write_arr_bin(f: BinaryIO, arr: np.ndarray, dtype: np.dtype) -> None:
+    """Function to write a list/array to a binary stream, without building an intermediate bytes copy
+    Args:
+        f: Stream to write to
+        arr: Array to be written, stored with its number of elements at the start
+        dtype: Format to store data as
+    """
+    b = np.ascontiguousarray(arr, dtype=dtype)
+    f.write(np.uint32(b.size).tobytes())
+    f.write(memoryview(b).cast('B'))
+
 def read_arr_bin(bin_data: np.ndarray, offset: int, dtype: np.dtype) -> Tuple[np.ndarray, int]:
     """Function to read an array from a binary file
     Args:
@@ -104,6 +356,106 @@ def read_arr_bin(bin_data: np.ndarray, offset: int, dtype: np.dtype) -> Tuple[np
     offset += np.dtype(dtype).itemsize * arr.size
     return arr, offset
 
+def skip_arr_bin(bin_data: np.ndarray, offset: int, dtype: np.dtype) -> int:
+    """Function to skip over an array in a binary file without reading it
+    Args:
+        bin_data: Binary data to read from
+        offset: Offset of the array
+        dtype: Format of stored data
+        
+    Returns:
+        int: Offset position after the array
+    """
+    n = int(np.frombuffer(bin_data, dtype=np.uint32, count=1, offset=offset)[0])
+    return offset + np.dtype(np.uint32).itemsize + np.dtype(dtype).itemsize * n
+
+class SmoothingCache:
+    """Memory-bounded LRU cache of Gaussian smoothed chromatogram intensities
+
+    Entries are keyed by the identity of the intensity array and sigma, so reassigning a chromatogram's
+    intensity invalidates its entries, and entries are dropped as soon as their intensity array is freed.
+    Drift correction only shifts the time axis, so one smoothed trace serves every drift offset.
+    Returned arrays are shared between callers and read-only.
+
+    Args:
+        max_bytes (int): Maximum total size of cached smoothed intensities
+    """
+    def __init__(self, max_bytes: int=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.entries = OrderedDict()
+        #Reentrant, since freeing an intensity array can run discard() from inside a locked section
+        self.lock = threading.RLock()
+
+    def lookup(self, intensity: np.ndarray, sigma: float) -> Optional[np.ndarray]:
+        with self.lock:
+            entry = self.entries.get((id(intensity), sigma))
+            if (entry is None) or (entry[0]() is not intensity):
+                return None
+            self.entries.move_to_end((id(intensity), sigma))
+            return entry[1]
+
+    def store(self, intensity: np.ndarray, sigma: float, smoothed: np.ndarray) -> np.ndarray:
+        key = (id(intensity), sigma)
+        smoothed.flags.writeable = False
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = (weakref.ref(intensity, lambda _, key=key: self.discard(key)), smoothed)
+            self.n_bytes += smoothed.nbytes
+            while (self.n_bytes > self.max_bytes) and (len(self.entries) > 1):
+                self.discard(next(iter(self.entries)))
+        return smoothed
+
+    def discard(self, key: Tuple[int, float]):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.n_bytes -= entry[1].nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+    def get(self, intensity: np.ndarray, sigma: float) -> np.ndarray:
+        """Function to get the Gaussian smoothed intensity, from the cache if possible
+
+        Args:
+            intensity (np.ndarray): Chromatogram intensity
+            sigma (float): Smoothing factor
+
+        Returns:
+            np.ndarray: Read-only smoothed intensity
+        """
+        sigma = float(sigma)
+        smoothed = self.lookup(intensity, sigma)
+        if smoothed is None:
+            smoothed = self.store(intensity, sigma, gaussian_filter1d(intensity, sigma))
+        return smoothed
+
+    def get_many(self, intensities: List[np.ndarray], sigma: float) -> np.ndarray:
+        """Function to get Gaussian smoothed intensities of equal length chromatograms as one stack, smoothing any
+        that aren't cached together in one call
+
+        Args:
+            intensities (List[np.ndarray]): Chromatogram intensities
+            sigma (float): Smoothing factor
+
+        Returns:
+            np.ndarray: Smoothed intensities, stacked in the same order
+        """
+        sigma = float(sigma)
+        smoothed = [self.lookup(intensity, sigma) for intensity in intensities]
+        missing = [i for i in range(len(intensities)) if smoothed[i] is None]
+        if len(missing) > 0:
+            smoothed_missing = gaussian_filter1d(np.vstack([intensities[i] for i in missing]), sigma, axis=1)
+            for i, row in zip(missing, smoothed_missing):
+                smoothed[i] = self.store(intensities[i], sigma, row.copy())
+        return np.vstack(smoothed)
+
+#Smoothed intensities shared by the plots and peak processing
+smoothing_cache = SmoothingCache()
+
 class Chromatogram(param.Parameterized):
     time = param.Array(doc="Array containing chromatogram timepoints")
     intensity = param.Array(doc="Array containing chromatogram intensity data")
@@ -115,6 +467,7 @@ class Chromatogram(param.Parameterized):
     cwt_min_scale = param.Integer(1, doc="CWT minimum scale")
     cwt_max_scale = param.Integer(60, doc="CWT maximum scale")
     cwt_neighborhood = param.Integer(1, doc="Maximum neighborhood square size for maxima/minima detection")
+    cwt_window = param.Boolean(True, doc="Restrict CWT analysis to the region around the peak bounds")
     friction_threshold = param.Number(0, doc="Friction value for relaxing initial peak boounds")
     rt = param.Number(0, doc="Specified target peak retention time")
     rt_tolerance = param.Number(0.2, doc="Specified target peak range")
@@ -136,6 +489,8 @@ class Chromatogram(param.Parameterized):
         self.intensity = intensity
         self.sample_name = sample_name
         self.source = source
+        #(ChromatogramTable, row) this chromatogram is packed into
+        self.table_row = None
 
     def get_tree(self, level=0):
         ret_str = f"{'    '*level}|--Sample Name: {self.sample_name}\n"
@@ -143,12 +498,42 @@ class Chromatogram(param.Parameterized):
         ret_str += f"{'    '*level}|--Time: Array({self.time.size})\n"
         ret_str += f"{'    '*level}|--Intensity: Array({self.intensity.size})\n"
         return ret_str
+
+    def get_processing_parameters(self) -> dict:
+        params = {name: getattr(self, name) for name in PROCESSING_PARAMETER_NAMES}
+        params['peak_bound_inds'] = list(self.peak_bound_inds)
+        return params
+
+    def get_peak_results(self) -> dict:
+        results = {name: getattr(self, name) for name in PEAK_RESULT_NAMES}
+        results['peak_bound_inds'] = list(self.peak_bound_inds)
+        return results
+
+    def set_peak_results(self, results: dict) -> None:
+        self.param.update(**results)
+        self.update_table(results)
+
+    def set_drift_offset(self, drift_offset: float) -> None:
+        self.drift_offset = drift_offset
+        self.update_table(['drift_offset'])
+
+    def update_table(self, names: Optional[Iterable[str]]=None) -> None:
+        """Function to write drift offset and peak results to the columns of the table this chromatogram is packed into
+
+        Parameters assigned directly aren't seen by the table until this is called.
+
+        Args:
+            names (Iterable[str], optional): Parameters which changed.  Defaults to all table columns.
+        """
+        if self.table_row is not None:
+            table, row = self.table_row
+            table.update_row(row, self, names)
     
     #Peak processing based on https://arxiv.org/pdf/2101.08841.pdf
     def set_processing_parameters(self, 
         rt: float, rt_tolerance: float, initial_left_bound: float, initial_right_bound: float, sigma: float, cwt_min_scale: int, cwt_max_scale: int, 
         cwt_neighborhood: int, friction_threshold: float, drop_baseline: bool,
-        stcurve_slope: Optional[float]=None, stcurve_intercept: Optional[float]=None
+        stcurve_slope: Optional[float]=None, stcurve_intercept: Optional[float]=None, cwt_window: bool=True
     ) -> None:
         self.rt = rt
         self.rt_tolerance = rt_tolerance
@@ -161,39 +546,43 @@ class Chromatogram(param.Parameterized):
         self.drop_baseline = drop_baseline
         self.stcurve_slope = stcurve_slope
         self.stcurve_intercept = stcurve_intercept
-
+        self.cwt_window = cwt_window
         
     def gaussian_smoothing(self) -> np.ndarray:
-        return gaussian_filter1d(self.intensity, self.sigma)
+        return smoothing_cache.get(self.intensity, self.sigma)
     
     def second_deriv(self, smoothed_chromatogram: np.ndarray) -> np.ndarray:
          return np.gradient(np.gradient(smoothed_chromatogram))
         
+    def get_peak_search_range(self) -> Tuple[int, int]:
+        #Minima are only ever searched for up to one peak span outside of the initial bounds
+        span = self.peak_bound_inds[1] - self.peak_bound_inds[0]
+        return max(self.peak_bound_inds[0] - span, 0), min(self.peak_bound_inds[1] + span, self.intensity.size - 1)
+
+    def get_cwt_window(self) -> Tuple[int, int]:
+        if not self.cwt_window:
+            return 0, self.intensity.size
+        left, right = self.get_peak_search_range()
+        #Pad so the minima/maxima neighborhood search is complete over the search range
+        pad = self.cwt_neighborhood + 1
+        return max(left - pad, 0), min(right + pad + 1, self.intensity.size)
+
     def cwt_generation(self, second_deriv: np.ndarray) -> np.ndarray:
-        #TODO: Eventually, we should limit this analysis to a range close to our peak bounds, but need more testing first before comitting to this and also need to work out display bugs
-        return cwt(-second_deriv, ricker, np.arange(self.cwt_min_scale, self.cwt_max_scale))
+        window_start, window_end = self.get_cwt_window()
+        return windowed_batch_cwt(-second_deriv[np.newaxis,:], self.cwt_min_scale, self.cwt_max_scale, window_start, window_end)[0]
     
     def cwt_analysis(self, cwtmatr: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
-        cwtarr = cwtmatr.flatten()
-        maxima = np.zeros(cwtarr.size, dtype=bool)
-        minima = np.zeros(cwtarr.size, dtype=bool)
-        faster_cwt_neighborhood(cwtarr, cwtmatr.shape[1], maxima, minima, self.cwt_neighborhood)
-        
-        maxima = maxima.reshape(cwtmatr.shape)
-        minima = minima.reshape(cwtmatr.shape)
-        maxima_inds = np.array(np.where(maxima)).T[::-1] #[Scale, Time index]
-        minima_inds = np.array(np.where(minima)).T#[Scale, Time index]
-        #Remove any maxima that do not have a minima flanking on one side
-        maxima_inds = maxima_inds[(np.min(minima_inds[:,1]) < maxima_inds[:,1]) &
-                                      (maxima_inds[:,1] < np.max(minima_inds[:,1]))]
-        return minima_inds, maxima_inds
-    
-    def score_stationary_points(self, cwtmatr: np.ndarray, indices: np.ndarray, target_time: float, target_tolerance: float) -> int:
-        fitness_values = cwtmatr[indices[:,0], indices[:,1]] * (
+        minima, _, maxima, _ = cwt_extrema_filter(cwtmatr[np.newaxis,:,:], self.cwt_neighborhood)
+        if self.cwt_window:
+            return cwt_extrema_indices(maxima, minima, self.get_cwt_window()[0], self.get_peak_search_range())
+        return cwt_extrema_indices(maxima, minima)
+    
+    def score_stationary_points(self, cwtmatr: np.ndarray, indices: np.ndarray, target_time: float, target_tolerance: float, cwt_offset: int=0) -> int:
+        fitness_values = cwtmatr[indices[:,0], indices[:,1] - cwt_offset] * (
             1 - (((self.time + self.drift_offset)[indices[:,1]] - target_time) / target_tolerance)**2)
         return indices[fitness_values.argmax(),1]
     
-    def get_initial_peak_bounds(self, cwtmatr: np.ndarray, minima_inds: np.ndarray, best_index: int) -> None:
+    def get_initial_peak_bounds(self, cwtmatr: np.ndarray, minima_inds: np.ndarray, best_index: int, cwt_offset: int=0) -> None:
         #Get peak span
         span = self.peak_bound_inds[1] - self.peak_bound_inds[0]
         #Mask of left and right minima/maxima
@@ -207,8 +596,8 @@ class Chromatogram(param.Parameterized):
         maxima_time = self.time[best_index]
 
         #Find best indicies for peak bounds by inverting CWT matrix intensity
-        left_best_index = self.score_stationary_points(-cwtmatr, left_minima, left_integ_region_time, maxima_time - left_integ_region_time)
-        right_best_index = self.score_stationary_points(-cwtmatr, right_minima, right_integ_region_time, right_integ_region_time - maxima_time)
+        left_best_index = self.score_stationary_points(-cwtmatr, left_minima, left_integ_region_time, maxima_time - left_integ_region_time, cwt_offset)
+        right_best_index = self.score_stationary_points(-cwtmatr, right_minima, right_integ_region_time, right_integ_region_time - maxima_time, cwt_offset)
         self.peak_bound_inds = [left_best_index, right_best_index]
 
     def friction_boundary_correction(self, smoothed_chromatogram: np.ndarray) -> None:
@@ -231,8 +620,8 @@ class Chromatogram(param.Parameterized):
                                 selected_chromatogram_arr[W[-1]], selected_chromatogram_arr[W[-2]]) <= 0):
                 W.pop()
             W.append(peak_points[j])
-        self.peak_bound_inds[0] = np.min(W)
-        self.peak_bound_inds[1] = np.max(W)
+        #Assigned as a new list, so parameter watchers see the change
+        self.peak_bound_inds = [np.min(W), np.max(W)]
     
     def get_peak_characteristics(self, smoothed_chromatogram: np.ndarray, maxima_inds: np.ndarray, peak_rt_index: int) -> None:
         selected_chromatogram_arr = np.vstack((self.time + self.drift_offset, self.intensity)).T
@@ -263,11 +652,14 @@ class Chromatogram(param.Parameterized):
         second_deriv = self.second_deriv(smoothed_chromatogram)
         cwtmatr = self.cwt_generation(second_deriv)
         minima_inds, maxima_inds = self.cwt_analysis(cwtmatr)
+        self.resolve_peak(smoothed_chromatogram, cwtmatr, minima_inds, maxima_inds, self.get_cwt_window()[0])
+
+    def resolve_peak(self, smoothed_chromatogram: np.ndarray, cwtmatr: np.ndarray, minima_inds: np.ndarray, maxima_inds: np.ndarray, cwt_offset: int=0) -> None:
         #Restrict maxima to defined integration region
         maxima_inds = maxima_inds[(maxima_inds[:,1] >= self.peak_bound_inds[0]) & (maxima_inds[:,1] <= self.peak_bound_inds[1]),:]
-        best_index = self.score_stationary_points(cwtmatr, maxima_inds, self.rt, self.rt_tolerance)
+        best_index = self.score_stationary_points(cwtmatr, maxima_inds, self.rt, self.rt_tolerance, cwt_offset)
         #Restrict minima to left and right of best maxima, and use same algorithm to find best minima
-        self.get_initial_peak_bounds(cwtmatr, minima_inds, best_index)
+        self.get_initial_peak_bounds(cwtmatr, minima_inds, best_index, cwt_offset)
         self.friction_boundary_correction(smoothed_chromatogram)
         self.partial_convex_hull_boundary_correction()
         self.rt = self.time[best_index] + self.drift_offset
@@ -276,19 +668,20 @@ class Chromatogram(param.Parameterized):
             self.peak_stcurve_area = (self.stcurve_slope * self.peak_area) + self.stcurve_intercept
         else:
             self.peak_stcurve_area = None
+        self.update_table()
         
-    def save_binary(self, bin_data: bytes) -> bytes:
-        bin_data += (
-            np.array([self.cwt_min_scale, self.cwt_max_scale, self.cwt_neighborhood, self.drop_baseline, 
-                self.peak_bound_inds[0], self.peak_bound_inds[1]], dtype=np.int32).tobytes() + 
-            np.array([self.sigma, self.friction_threshold, self.rt, self.rt_tolerance, 
-                self.peak_area, self.peak_rt, self.peak_background, self.peak_height, self.peak_snr], dtype=np.float32).tobytes() +
-            save_arr_bin(self.time, np.float32) + save_arr_bin(self.intensity, np.float32)
-        )
-        return bin_data
+    def save_binary(self, f: BinaryIO) -> None:
+        #Bounds are stored as -1 if the chromatogram hasn't been integrated yet
+        f.write(np.array([self.cwt_min_scale, self.cwt_max_scale, self.cwt_neighborhood, self.drop_baseline, 
+            -1 if self.peak_bound_inds[0] is None else self.peak_bound_inds[0], -1 if self.peak_bound_inds[1] is None else self.peak_bound_inds[1]], dtype=np.int32).tobytes())
+        f.write(np.array([self.sigma, self.friction_threshold, self.rt, self.rt_tolerance, 
+            self.peak_area, self.peak_rt, self.peak_background, self.peak_height, self.peak_snr], dtype=np.float32).tobytes())
+        write_arr_bin(f, self.time, np.float32)
+        write_arr_bin(f, self.intensity, np.float32)
     
     def load_binary(self, bin_data: bytes, offset: int) -> int:
         self.cwt_min_scale, self.cwt_max_scale, self.cwt_neighborhood, db, self.peak_bound_inds[0], self.peak_bound_inds[1] = [int(x) for x in np.frombuffer(bin_data, dtype=np.int32, count=6, offset=offset)]
+        self.peak_bound_inds = [None if x < 0 else x for x in self.peak_bound_inds]
         self.drop_baseline = bool(db)
         offset += 6 * np.dtype(np.int32).itemsize
         self.sigma, self.friction_threshold, self.rt, self.rt_tolerance, self.peak_area, self.peak_rt, self.peak_background, self.peak_height, self.peak_snr = np.frombuffer(bin_data, dtype=np.float32, count=9, offset=offset)
@@ -297,12 +690,120 @@ class Chromatogram(param.Parameterized):
         self.intensity, offset = read_arr_bin(bin_data, offset, np.float32)
         return offset
     
+    @staticmethod
+    def skip_binary(bin_data: bytes, offset: int) -> int:
+        offset += 6 * np.dtype(np.int32).itemsize + 9 * np.dtype(np.float32).itemsize
+        offset = skip_arr_bin(bin_data, offset, np.float32)
+        return skip_arr_bin(bin_data, offset, np.float32)
+    
     #def get_json(self):
     #    return json.loads(self.param.serialize_parameters([
     #        "time", "intensity", "sigma", "cwt_min_scale", "cwt_max_scale", "cwt_neighborhood", "friction_threshold", "rt", 
     #        "rt_tolerance", "drop_baseline", "peak_area", "peak_rt", "peak_bound_inds", "peak_background", "peak_height", "peak_snr"
     #    ]))
 
+def batch_process_peaks(chromatograms: List[Chromatogram], batch_size: int=16, progress_callback: Optional[Callable[[int, int], None]]=None,
+        use_cache: bool=True) -> None:
+    """Function to run the process_peak() workflow on many chromatograms at once
+
+    Chromatograms sharing a length, dtype, and smoothing/CWT parameters are stacked into 2D arrays, so
+    smoothing, second derivatives, CWT generation, and minima/maxima detection are run once per stack.
+    Peak results are then resolved and written back to each chromatogram, identically to process_peak().
+
+    Args:
+        chromatograms (List[Chromatogram]): Chromatograms to process, with processing parameters already set
+        batch_size (int): Maximum number of chromatograms stacked at once, which limits CWT memory usage
+        progress_callback (Callable[[int, int], None], optional): Called with (processed, total) after each stack
+        use_cache (bool): Get smoothed intensities from, and add them to, the shared smoothing cache
+    """
+    groups = {}
+    for chrom in chromatograms:
+        key = (chrom.intensity.size, chrom.intensity.dtype.str, chrom.sigma, chrom.cwt_min_scale, chrom.cwt_max_scale, chrom.cwt_neighborhood, chrom.cwt_window)
+        groups.setdefault(key, []).append(chrom)
+    n_done = 0
+    for (_, _, sigma, cwt_min_scale, cwt_max_scale, cwt_neighborhood, cwt_window), group in groups.items():
+        for start in range(0, len(group), batch_size):
+            batch = group[start:start+batch_size]
+            if use_cache:
+                smoothed_chromatograms = smoothing_cache.get_many([chrom.intensity for chrom in batch], sigma)
+            else:
+                smoothed_chromatograms = gaussian_filter1d(np.vstack([chrom.intensity for chrom in batch]), sigma, axis=1)
+            second_derivs = np.gradient(np.gradient(smoothed_chromatograms, axis=1), axis=1)
+            #Windowed chromatograms share one CWT window covering all of their individual windows
+            windows = np.array([chrom.get_cwt_window() for chrom in batch])
+            window_start = int(windows[:,0].min())
+            cwtmatrs = windowed_batch_cwt(-second_derivs, cwt_min_scale, cwt_max_scale, window_start, int(windows[:,1].max()))
+            minima, minima_offsets, maxima, maxima_offsets = cwt_extrema_filter(cwtmatrs, cwt_neighborhood)
+            for i, chrom in enumerate(batch):
+                search_range = chrom.get_peak_search_range() if cwt_window else None
+                minima_inds, maxima_inds = cwt_extrema_indices(maxima[maxima_offsets[i]:maxima_offsets[i+1]], minima[minima_offsets[i]:minima_offsets[i+1]], window_start, search_range)
+                chrom.resolve_peak(smoothed_chromatograms[i], cwtmatrs[i], minima_inds, maxima_inds, window_start)
+            n_done += len(batch)
+            if progress_callback is not None:
+                progress_callback(n_done, len(chromatograms))
+
+class LazyChromatogramDict(dict):
+    """Dictionary of chromatograms which are only built from their archive data when first accessed
+
+    Keys of chromatograms that haven't been accessed yet map to their offset in the archive buffer.
+    Once built, time and intensity are views into the buffer, so a memory-mapped archive is only paged
+    in for chromatograms that are actually used.
+
+    Args:
+        bin_data (bytes): Archive buffer
+        loader (Callable[[bytes, object], Chromatogram], optional): Builds a chromatogram from the buffer and its
+            stored offset.  Defaults to reading the legacy .bin layout with Chromatogram.load_binary().
+    """
+    def __init__(self, bin_data: bytes, loader: Optional[Callable[[bytes, object], Chromatogram]]=None):
+        super().__init__()
+        self.bin_data = bin_data
+        self.loader = loader
+        self.offsets = {}
+        #Called with each chromatogram as it's built, e.g. so autosave can watch it from the start
+        self.on_load: Optional[Callable[[Chromatogram], None]] = None
+    
+    def add_offset(self, key: str, offset):
+        super().__setitem__(key, None)
+        self.offsets[key] = offset
+    
+    def __getitem__(self, key: str) -> Chromatogram:
+        chrom = super().__getitem__(key)
+        if chrom is None:
+            if self.loader is None:
+                chrom = Chromatogram()
+                chrom.load_binary(self.bin_data, self.offsets[key])
+            else:
+                chrom = self.loader(self.bin_data, self.offsets[key])
+            del self.offsets[key]
+            super().__setitem__(key, chrom)
+            if self.on_load is not None:
+                self.on_load(chrom)
+        return chrom
+    def __setitem__(self, key: str, value: Chromatogram):
+        self.offsets.pop(key, None)
+        super().__setitem__(key, value)
+    def __delitem__(self, key: str):
+        self.offsets.pop(key, None)
+        super().__delitem__(key)
+    def __reduce__(self):
+        #Pickle as a regular dictionary, since the archive buffer can't be pickled
+        return (dict, (dict(self.items()),))
+    
+    def get(self, key: str, default=None):
+        return self[key] if key in self else default
+    def pop(self, key: str, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        chrom = self[key]
+        del self[key]
+        return chrom
+    def values(self):
+        return [self[key] for key in self]
+    def items(self):
+        return [(key, self[key]) for key in self]
+    def copy(self):
+        return dict(self.items())
+
 class Sequencing(param.Parameterized):
     forward_alignment = param.Array(np.array([]), doc="Forward read alignment")
     forward_abi_traces = param.Array(np.array([]), doc="Forward read abi signal data in A,T,C,G order")
@@ -328,14 +829,11 @@ class Sequencing(param.Parameterized):
         else:
             raise ValueError(f"Direction {direction} not 'For' or 'Rev'")
 
-    def save_binary(self, bin_data: bytes) -> bytes:
-        bin_data += (
-            save_arr_bin(self.forward_alignment, np.uint8) + 
-            save_arr_bin(self.forward_abi_traces, np.int16) + 
-            save_arr_bin(self.reverse_alignment, np.uint8) + 
-            save_arr_bin(self.reverse_abi_traces, np.int16)
-        )
-        return bin_data
+    def save_binary(self, f: BinaryIO) -> None:
+        write_arr_bin(f, self.forward_alignment, np.uint8)
+        write_arr_bin(f, self.forward_abi_traces, np.int16)
+        write_arr_bin(f, self.reverse_alignment, np.uint8)
+        write_arr_bin(f, self.reverse_abi_traces, np.int16)
     
     def load_binary(self, bin_data: bytes, offset: int) -> int:
         self.forward_alignment, offset = read_arr_bin(bin_data, offset, np.uint8)
@@ -397,37 +895,39 @@ class Well(param.Parameterized):
     def add_sequencing(self):
         self.sequencing = Sequencing()
 
-    def save_binary(self, bin_data: bytes) -> bytes:
-        chrom_names = list(self.chromatograms)
-        n_chroms = len(chrom_names)
-        bin_data += np.uint32(n_chroms).tobytes()
-        for i in range(n_chroms):
-            bkey = bytes(chrom_names[i], 'utf-8')
-            bin_data += np.uint32(len(bkey)).tobytes()
-            bin_data += bkey
-            bin_data = self.chromatograms[chrom_names[i]].save_binary(bin_data)
+    def save_binary(self, f: BinaryIO) -> None:
+        f.write(np.uint32(len(self.chromatograms)).tobytes())
+        for compound in self.chromatograms:
+            write_str_bin(f, compound)
+            self.chromatograms[compound].save_binary(f)
         if self.sequencing:
-            bin_data += np.uint8(1).tobytes()
-            bin_data = self.sequencing.save_binary(bin_data)
+            f.write(np.uint8(1).tobytes())
+            self.sequencing.save_binary(f)
         else:
-            bin_data += np.uint8(0).tobytes()
-        return bin_data
+            f.write(np.uint8(0).tobytes())
     
-    def load_binary(self, bin_data: bytes, offset: int) -> int:
+    def load_binary(self, bin_data: bytes, offset: int, lazy: bool=False) -> int:
         n_chroms = np.frombuffer(bin_data, dtype=np.uint32, count=1, offset=offset)[0]
         offset += np.dtype(np.uint32).itemsize
+        if lazy:
+            self.chromatograms = LazyChromatogramDict(bin_data)
         for i in range(n_chroms):
             nsize = np.frombuffer(bin_data, dtype=np.uint32, count=1, offset=offset)[0]
             offset += np.dtype(np.uint32).itemsize
             key = bin_data[offset:offset+nsize].decode('utf-8')
             offset += nsize
-            self.chromatograms[key] = Chromatogram()
-            offset = self.chromatograms[key].load_binary(bin_data, offset)
+            if lazy:
+                #Only index where the chromatogram is, it gets built on first access
+                self.chromatograms.add_offset(key, offset)
+                offset = Chromatogram.skip_binary(bin_data, offset)
+            else:
+                self.chromatograms[key] = Chromatogram()
+                offset = self.chromatograms[key].load_binary(bin_data, offset)
         has_sequencing = bool(np.frombuffer(bin_data, dtype=np.uint8, count=1, offset=offset)[0])
         offset += np.dtype(np.uint8).itemsize
         if has_sequencing:
             self.sequencing = Sequencing()
-            offset = self.sequence.load_binary(bin_data, offset)
+            offset = self.sequencing.load_binary(bin_data, offset)
         return offset
     
     #def get_json(self):
@@ -439,11 +939,95 @@ class Well(param.Parameterized):
     #        json_params['chromatograms'][chrom] = self.chromatograms[chrom].get_json()
     #    return json_params
 
+class ChromatogramTable:
+    """Columnar storage for one compound's chromatograms across a plate
+
+    Intensities are packed into one contiguous (well, timepoint) matrix, and the time axis is stored once if
+    every chromatogram shares it.  Each chromatogram's time and intensity become views into this storage, so
+    the chromatograms stay usable as before without holding their own arrays.  Drift offsets and peak results
+    are kept in dense columns, so plate-wide heatmaps, statistics, and exports can read whole columns instead
+    of walking every well.  Chromatograms write to their row through Chromatogram.update_table() when results
+    are set, rather than the table watching each of them.
+
+    Chromatograms of different lengths are zero-padded to the longest one, with their lengths in lengths.
+    Reassigning a chromatogram's time or intensity makes the table out of date, and Plate.get_table() repacks it.
+
+    Args:
+        well_ids (List[str]): Wells of the chromatograms, in row order
+        chromatograms (List[Chromatogram]): Chromatograms to be packed
+    """
+    def __init__(self, well_ids: List[str], chromatograms: List[Chromatogram]):
+        self.well_ids = list(well_ids)
+        self.chromatograms = list(chromatograms)
+        self.valid = True
+        n_chroms = len(self.chromatograms)
+
+        self.lengths = np.array([chrom.intensity.size for chrom in self.chromatograms], dtype=np.int64)
+        n_points = int(self.lengths.max()) if n_chroms > 0 else 0
+        dtype = np.result_type(*[chrom.intensity.dtype for chrom in self.chromatograms]) if n_chroms > 0 else np.float32
+        self.intensity = np.zeros((n_chroms, n_points), dtype=dtype)
+        for i, chrom in enumerate(self.chromatograms):
+            self.intensity[i,:self.lengths[i]] = chrom.intensity
+        #Share the time axis if the sampling matches, otherwise pack it the same way as intensity
+        self.shared_time = (n_chroms > 0) and all(np.array_equal(chrom.time, self.chromatograms[0].time) for chrom in self.chromatograms)
+        if self.shared_time:
+            self.time = np.array(self.chromatograms[0].time)
+        else:
+            dtype = np.result_type(*[chrom.time.dtype for chrom in self.chromatograms]) if n_chroms > 0 else np.float32
+            self.time = np.zeros((n_chroms, n_points), dtype=dtype)
+            for i, chrom in enumerate(self.chromatograms):
+                self.time[i,:chrom.time.size] = chrom.time
+
+        self.columns = {key: np.full(n_chroms, np.nan) for key in TABLE_COLUMN_NAMES}
+        self.columns['peak_bound_inds'] = np.full((n_chroms, 2), -1, dtype=np.int64)
+        for i, chrom in enumerate(self.chromatograms):
+            chrom.param.update(time=self.get_time(i), intensity=self.intensity[i,:self.lengths[i]])
+            chrom.table_row = (self, i)
+            self.update_row(i, chrom)
+        #The arrays handed out, to tell when a chromatogram's data is reassigned
+        self.row_arrays = [(chrom.time, chrom.intensity) for chrom in self.chromatograms]
+    
+    def __len__(self):
+        return len(self.chromatograms)
+
+    def get_time(self, row: int) -> np.ndarray:
+        if self.shared_time:
+            return self.time
+        return self.time[row,:self.lengths[row]]
+
+    def update_row(self, row: int, chrom: Chromatogram, names: Optional[Iterable[str]]=None):
+        """Function to copy a chromatogram's drift offset and peak results into its row of the columns"""
+        for key in (self.columns if names is None else names):
+            if key not in self.columns:
+                continue
+            value = getattr(chrom, key)
+            if key == 'peak_bound_inds':
+                self.columns[key][row] = [-1 if x is None else x for x in value]
+            else:
+                self.columns[key][row] = np.nan if value is None else value
+
+    def is_packed(self, row: int, chrom: Chromatogram) -> bool:
+        """Returns whether a row still holds this chromatogram, with the arrays it was packed with"""
+        time, intensity = self.row_arrays[row]
+        return self.valid and (self.chromatograms[row] is chrom) and (chrom.time is time) and (chrom.intensity is intensity)
+
+    def release(self):
+        """Detaches the chromatograms from the table, and they keep their current arrays"""
+        for chrom in self.chromatograms:
+            if (chrom.table_row is not None) and (chrom.table_row[0] is self):
+                chrom.table_row = None
+        self.valid = False
+
+    def get_column(self, key: str) -> np.ndarray:
+        """Returns a dense column of drift offsets or peak results, with NaN (or -1 for peak bounds) where unset"""
+        return self.columns[key]
+
 class Plate(param.Parameterized):
     wells = param.Dict({}, doc="Stored wells")
     compounds = param.List([], doc="All compounds found during data entry")
     
     parent_alignment = param.Array(np.array([]), doc="Alignment for all wells of the parent DNA sequence")
+    tables = param.Dict({}, doc="Columnar chromatogram storage for each compound")
     
     def __init__(self, **params):
         super().__init__(**params)
@@ -477,20 +1061,47 @@ class Plate(param.Parameterized):
         else:
             raise ValueError(f"Well {well_id} not found in plate")
 
-    def save_binary(self, bin_data: bytes) -> bytes:
-        bin_data += save_arr_bin(self.parent_alignment, np.uint8)
+    def get_chromatograms(self, compound: str, well_ids: Optional[List[str]]=None) -> List[Chromatogram]:
+        if well_ids is None:
+            well_ids = list(self.wells)
+        return [self.wells[well][compound] for well in well_ids if compound in self.wells[well]]
+
+    def process_peaks(self, compound: str, well_ids: Optional[List[str]]=None, progress_callback: Optional[Callable[[int, int], None]]=None) -> None:
+        batch_process_peaks(self.get_chromatograms(compound, well_ids), progress_callback=progress_callback)
+
+    def get_table(self, compound: str) -> ChromatogramTable:
+        """Function to get the columnar storage for a compound, packing it if it is missing or out of date
+
+        Args:
+            compound (str): Compound to get the chromatograms of
+
+        Returns:
+            ChromatogramTable: Columnar storage of the compound's chromatograms, in well order
+        """
+        well_ids = [well for well in self.wells if compound in self.wells[well]]
+        table = self.tables.get(compound)
+        if (table is None) or (table.well_ids != well_ids) or \
+                not all(table.is_packed(row, self.wells[well][compound]) for row, well in enumerate(well_ids)):
+            if table is not None:
+                table.release()
+            table = ChromatogramTable(well_ids, [self.wells[well][compound] for well in well_ids])
+            self.tables[compound] = table
+        return table
+
+    def pack(self):
+        """Function to pack all of the plate's chromatograms into columnar storage"""
+        for compound in set(compound for well in self.wells for compound in self.wells[well]):
+            self.get_table(compound)
+
+    def save_binary(self, f: BinaryIO) -> None:
+        write_arr_bin(f, self.parent_alignment, np.uint8)
         
-        well_names = list(self.wells)
-        n_wells = len(well_names)
-        bin_data += np.uint32(n_wells).tobytes()
-        for i in range(n_wells):
-            bkey = bytes(well_names[i], 'utf-8')
-            bin_data += np.uint32(len(bkey)).tobytes()
-            bin_data += bkey
-            bin_data = self.wells[well_names[i]].save_binary(bin_data)
-        return bin_data
+        f.write(np.uint32(len(self.wells)).tobytes())
+        for well in self.wells:
+            write_str_bin(f, well)
+            self.wells[well].save_binary(f)
     
-    def load_binary(self, bin_data: bytes, offset: int) -> int:
+    def load_binary(self, bin_data: bytes, offset: int, lazy: bool=False) -> int:
         self.parent_alignment, offset = read_arr_bin(bin_data, offset, dtype=np.uint8)
         
         n_wells = np.frombuffer(bin_data, dtype=np.uint32, count=1, offset=offset)[0]
@@ -501,7 +1112,7 @@ class Plate(param.Parameterized):
             key = bin_data[offset:offset+nsize].decode('utf-8')
             offset += nsize
             self.wells[key] = Well()
-            offset = self.wells[key].load_binary(bin_data, offset)
+            offset = self.wells[key].load_binary(bin_data, offset, lazy)
         return offset
     
     #def get_json(self):
@@ -547,24 +1158,39 @@ class Library(param.Parameterized):
         else:
             raise ValueError(f"Plate {plate_name} not found in plates")
 
+    def get_chromatograms(self, compound: str) -> List[Chromatogram]:
+        return [chrom for plate in self.plates for chrom in self.plates[plate].get_chromatograms(compound)]
+
+    def process_peaks(self, compound: str, progress_callback: Optional[Callable[[int, int], None]]=None) -> None:
+        batch_process_peaks(self.get_chromatograms(compound), progress_callback=progress_callback)
+
     def save_binary(self, file_path: str):
-        bin_data = b''
-        plate_names = list(self.plates)
-        n_plates = len(plate_names)
-        bin_data += np.uint32(n_plates).tobytes()
-        for i in range(n_plates):
-            bkey = bytes(plate_names[i], 'utf-8')
-            bin_data += np.uint32(len(bkey)).tobytes()
-            bin_data += bkey
-            bin_data = self.plates[plate_names[i]].save_binary(bin_data)
-        with open(file_path, 'wb') as f:
-            f.write(bin_data)
-    
-    def load_binary(self, file_path: str):
+        #Stream straight to the file, so the archive is never held in memory.
+        #Written to a temporary file first, since a lazily loaded library may still be reading from file_path.
+        temp_path = file_path + ".tmp"
+        with open(temp_path, 'wb', buffering=1 << 20) as f:
+            f.write(np.uint32(len(self.plates)).tobytes())
+            for plate in self.plates:
+                write_str_bin(f, plate)
+                self.plates[plate].save_binary(f)
+        os.replace(temp_path, file_path)
+    
+    def load_binary(self, file_path: str, lazy: bool=False):
+        """Function to load plates from a .bin archive
+
+        Args:
+            file_path (str): Path to the archive
+            lazy (bool): Memory-map the archive and only build chromatograms when they are first accessed.
+                Chromatogram data is then a copy-on-write view of the file, and only read from disk when used.
+        """
         bin_data = None
         offset = 0
         with open(file_path, 'rb') as f:
-            bin_data = f.read()
+            if lazy:
+                #The map stays open after the file is closed, for as long as any views reference it
+                bin_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            else:
+                bin_data = f.read()
         n_plates = np.frombuffer(bin_data, dtype=np.uint32, count=1, offset=offset)[0]
         offset += np.dtype(np.uint32).itemsize
         for i in range(n_plates):
@@ -573,7 +1199,7 @@ class Library(param.Parameterized):
             key = bin_data[offset:offset+nsize].decode('utf-8')
             offset += nsize
             self.plates[key] = Plate()
-            offset = self.plates[key].load_binary(bin_data, offset)
+            offset = self.plates[key].load_binary(bin_data, offset, lazy)
     
     #def get_json(self):
     #    json_params = json.loads('{}')
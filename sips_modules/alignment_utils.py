@@ -0,0 +1,115 @@
+import numpy as np
+
+from scipy.ndimage import gaussian_filter1d
+
+from typing import Optional
+
+def resample_traces(time: np.ndarray, intensity: np.ndarray, lengths: np.ndarray, rows: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    """Function to linearly interpolate chromatograms onto a common time grid
+
+    Args:
+        time (np.ndarray): Time axis shared by all rows, or a 2D array with one time axis per row
+        intensity (np.ndarray): 2D array of intensities, one chromatogram per row
+        lengths (np.ndarray): Number of valid points in each row
+        rows (np.ndarray): Rows to be resampled
+        grid (np.ndarray): Sorted times to interpolate at
+
+    Returns:
+        np.ndarray: (rows, grid points) array of resampled intensities
+    """
+    if time.ndim == 1:
+        #One set of interpolation weights serves every row
+        inds = np.clip(np.searchsorted(time, grid) - 1, 0, time.size - 2)
+        weights = np.clip((grid - time[inds]) / (time[inds+1] - time[inds]), 0, 1)
+        data = intensity[rows]
+        return (data[:,inds] * (1 - weights)) + (data[:,inds+1] * weights)
+    return np.vstack([np.interp(grid, time[row,:lengths[row]], intensity[row,:lengths[row]]) for row in rows])
+
+def get_correlation_shifts(traces: np.ndarray, reference: np.ndarray, max_shift: int) -> np.ndarray:
+    """Function to find the shift of each trace which best matches a reference, by FFT cross-correlation
+
+    All traces are correlated at once.  The best integer lag is refined to a fraction of a sample by fitting a
+    parabola through the correlation at it and its two neighbors.
+
+    Args:
+        traces (np.ndarray): 2D array of evenly sampled traces, one per row
+        reference (np.ndarray): Reference trace, with the same sampling
+        max_shift (int): Largest shift considered, in samples
+
+    Returns:
+        np.ndarray: Shift of each trace in samples, positive where the trace is later than the reference
+    """
+    n_points = traces.shape[1]
+    #Zero-padded, so the correlation isn't circular within the window
+    n_fft = 1 << int(np.ceil(np.log2(2 * n_points)))
+    correlation = np.fft.irfft(np.fft.rfft(traces, n_fft, axis=1) * np.conj(np.fft.rfft(reference, n_fft)), n_fft, axis=1)
+    max_shift = min(max_shift, n_points - 1)
+    #Lags -max_shift - 1 to max_shift + 1, so the refinement always has neighbors
+    lags = np.arange(-max_shift - 1, max_shift + 2)
+    correlation = correlation[:,lags % n_fft]
+    best = 1 + np.argmax(correlation[:,1:-1], axis=1)
+    rows = np.arange(traces.shape[0])
+    before, peak, after = correlation[rows,best-1], correlation[rows,best], correlation[rows,best+1]
+    curvature = before - (2 * peak) + after
+    refinement = np.divide(0.5 * (before - after), curvature, out=np.zeros_like(peak), where=curvature < 0)
+    return lags[best] + np.clip(refinement, -0.5, 0.5)
+
+def shift_traces(traces: np.ndarray, shifts: np.ndarray) -> np.ndarray:
+    """Function to shift each trace earlier by a (fractional) number of samples, through its Fourier transform"""
+    n_points = traces.shape[1]
+    n_fft = 1 << int(np.ceil(np.log2(2 * n_points)))
+    phase = np.exp(2j * np.pi * np.outer(shifts, np.fft.rfftfreq(n_fft)))
+    return np.fft.irfft(np.fft.rfft(traces, n_fft, axis=1) * phase, n_fft, axis=1)[:,:n_points]
+
+def get_drift_offsets(time: np.ndarray, intensity: np.ndarray, lengths: np.ndarray, rows: np.ndarray, left_bound: float, right_bound: float,
+    sigma: float, reference_row: Optional[int]=None, n_iterations: int=2) -> np.ndarray:
+    """Function to get drift offsets which align chromatograms within a time window, all at once
+
+    Traces are resampled onto an even grid over the window, smoothed, and baseline subtracted, then aligned
+    to the reference by cross-correlation.  With the median reference, traces are first lined up by their apexes,
+    the median is rebuilt from the aligned traces on each iteration, and the offsets are centered so the typical
+    chromatogram isn't moved.
+
+    Args:
+        time (np.ndarray): Time axis shared by all rows, or a 2D array with one time axis per row
+        intensity (np.ndarray): 2D array of intensities, one chromatogram per row
+        lengths (np.ndarray): Number of valid points in each row
+        rows (np.ndarray): Rows to be aligned
+        left_bound (float): Start of the window
+        right_bound (float): End of the window
+        sigma (float): Gaussian smoothing factor, in samples
+        reference_row (int, optional): Row to align to, which gets an offset of 0.  Defaults to the median of the traces.
+        n_iterations (int): Number of times the median reference is rebuilt and realigned to
+
+    Returns:
+        np.ndarray: drift_offset of each row, which is added to its time axis
+    """
+    rows = np.asarray(rows)
+    if time.ndim == 1:
+        window_times = [time[(time >= left_bound) & (time <= right_bound)]]
+    else:
+        window_times = [t[(t >= left_bound) & (t <= right_bound)] for t in (time[row,:lengths[row]] for row in rows)]
+    if min(t.size for t in window_times) < 3:
+        raise ValueError("Drift correction window must contain at least 3 timepoints")
+    step = np.median(np.concatenate([np.diff(t) for t in window_times]))
+    grid = np.arange(left_bound, right_bound, step)
+
+    all_rows = rows if reference_row is None else np.append(rows, reference_row)
+    traces = gaussian_filter1d(resample_traces(time, intensity, lengths, all_rows, grid), sigma, axis=1)
+    traces -= traces.min(axis=1, keepdims=True)
+    traces -= traces.mean(axis=1, keepdims=True)
+    #Peaks can move by up to half the window
+    max_shift = grid.size // 2
+
+    if reference_row is not None:
+        shifts = get_correlation_shifts(traces[:-1], traces[-1], max_shift)
+    else:
+        #Start from each trace's apex relative to the median apex, since a median of traces which are drifted by
+        #more than a peak width is nearly flat and gives no alignment to correlate against
+        apexes = np.argmax(traces, axis=1).astype(np.float64)
+        shifts = apexes - np.median(apexes)
+        for _ in range(max(n_iterations, 1)):
+            reference = np.median(shift_traces(traces, shifts), axis=0)
+            shifts = get_correlation_shifts(traces, reference, max_shift)
+        shifts -= np.median(shifts)
+    return -shifts * step
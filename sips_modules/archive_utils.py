@@ -0,0 +1,420 @@
+import os
+import io
+import mmap
+import json
+import zlib
+import struct
+
+import numpy as np
+
+from typing import List, Tuple, Optional, BinaryIO
+
+from .PlateClass import Library, Plate, Well, Chromatogram, Sequencing, LazyChromatogramDict
+
+#SIPS archive layout:
+#  Header:  magic (8s), version (uint16), flags (uint16), reserved (uint32)
+#  Blocks:  8-byte aligned; uint32 JSON header length, JSON header, then 8-byte aligned arrays
+#  TOC:     JSON table of contents with the offset, length, and CRC32 of every plate, well, and chromatogram block
+#  Trailer: TOC offset (uint64), TOC length (uint32), TOC CRC32 (uint32), magic (8s)
+#Appending writes new blocks and a new TOC/trailer after the old ones, so existing blocks are never rewritten.
+ARCHIVE_MAGIC = b'SIPSARC\x00'
+ARCHIVE_TOC_MAGIC = b'SIPSTOC\x00'
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER = struct.Struct('<8sHHI')
+ARCHIVE_TRAILER = struct.Struct('<QII8s')
+ARCHIVE_ALIGNMENT = 8
+
+#Parameters which aren't stored as chromatogram block metadata
+CHROMATOGRAM_ARRAY_NAMES = ('time', 'intensity')
+SEQUENCING_ARRAY_NAMES = ('forward_alignment', 'forward_abi_traces', 'reverse_alignment', 'reverse_abi_traces')
+
+class ArchiveFormatError(Exception):
+    pass
+class ArchiveChecksumError(ArchiveFormatError):
+    pass
+
+def json_default(obj):
+    """Converts numpy scalars/arrays in block headers to JSON types"""
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+def align_offset(offset: int) -> int:
+    return -(-offset // ARCHIVE_ALIGNMENT) * ARCHIVE_ALIGNMENT
+
+def write_block(f: BinaryIO, header: dict, arrays: dict) -> dict:
+    """Function to write a block of metadata and arrays to an archive
+
+    Args:
+        f (BinaryIO): Archive opened for writing, positioned at the end of the data
+        header (dict): JSON serializable metadata
+        arrays (dict): Arrays to be stored with the block, written as-is with their dtype and shape
+
+    Returns:
+        dict: TOC entry with the offset, length, and CRC32 of the block
+    """
+    f.write(bytes(align_offset(f.tell()) - f.tell()))
+    start = f.tell()
+    array_entries = {}
+    array_offset = 0
+    for key in arrays:
+        arr = np.ascontiguousarray(arrays[key])
+        array_entries[key] = [arr.dtype.str, list(arr.shape), array_offset]
+        array_offset = align_offset(array_offset + arr.nbytes)
+    bheader = json.dumps({'header': header, 'arrays': array_entries}, default=json_default).encode('utf-8')
+    bheader += b' ' * (align_offset(4 + len(bheader)) - 4 - len(bheader))
+    chunks = [np.uint32(len(bheader)).tobytes(), bheader]
+    for key in arrays:
+        arr = np.ascontiguousarray(arrays[key])
+        chunks.append(memoryview(arr).cast('B'))
+        chunks.append(bytes(align_offset(arr.nbytes) - arr.nbytes))
+    crc = 0
+    for chunk in chunks:
+        f.write(chunk)
+        crc = zlib.crc32(chunk, crc)
+    return {'offset': start, 'length': f.tell() - start, 'crc32': crc}
+
+def read_block(bin_data: bytes, entry: dict, verify: bool=True) -> Tuple[dict, dict]:
+    """Function to read a block from an archive
+
+    Args:
+        bin_data (bytes): Archive buffer
+        entry (dict): TOC entry of the block
+        verify (bool): Check the block against its stored CRC32
+
+    Returns: header, arrays
+        header: Block metadata
+        arrays: Arrays stored with the block, as views into bin_data
+    """
+    start = entry['offset']
+    block = memoryview(bin_data)[start:start+entry['length']]
+    if len(block) != entry['length']:
+        raise ArchiveFormatError(f"Block at {start} extends past the end of the archive")
+    if verify and zlib.crc32(block) != entry['crc32']:
+        raise ArchiveChecksumError(f"Block at {start} failed its checksum")
+    nsize = int(np.frombuffer(block, dtype=np.uint32, count=1)[0])
+    block_header = json.loads(bytes(block[4:4+nsize]))
+    data_start = start + 4 + nsize
+    arrays = {}
+    for key, (dtype, shape, offset) in block_header['arrays'].items():
+        arrays[key] = np.frombuffer(bin_data, dtype=dtype, count=int(np.prod(shape)), offset=data_start+offset).reshape(shape)
+    return block_header['header'], arrays
+
+def get_chromatogram_params(chrom: Chromatogram) -> dict:
+    """Returns all chromatogram parameters besides its arrays, so new parameters are persisted automatically"""
+    #Lists are copied, so the parameters can be written out after the chromatogram changes again
+    return {key: list(value) if isinstance(value, list) else value for key, value in chrom.param.values().items() if key != 'name' and key not in CHROMATOGRAM_ARRAY_NAMES}
+
+#Records hold everything needed to write a block: its header and references to its arrays.  Capturing records is
+#cheap, and the arrays of chromatograms and wells are replaced rather than modified, so records captured on the
+#thread which changes a library can be written out from another thread.
+def get_chromatogram_record(chrom: Chromatogram) -> dict:
+    """Returns the record of a chromatogram's block"""
+    return {'header': get_chromatogram_params(chrom), 'arrays': {key: getattr(chrom, key) for key in CHROMATOGRAM_ARRAY_NAMES}}
+
+def get_unloaded_entry(chromatograms: dict, compound: str) -> Optional[dict]:
+    """Returns the archive TOC entry of a lazily loaded chromatogram which hasn't been built yet, or None"""
+    if isinstance(chromatograms, LazyChromatogramDict) and (dict.get(chromatograms, compound) is None):
+        entry = chromatograms.offsets.get(compound)
+        #Chromatograms from legacy .bin files are indexed by a plain offset, and have to be built to be saved
+        if isinstance(entry, dict):
+            return entry
+    return None
+
+def get_well_record(well: Well) -> dict:
+    """Returns the record of a well's sequencing block, without its chromatograms"""
+    sequencing = well.sequencing
+    if sequencing:
+        return {'header': {'has_sequencing': True}, 'arrays': {key: getattr(sequencing, key) for key in SEQUENCING_ARRAY_NAMES}}
+    return {'header': {'has_sequencing': False}, 'arrays': {}}
+
+def get_plate_header_record(plate: Plate) -> dict:
+    """Returns the record of a plate's compounds and parent alignment block, without its wells"""
+    return {'header': {'compounds': list(plate.compounds)}, 'arrays': {'parent_alignment': plate.parent_alignment}}
+
+def get_plate_records(plate: Plate) -> dict:
+    """Function to get the records of a plate, its wells, and their chromatograms
+
+    Chromatograms of a lazily loaded plate which haven't been accessed get a record of their blocks in the archive
+    they were loaded from, so they're copied from there instead of being built.
+
+    Returns:
+        dict: Plate header record, with the records of each well under 'wells', and of each well's chromatograms
+            under 'chromatograms'
+    """
+    records = {'header': get_plate_header_record(plate), 'wells': {}}
+    for well_name, well in list(plate.wells.items()):
+        chromatograms = well.chromatograms
+        well_records = {'header': get_well_record(well), 'chromatograms': {}}
+        for compound in list(dict.keys(chromatograms)):
+            entry = get_unloaded_entry(chromatograms, compound)
+            if entry is None:
+                well_records['chromatograms'][compound] = get_chromatogram_record(chromatograms[compound])
+            else:
+                well_records['chromatograms'][compound] = {'bin_data': chromatograms.bin_data, 'entry': entry}
+        records['wells'][well_name] = well_records
+    return records
+
+def get_library_records(library: Library) -> dict:
+    """Function to get the records of every plate in a library, by plate name"""
+    return {plate_name: get_plate_records(plate) for plate_name, plate in list(library.plates.items())}
+
+def copy_block(f: BinaryIO, bin_data: bytes, entry: dict) -> dict:
+    """Function to copy a block from another archive as-is, which keeps its CRC32 valid
+
+    Args:
+        f (BinaryIO): Archive opened for writing, positioned at the end of the data
+        bin_data (bytes): Buffer of the archive the block is in
+        entry (dict): TOC entry of the block in bin_data
+
+    Returns:
+        dict: TOC entry of the copied block
+    """
+    f.write(bytes(align_offset(f.tell()) - f.tell()))
+    start = f.tell()
+    with memoryview(bin_data)[entry['offset']:entry['offset']+entry['length']] as block:
+        if len(block) != entry['length']:
+            raise ArchiveFormatError(f"Block at {entry['offset']} extends past the end of the archive")
+        f.write(block)
+    return {'offset': start, 'length': entry['length'], 'crc32': entry['crc32']}
+
+def write_record(f: BinaryIO, record: dict) -> dict:
+    """Function to write a record as an archive block
+
+    Records of unloaded chromatograms are copied along with their journaled parameter block.
+
+    Returns:
+        dict: TOC entry of the block
+    """
+    if 'entry' in record:
+        entry = copy_block(f, record['bin_data'], record['entry'])
+        if 'params' in record['entry']:
+            entry['params'] = copy_block(f, record['bin_data'], record['entry']['params'])
+        return entry
+    return write_block(f, record['header'], record['arrays'])
+
+def write_params_record(f: BinaryIO, record: dict) -> dict:
+    """Function to write only the parameters of a chromatogram record as an archive block
+
+    The returned entry is stored under 'params' in the chromatogram's TOC entry, and overrides the parameters
+    stored with its data, so changing peak results doesn't rewrite the chromatogram's arrays.
+    """
+    return write_block(f, record['header'], {})
+
+def write_plate_records(f: BinaryIO, records: dict) -> dict:
+    """Function to write a plate, its wells, and their chromatograms as archive blocks
+
+    Args:
+        f (BinaryIO): Archive opened for writing, positioned at the end of the data
+        records (dict): Records from get_plate_records()
+
+    Returns:
+        dict: TOC entry of the plate, with nested entries for its wells and chromatograms
+    """
+    plate_entry = write_record(f, records['header'])
+    plate_entry['wells'] = {}
+    for well_name, well_records in records['wells'].items():
+        well_entry = write_record(f, well_records['header'])
+        well_entry['chromatograms'] = {compound: write_record(f, record) for compound, record in well_records['chromatograms'].items()}
+        plate_entry['wells'][well_name] = well_entry
+    return plate_entry
+
+def write_toc(f: BinaryIO, toc: dict) -> int:
+    """Function to write a table of contents and trailer, returning the TOC's length in bytes"""
+    f.write(bytes(align_offset(f.tell()) - f.tell()))
+    toc_offset = f.tell()
+    btoc = json.dumps(toc).encode('utf-8')
+    f.write(btoc)
+    f.write(ARCHIVE_TRAILER.pack(toc_offset, len(btoc), zlib.crc32(btoc), ARCHIVE_TOC_MAGIC))
+    return len(btoc)
+
+def read_toc(bin_data: bytes, end: Optional[int]=None) -> dict:
+    """Function to check an archive's header and read its table of contents
+
+    Args:
+        bin_data (bytes): Archive buffer
+        end (int, optional): End of the archive's trailer.  Defaults to the end of the buffer.
+
+    Returns:
+        dict: Table of contents
+    """
+    if end is None:
+        end = len(bin_data)
+    if end < ARCHIVE_HEADER.size + ARCHIVE_TRAILER.size:
+        raise ArchiveFormatError("File is too small to be a SIPS archive")
+    magic, version, _, _ = ARCHIVE_HEADER.unpack_from(bin_data, 0)
+    if magic != ARCHIVE_MAGIC:
+        raise ArchiveFormatError("File is not a SIPS archive")
+    if version > ARCHIVE_VERSION:
+        raise ArchiveFormatError(f"Archive version {version} is newer than the supported version {ARCHIVE_VERSION}")
+    toc_offset, toc_size, toc_crc, magic = ARCHIVE_TRAILER.unpack_from(bin_data, end - ARCHIVE_TRAILER.size)
+    if magic != ARCHIVE_TOC_MAGIC:
+        raise ArchiveFormatError("Archive table of contents is missing, the file may be truncated")
+    btoc = bytes(bin_data[toc_offset:toc_offset+toc_size])
+    if zlib.crc32(btoc) != toc_crc:
+        raise ArchiveChecksumError("Archive table of contents failed its checksum")
+    return json.loads(btoc)
+
+def recover_archive(file_path: str) -> bool:
+    """Function to roll an archive back to its last complete table of contents
+
+    Appends which were cut off (e.g. by a crash while autosaving) leave blocks without a trailer at the end of
+    the archive.  Everything after the last valid trailer is truncated, which loses only the unfinished append.
+
+    Args:
+        file_path (str): Path of the archive
+
+    Returns:
+        bool: Whether a valid table of contents was found
+    """
+    with open(file_path, 'r+b') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as bin_data:
+            end = len(bin_data)
+            while end > 0:
+                end = bin_data.rfind(ARCHIVE_TOC_MAGIC, 0, end)
+                if end < 0:
+                    return False
+                end += len(ARCHIVE_TOC_MAGIC)
+                try:
+                    read_toc(bin_data, end)
+                    break
+                except ArchiveFormatError:
+                    end -= len(ARCHIVE_TOC_MAGIC)
+            else:
+                return False
+        f.truncate(end)
+    return True
+
+def is_archive(file_path: str) -> bool:
+    """Returns whether a file is a SIPS archive, rather than a legacy .bin"""
+    with open(file_path, 'rb') as f:
+        return f.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC
+
+def save_archive(library: Library, file_path: str) -> None:
+    """Function to save a library as a SIPS archive
+
+    Args:
+        library (Library): Library to be saved
+        file_path (str): Path of the archive, which is replaced if it exists
+    """
+    save_archive_records(get_library_records(library), file_path)
+
+def save_archive_records(records: dict, file_path: str) -> dict:
+    """Function to save the records of a library's plates as a SIPS archive
+
+    Args:
+        records (dict): Records from get_library_records()
+        file_path (str): Path of the archive, which is replaced if it exists
+
+    Returns:
+        dict: Table of contents of the archive
+    """
+    toc = {'plates': {}}
+    #Written to a temporary file first, since a lazily loaded library may still be reading from file_path
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'wb', buffering=1 << 20) as f:
+        f.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, 0, 0))
+        for plate_name, plate_records in records.items():
+            toc['plates'][plate_name] = write_plate_records(f, plate_records)
+        write_toc(f, toc)
+    os.replace(temp_path, file_path)
+    return toc
+
+def append_archive(library: Library, file_path: str, plates: List[str]) -> None:
+    """Function to add plates to an existing archive without rewriting it
+
+    Plates already in the archive are replaced, and the space used by their old blocks isn't reclaimed.
+
+    Args:
+        library (Library): Library containing the plates
+        file_path (str): Path of the archive
+        plates (List[str]): Names of the plates to be appended
+    """
+    with open(file_path, 'r+b') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as bin_data:
+            toc = read_toc(bin_data)
+        f.seek(0, io.SEEK_END)
+        end = f.tell()
+        try:
+            for plate in plates:
+                toc['plates'][plate] = write_plate_records(f, get_plate_records(library[plate]))
+            write_toc(f, toc)
+        except BaseException:
+            #Leave the archive as it was
+            f.truncate(end)
+            raise
+
+def list_archive_plates(file_path: str) -> List[str]:
+    """Returns the names of the plates stored in an archive"""
+    with open(file_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as bin_data:
+            return list(read_toc(bin_data)['plates'])
+
+def read_chromatogram(bin_data: bytes, entry: dict, verify: bool=True, copy: bool=False) -> Chromatogram:
+    """Function to build a chromatogram from its archive block
+
+    Args:
+        bin_data (bytes): Archive buffer
+        entry (dict): TOC entry of the chromatogram
+        verify (bool): Check the block against its stored CRC32
+        copy (bool): Copy arrays out of the buffer instead of keeping views into it
+
+    Returns:
+        Chromatogram: Loaded chromatogram
+    """
+    params, arrays = read_block(bin_data, entry, verify)
+    if 'params' in entry:
+        #Parameters journaled after the data was written
+        params, _ = read_block(bin_data, entry['params'], verify)
+    if copy:
+        arrays = {key: arrays[key].copy() for key in arrays}
+    chrom = Chromatogram(**arrays)
+    #Skip any parameters this version of SIPS doesn't know about
+    chrom.param.update(**{key: value for key, value in params.items() if key in chrom.param})
+    return chrom
+
+def load_archive(library: Library, file_path: str, plates: Optional[List[str]]=None, lazy: bool=False, verify: bool=True) -> None:
+    """Function to load plates from a SIPS archive into a library
+
+    Args:
+        library (Library): Library to load plates into
+        file_path (str): Path of the archive
+        plates (List[str], optional): Names of the plates to load.  Defaults to all plates.
+        lazy (bool): Only build chromatograms when they are first accessed, with their data as copy-on-write
+            views of the memory-mapped archive.  Otherwise, chromatogram data is copied into memory.
+        verify (bool): Check blocks against their stored CRC32 as they are read
+    """
+    with open(file_path, 'rb') as f:
+        bin_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    toc = read_toc(bin_data)
+    if plates is None:
+        plates = list(toc['plates'])
+    for plate in plates:
+        if plate not in toc['plates']:
+            raise ValueError(f"Plate {plate} not found in archive")
+
+    #Build everything before touching the library, so a corrupt archive doesn't leave it half-loaded
+    loaded_plates = {}
+    for plate in plates:
+        plate_entry = toc['plates'][plate]
+        plate_header, plate_arrays = read_block(bin_data, plate_entry, verify)
+        loaded_plates[plate] = Plate(compounds=plate_header['compounds'], parent_alignment=plate_arrays['parent_alignment'].copy())
+        for well, well_entry in plate_entry['wells'].items():
+            well_header, well_arrays = read_block(bin_data, well_entry, verify)
+            loaded_plates[plate][well] = Well()
+            if well_header['has_sequencing']:
+                loaded_plates[plate][well].sequencing = Sequencing(**{key: well_arrays[key].copy() for key in SEQUENCING_ARRAY_NAMES})
+            if lazy:
+                chromatograms = LazyChromatogramDict(bin_data, lambda bin_data, entry: read_chromatogram(bin_data, entry, verify))
+                for compound, entry in well_entry['chromatograms'].items():
+                    chromatograms.add_offset(compound, entry)
+                loaded_plates[plate][well].chromatograms = chromatograms
+            else:
+                for compound, entry in well_entry['chromatograms'].items():
+                    loaded_plates[plate][well][compound] = read_chromatogram(bin_data, entry, verify, copy=True)
+
+    for plate in loaded_plates:
+        library[plate] = loaded_plates[plate]
+        for compound in loaded_plates[plate].compounds:
+            if compound not in library.compounds:
+                library.compounds.append(compound)
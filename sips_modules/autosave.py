@@ -0,0 +1,310 @@
+import io
+import os
+import mmap
+import threading
+
+import numpy as np
+
+from typing import Optional
+
+from .PlateClass import Library, Chromatogram, LazyChromatogramDict
+from .archive_utils import (
+    ARCHIVE_HEADER, ARCHIVE_TRAILER, align_offset, read_toc, write_toc, save_archive_records, write_record, write_params_record,
+    get_chromatogram_record, get_well_record, get_plate_header_record, get_library_records
+)
+
+def get_entry_size(entry: dict) -> int:
+    """Returns the bytes of all blocks referenced by a TOC entry, including nested and parameter entries and their alignment"""
+    size = align_offset(entry.get('length', 0))
+    if 'params' in entry:
+        size += align_offset(entry['params']['length'])
+    for key in ('wells', 'chromatograms'):
+        for child in entry.get(key, {}).values():
+            size += get_entry_size(child)
+    return size
+
+class LibraryJournal:
+    """Tracks changes to a library and saves them to its archive as an append-only journal
+
+    Chromatograms are watched for parameter changes, and the library's plates, wells, and chromatograms are
+    compared by identity against the last checkpoint to find structural changes.  A checkpoint appends blocks
+    for only what changed, followed by a new table of contents, so the archive stays loadable after every
+    checkpoint.  Chromatograms whose arrays haven't changed only get a small parameter block.  Once the
+    journal holds more replaced blocks than compact_ratio times its live ones, the archive is compacted into a
+    fresh full archive.  Compaction copies the blocks of lazily loaded chromatograms which haven't been
+    accessed, rather than building them.
+
+    Watchers only record what changed, so they never slow down the event loop.  Saving is split in two:
+    prepare() reads the library, so it runs on the thread which changes it (a session's event loop), but it only
+    captures records of what changed, which reference arrays rather than copying them.  write() does all of the
+    file I/O from those records, so it can run on a background thread while the library keeps changing.
+    Anything changed after prepare() is saved by the next checkpoint.
+
+    Args:
+        library (Library): Library to be tracked
+        file_path (str): Path of the library's archive
+        clean (bool): Whether the archive already matches the library, e.g. because it was just loaded from
+            it.  Otherwise, the first checkpoint writes a full archive.
+        compact_ratio (float): Compact once the bytes of replaced blocks exceed this multiple of the live bytes
+    """
+    def __init__(self, library: Library, file_path: str, clean: bool=False, compact_ratio: float=1.0):
+        self.library = library
+        self.file_path = file_path
+        self.compact_ratio = compact_ratio
+        self.dirty_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        #id(object) -> 'data' or 'params' for chromatograms, or True for sequencing
+        self.dirty = {}
+        self.watchers = {}
+        self.closed = False
+        #Objects seen at the last checkpoint
+        self.plates = {}
+        self.wells = {}
+        self.chromatograms = {}
+        self.toc = None
+        self.toc_size = 0
+        self.file_size = 0
+        if clean and os.path.exists(self.file_path):
+            self.read_archive()
+            self.scan(baseline=True)
+
+    def watch(self, obj):
+        if (not self.closed) and (id(obj) not in self.watchers):
+            names = [name for name in obj.param if name != 'name']
+            self.watchers[id(obj)] = (obj, obj.param.watch(self.object_changed, names))
+
+    def object_changed(self, *events):
+        obj = events[0].obj
+        if not isinstance(obj, Chromatogram):
+            kind = True
+        else:
+            #Repacking a chromatogram into a table reassigns equal arrays, which aren't a change
+            names = [event.name for event in events if (event.name not in ('time', 'intensity')) or not self.same_array(event.old, event.new)]
+            if not names:
+                return
+            kind = 'data' if ('time' in names) or ('intensity' in names) else 'params'
+        with self.dirty_lock:
+            if self.dirty.get(id(obj)) != 'data':
+                self.dirty[id(obj)] = kind
+
+    @staticmethod
+    def same_array(old, new) -> bool:
+        return (old is new) or (isinstance(old, np.ndarray) and isinstance(new, np.ndarray) and (old.shape == new.shape) and np.array_equal(old, new))
+
+    def close(self):
+        """Function to stop watching the library"""
+        self.closed = True
+        for obj, watcher in list(self.watchers.values()):
+            obj.param.unwatch(watcher)
+        self.watchers = {}
+
+    def read_archive(self):
+        with open(self.file_path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as bin_data:
+                self.toc = read_toc(bin_data)
+                self.file_size = len(bin_data)
+                self.toc_size = ARCHIVE_TRAILER.unpack_from(bin_data, self.file_size - ARCHIVE_TRAILER.size)[1]
+
+    def get_live_size(self) -> int:
+        """Returns the bytes the archive would take up if it were compacted"""
+        blocks = sum(get_entry_size(entry) for entry in self.toc['plates'].values())
+        return align_offset(ARCHIVE_HEADER.size + blocks) + self.toc_size + ARCHIVE_TRAILER.size
+
+    def get_dead_size(self) -> int:
+        """Returns the bytes of replaced blocks and old tables of contents in the archive"""
+        return max(self.file_size - self.get_live_size(), 0)
+
+    def scan(self, baseline: bool=False) -> dict:
+        """Function to find what changed since the last checkpoint, and start watching new objects
+
+        Args:
+            baseline (bool): Record the library as matching the archive, without loading lazy chromatograms
+
+        Returns:
+            dict: Changes by plate, each with 'header' (bool), 'wells' ({well: (header, {compound: kind})}),
+                and 'removed' (wells which are gone), or None if the whole plate is gone
+        """
+        with self.dirty_lock:
+            dirty, self.dirty = self.dirty, {}
+        changes = {}
+        plates, wells, chromatograms = {}, {}, {}
+        for plate_name, plate in list(self.library.plates.items()):
+            well_names = list(plate.wells)
+            old_plate = self.plates.get(plate_name)
+            new_plate = (not baseline) and ((old_plate is None) or (old_plate[0] is not plate))
+            plates[plate_name] = (plate, tuple(plate.compounds), id(plate.parent_alignment), frozenset(well_names))
+            plate_changes = {
+                'header': new_plate or ((not baseline) and (old_plate[:3] != plates[plate_name][:3])),
+                'wells': {},
+                'removed': [] if new_plate or baseline else list(old_plate[3].difference(well_names)),
+            }
+            for well_name in well_names:
+                well = plate.wells[well_name]
+                key = (plate_name, well_name)
+                compounds = list(dict.keys(well.chromatograms))
+                old_well = self.wells.get(key)
+                new_well = (not baseline) and (new_plate or (old_well is None) or (old_well[0] is not well))
+                wells[key] = (well, well.sequencing, frozenset(compounds))
+                well_header = new_well or ((not baseline) and ((old_well[1] is not well.sequencing) or (dirty.get(id(well.sequencing)) is True)))
+                if well.sequencing is not None:
+                    self.watch(well.sequencing)
+                compound_changes = {}
+                for compound in compounds:
+                    chrom = dict.get(well.chromatograms, compound)
+                    if chrom is None:
+                        if not new_well:
+                            #Not loaded from the archive yet, so it can't have changed.  Chromatograms are
+                            #watched as soon as they're loaded, so changes made before the next scan aren't missed.
+                            if isinstance(well.chromatograms, LazyChromatogramDict):
+                                well.chromatograms.on_load = self.watch
+                            chromatograms[key + (compound,)] = None
+                            continue
+                        chrom = well.chromatograms[compound]
+                    previous = self.chromatograms.get(key + (compound,), False)
+                    if new_well or ((not baseline) and ((previous is False) or ((previous is not None) and (previous is not chrom)))):
+                        compound_changes[compound] = 'data'
+                    elif (not baseline) and (id(chrom) in dirty):
+                        compound_changes[compound] = dirty[id(chrom)]
+                    chromatograms[key + (compound,)] = chrom
+                    self.watch(chrom)
+                removed_compounds = (not new_well) and (not baseline) and (old_well[2] != wells[key][2])
+                if well_header or compound_changes or removed_compounds:
+                    plate_changes['wells'][well_name] = (well_header, compound_changes)
+            if plate_changes['header'] or plate_changes['wells'] or plate_changes['removed']:
+                changes[plate_name] = plate_changes
+        for plate_name in self.plates:
+            if plate_name not in plates:
+                changes[plate_name] = None
+
+        #Stop watching objects which aren't in the library anymore.  Chromatograms loaded during the scan aren't
+        #in either set, so they stay watched.
+        current = {id(obj) for obj in chromatograms.values() if obj is not None} | {id(seq) for _, seq, _ in wells.values() if seq is not None}
+        previous = {id(obj) for obj in self.chromatograms.values() if obj is not None} | {id(seq) for _, seq, _ in self.wells.values() if seq is not None}
+        for obj_id in previous.difference(current):
+            if obj_id in self.watchers:
+                obj, watcher = self.watchers.pop(obj_id)
+                obj.param.unwatch(watcher)
+        self.plates, self.wells, self.chromatograms = plates, wells, chromatograms
+        return changes
+
+    def needs_compaction(self) -> bool:
+        return (self.toc is None) or (self.get_dead_size() > self.compact_ratio * self.get_live_size())
+
+    def get_change_records(self, changes: dict) -> dict:
+        """Function to capture records of the changes found by scan(), laid out the same way"""
+        records = {}
+        for plate_name, plate_changes in changes.items():
+            if plate_changes is None:
+                records[plate_name] = None
+                continue
+            plate = self.library.plates[plate_name]
+            wells = {}
+            for well_name, (well_header, compound_changes) in plate_changes['wells'].items():
+                well = plate.wells[well_name]
+                wells[well_name] = {
+                    'header': get_well_record(well) if well_header else None,
+                    'compounds': list(dict.keys(well.chromatograms)),
+                    'chromatograms': {compound: (kind, get_chromatogram_record(well.chromatograms[compound])) for compound, kind in compound_changes.items()},
+                }
+            records[plate_name] = {
+                'header': get_plate_header_record(plate) if plate_changes['header'] else None,
+                'wells': wells,
+                'removed': plate_changes['removed'],
+            }
+        return records
+
+    def prepare(self) -> Optional[dict]:
+        """Function to capture what the next checkpoint writes, on the thread which changes the library
+
+        Returns:
+            dict: Plan for write(), with the records of either the changes or, when the archive is due to be
+                compacted, the whole library.  None if nothing changed since the last checkpoint.
+        """
+        compact = self.needs_compaction()
+        changes = self.scan()
+        if compact:
+            return {'plates': get_library_records(self.library)}
+        if not changes:
+            return None
+        return {'changes': self.get_change_records(changes)}
+
+    def write_changes(self, records: dict):
+        """Function to append blocks for the change records, followed by a new table of contents"""
+        toc = {'plates': dict(self.toc['plates'])}
+        with open(self.file_path, 'r+b') as f:
+            f.seek(0, io.SEEK_END)
+            end = f.tell()
+            try:
+                for plate_name, plate_records in records.items():
+                    if plate_records is None:
+                        toc['plates'].pop(plate_name, None)
+                        continue
+                    plate_entry = dict(toc['plates'].get(plate_name, {'wells': {}}))
+                    if plate_records['header'] is not None:
+                        plate_entry.update(write_record(f, plate_records['header']))
+                    plate_entry['wells'] = dict(plate_entry['wells'])
+                    for well_name in plate_records['removed']:
+                        plate_entry['wells'].pop(well_name, None)
+                    for well_name, well_records in plate_records['wells'].items():
+                        well_entry = dict(plate_entry['wells'].get(well_name, {'chromatograms': {}}))
+                        if well_records['header'] is not None:
+                            well_entry.update(write_record(f, well_records['header']))
+                        old_entries = well_entry['chromatograms']
+                        well_entry['chromatograms'] = {compound: old_entries[compound] for compound in well_records['compounds'] if compound in old_entries}
+                        for compound, (kind, record) in well_records['chromatograms'].items():
+                            if (kind == 'params') and (compound in well_entry['chromatograms']):
+                                well_entry['chromatograms'][compound] = {**well_entry['chromatograms'][compound], 'params': write_params_record(f, record)}
+                            else:
+                                well_entry['chromatograms'][compound] = write_record(f, record)
+                        plate_entry['wells'][well_name] = well_entry
+                    toc['plates'][plate_name] = plate_entry
+                toc_size = write_toc(f, toc)
+                f.flush()
+                os.fsync(f.fileno())
+            except BaseException:
+                #Leave the archive as it was
+                f.truncate(end)
+                raise
+            self.file_size = f.tell()
+        self.toc = toc
+        self.toc_size = toc_size
+
+    def write(self, plan: Optional[dict]) -> bool:
+        """Function to write a plan from prepare() to the archive, which can be done from a background thread
+
+        A compaction rewrites the archive from the plan's records.  Lazy chromatograms keep reading from the
+        mapping of the archive they were loaded from, which outlives it being replaced.
+
+        Returns:
+            bool: Whether anything was written
+        """
+        if plan is None:
+            return False
+        with self.write_lock:
+            try:
+                if 'plates' in plan:
+                    save_archive_records(plan['plates'], self.file_path)
+                    self.read_archive()
+                else:
+                    self.write_changes(plan['changes'])
+            except BaseException:
+                #These changes aren't tracked by the journal anymore, so the next checkpoint saves everything
+                self.toc = None
+                raise
+        return True
+
+    def checkpoint(self) -> bool:
+        """Function to save the library's changes since the last checkpoint, on the thread which changes the library
+
+        Returns:
+            bool: Whether anything was written
+        """
+        written = self.write(self.prepare())
+        if self.needs_compaction():
+            written = self.write(self.prepare())
+        return written
+
+    def pending(self) -> bool:
+        """Returns whether there are recorded changes which haven't been checkpointed"""
+        with self.dirty_lock:
+            return bool(self.dirty) or (self.toc is None)
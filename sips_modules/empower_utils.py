@@ -0,0 +1,383 @@
+import os
+import re
+import glob
+import shutil
+import tempfile
+import numpy as np
+
+from concurrent.futures import Executor, as_completed
+
+from typing import List, Tuple, Optional, Callable, Dict, BinaryIO, Iterator
+
+#Size of the blocks data lines are parsed in, which bounds the memory used for a file no matter its size
+ARW_READ_CHUNK_SIZE = 4 << 20
+
+class EmpowerFormatError(ValueError):
+    """Raised when an .arw file is missing header information or has malformed data"""
+    pass
+
+class ArwHeader:
+    """Header information of an Empower .arw raw data export
+
+    Args:
+        name (str): Name of the file, for error messages
+        sample_name (str): Sample name, or "" if the export doesn't include it
+        well (str): Well ID from the vial position (e.g. A01)
+        tag (str): Data source of the file (e.g. '(+)MS Scan', '(+)SIR 202.00 m/z', 'PDA Scan', '340nm')
+        wavelengths (np.ndarray): Wavelengths or m/z values of each data column for 3D data, or empty for 2D data
+        data_offset (int): Byte offset of the first data line in the file
+        n_columns (int): Number of values on each data line, starting with time
+    """
+    def __init__(self, name: str, sample_name: str, well: str, tag: str, wavelengths: np.ndarray, data_offset: int, n_columns: int):
+        self.name = name
+        self.sample_name = sample_name
+        self.well = well
+        self.tag = tag
+        self.wavelengths = wavelengths
+        self.data_offset = data_offset
+        self.n_columns = n_columns
+
+    @property
+    def content3d(self) -> bool:
+        return self.wavelengths.size > 0
+
+def get_channel_tag(name: str, channel_desc: str) -> Tuple[str, bool]:
+    """Function to get the data source tag of a channel description
+
+    Possible formats:
+    "1: QDa Positive(+) Scan (150.00-750.00)Da, Centroid, CV=15"
+    "2: QDa Negative(-) Scan (150.00-750.00)Da, Centroid, CV=15"
+    "PDA Spectrum (210-400)nm"
+    "2: QDa Positive(+) SIR Ch1 202.00 Da, CV=15"
+    "PDA Ch2 340nm@4.8nm"
+
+    Returns: tag, whether the channel is 3D data
+    """
+    desc_split = [x for x in re.split(r'[ ,]+', channel_desc) if x != ""]
+    if 'QDa' in channel_desc:
+        polarity = '+' if 'Positive' in channel_desc else ('-' if 'Negative' in channel_desc else None)
+        if polarity is not None:
+            if 'Scan' in channel_desc:
+                return f"({polarity})MS Scan", True
+            elif ('SIR' in channel_desc) and ('Da' in desc_split):
+                return f"({polarity})SIR {desc_split[desc_split.index('Da')-1]} m/z", False
+        raise EmpowerFormatError(f"{name} has a malformed MS description")
+    elif 'PDA' in channel_desc:
+        if 'Spectrum' in channel_desc:
+            return "PDA Scan", True
+        elif '@' in channel_desc:
+            return [x for x in desc_split if '@' in x][0].split('@')[0], False
+        raise EmpowerFormatError(f"{name} has a malformed PDA description")
+    raise EmpowerFormatError(f"{name} has unknown data description: {channel_desc}")
+
+def read_header_line(f: BinaryIO) -> str:
+    #Returns the next non-empty line, since Empower lines can be separated by any run of \r and \n
+    while True:
+        line = f.readline()
+        if line == b"":
+            raise EmpowerFormatError("File ended before the data")
+        line = line.strip(b"\r\n")
+        if line != b"":
+            return line.decode('utf-8', errors='replace')
+
+def read_arw_header(f: BinaryIO, name: str="") -> ArwHeader:
+    """Function to read the header of an .arw file, leaving the file positioned at the first data line
+
+    Args:
+        f (BinaryIO): File opened in binary mode, positioned at the start
+        name (str): Name of the file, for error messages
+
+    Returns:
+        ArwHeader: Header information of the file
+    """
+    header_labels = read_header_line(f).split('\t')
+    header_content = read_header_line(f).split('\t')
+    if '"Channel Description"' not in header_labels:
+        raise EmpowerFormatError(f"{name} is missing a channel description")
+    channel_desc = header_content[header_labels.index('"Channel Description"')]
+    if '"Vial"' not in header_labels:
+        raise EmpowerFormatError(f"{name} is missing a vial ID")
+    try:
+        #Vials look like "1:A,1"
+        vial_bits = header_content[header_labels.index('"Vial"')].replace('"', '').split(':')[1].split(',')
+        well = vial_bits[0].upper() + vial_bits[1].zfill(2)
+    except IndexError:
+        raise EmpowerFormatError(f"{name} has a malformed vial ID")
+    sample_name = ""
+    if '"SampleName"' in header_labels:
+        sample_name = header_content[header_labels.index('"SampleName"')][1:-1]
+    tag, content3d = get_channel_tag(name, channel_desc)
+    wavelengths = np.zeros(0)
+    if content3d:
+        #3D data has a row of wavelengths/m/z values, then a second label row before the data
+        #The first value is the row's label, or empty if the row starts with a tab
+        wavelengths = np.array(re.split(r'\s+', read_header_line(f).rstrip())[1:], dtype=np.float64)
+        read_header_line(f)
+    #Count the values on the first data line, then go back to it
+    data_offset = f.tell()
+    try:
+        n_columns = len(read_header_line(f).split())
+    except EmpowerFormatError:
+        n_columns = 1 + max(wavelengths.size, 1)
+    f.seek(data_offset)
+    if content3d and (n_columns != 1 + wavelengths.size):
+        raise EmpowerFormatError(f"{name} has {n_columns - 1} data columns for {wavelengths.size} wavelengths")
+    return ArwHeader(name, sample_name, well, tag, wavelengths, data_offset, n_columns)
+
+def parse_data_block(block: bytes, n_columns: int, columns: np.ndarray) -> np.ndarray:
+    """Function to parse a block of whole data lines, keeping only the requested columns
+
+    Returns:
+        np.ndarray: (lines, len(columns)) array of values
+    """
+    if block.strip() == b"":
+        return np.zeros((0, len(columns)))
+    values = np.fromstring(block.decode('latin-1'), dtype=np.float64, sep=' ')
+    if values.size % n_columns != 0:
+        raise EmpowerFormatError(f"Data lines don't all have {n_columns} values")
+    return values.reshape(-1, n_columns)[:,columns]
+
+def read_arw_columns(f: BinaryIO, header: ArwHeader, columns: List[int], chunk_size: int=ARW_READ_CHUNK_SIZE) -> np.ndarray:
+    """Function to stream the data lines of an .arw file, keeping only the requested columns
+
+    The file is read and parsed in blocks of whole lines, so only one block of the full data matrix is held at
+    a time, however many wavelengths/m/z values a 3D export has.
+
+    Args:
+        f (BinaryIO): File opened in binary mode
+        header (ArwHeader): Header of the file
+        columns (List[int]): Indices of the columns to keep, where 0 is time
+        chunk_size (int): Number of bytes read per block
+
+    Returns:
+        np.ndarray: (points, len(columns)) array of the requested columns
+    """
+    columns = np.asarray(columns, dtype=np.int64)
+    f.seek(header.data_offset)
+    blocks = []
+    remainder = b""
+    while True:
+        chunk = f.read(chunk_size)
+        if chunk == b"":
+            break
+        chunk = remainder + chunk
+        #Only parse up to the last complete line, and carry the rest over to the next block
+        end = max(chunk.rfind(b"\n"), chunk.rfind(b"\r")) + 1
+        remainder = chunk[end:]
+        if end > 0:
+            blocks.append(parse_data_block(chunk[:end], header.n_columns, columns))
+    if remainder.strip() != b"":
+        blocks.append(parse_data_block(remainder, header.n_columns, columns))
+    if len(blocks) == 0:
+        return np.zeros((0, columns.size))
+    return np.vstack(blocks)
+
+def format_target(target: float) -> str:
+    #Formats a target like the browser did (e.g. 254, 254.5)
+    return str(int(target)) if float(target).is_integer() else str(target)
+
+def harvest_arw_file(path: str, header: ArwHeader, requests: List[Tuple[str, str, float]]) -> List[Tuple[str, str, str, str, np.ndarray, np.ndarray]]:
+    """Function to extract the requested compounds from one .arw file, in a single pass over its data
+
+    Args:
+        path (str): Path of the file
+        header (ArwHeader): Header of the file
+        requests (List[Tuple[str, str, float]]): (compound, source, target) of each compound to extract, where
+            target is the wavelength/m/z for 3D sources (ignored for 2D sources).  Other sources are skipped.
+
+    Returns:
+        List of (sample name, well, compound, source, time, intensity) records, with float32 time and intensity
+    """
+    requests = [(compound, target) for compound, source, target in requests if source == header.tag]
+    if len(requests) == 0:
+        return []
+    if header.content3d:
+        #Pull the closest wavelength/m/z column of each target
+        request_columns = [1 + int(np.argmin(np.abs(header.wavelengths - target))) for _, target in requests]
+    else:
+        request_columns = [1 for _ in requests]
+    columns = sorted(set(request_columns))
+    with open(path, 'rb') as f:
+        data = read_arw_columns(f, header, [0] + columns).astype(np.float32)
+    time = np.ascontiguousarray(data[:,0])
+    records = []
+    for (compound, target), column in zip(requests, request_columns):
+        tag = header.tag
+        if header.content3d:
+            tag = f"{tag[:3]}XIC {format_target(target)} m/z" if 'MS' in tag else f"XAC {format_target(target)} nm"
+        records.append((header.sample_name, header.well, compound, tag, time, np.ascontiguousarray(data[:,1 + columns.index(column)])))
+    return records
+
+class EmpowerIngest:
+    """Server-side ingest of Empower .arw files, received in chunks from the browser or read from a folder
+
+    Uploaded files are spooled to a temporary directory as their chunks arrive, and each file's header is parsed
+    once its last chunk has been written.  An upload starts with a manifest of its files, which is matched
+    against what has already been received, so an upload interrupted by a dropped connection resumes where it
+    left off instead of re-sending whole files.  Harvesting then streams each file once, extracting only the
+    columns the requested compounds need.
+
+    Args:
+        spool_dir (str, optional): Directory to spool uploaded files to.  Defaults to a new temporary directory.
+        spool_root (str, optional): Where the temporary directory is made, so leftovers can be swept.  Defaults to
+            the system's temporary directory.
+    """
+    def __init__(self, spool_dir: Optional[str]=None, spool_root: Optional[str]=None):
+        self.spool_dir = spool_dir
+        self.spool_root = spool_root
+        self.owns_spool_dir = False
+        self.n_spooled = 0
+        self.paths: Dict[str, str] = {}
+        self.headers: Dict[str, ArwHeader] = {}
+        #Bytes received so far and (size, modification time) of each uploaded file
+        self.received: Dict[str, int] = {}
+        self.manifest: Dict[str, Tuple[int, int]] = {}
+
+    def reset(self):
+        """Function to drop all files, deleting any spooled uploads"""
+        if self.owns_spool_dir and (self.spool_dir is not None):
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+            self.spool_dir = None
+            self.owns_spool_dir = False
+        self.paths = {}
+        self.headers = {}
+        self.received = {}
+        self.manifest = {}
+
+    def remove_file(self, name: str):
+        """Function to drop one file, deleting it if it was spooled"""
+        path = self.paths.pop(name, None)
+        if (path is not None) and self.owns_spool_dir and (os.path.dirname(path) == self.spool_dir):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.headers.pop(name, None)
+        self.received.pop(name, None)
+        self.manifest.pop(name, None)
+
+    def get_spool_path(self) -> str:
+        if self.spool_dir is None:
+            if self.spool_root is not None:
+                os.makedirs(self.spool_root, exist_ok=True)
+            self.spool_dir = tempfile.mkdtemp(prefix='sips_arw_', dir=self.spool_root)
+            self.owns_spool_dir = True
+        self.n_spooled += 1
+        return os.path.join(self.spool_dir, f"{self.n_spooled}.arw")
+
+    def start_upload(self, manifest: List[Tuple[str, int, int]]) -> List[int]:
+        """Function to start an upload, keeping whatever was already received of the same files
+
+        Files which aren't in the manifest, or which have changed since they were received, are dropped.
+
+        Args:
+            manifest (List[Tuple[str, int, int]]): (name, size, modification time) of each file to upload
+
+        Returns:
+            List[int]: Byte offset to resume each file from, which is its size if it was already received
+        """
+        files = {name: (int(size), int(modified)) for name, size, modified in manifest}
+        for name in list(self.paths):
+            if self.manifest.get(name) != files.get(name):
+                self.remove_file(name)
+        self.manifest = files
+        return [self.received.get(name, 0) for name, _, _ in manifest]
+
+    def add_chunk(self, name: str, offset: int, data: bytes, final: bool):
+        """Function to write a chunk of an uploaded file, parsing its header once the file is complete
+
+        Args:
+            name (str): Name of the uploaded file
+            offset (int): Byte offset of the chunk in the file
+            data (bytes): Contents of the chunk
+            final (bool): Whether this is the last chunk of the file
+        """
+        if name not in self.paths:
+            self.paths[name] = self.get_spool_path()
+            self.received[name] = 0
+        if offset > self.received[name]:
+            raise EmpowerFormatError(f"{name} is missing bytes {self.received[name]} to {offset}")
+        with open(self.paths[name], 'r+b' if offset > 0 else 'wb') as f:
+            f.seek(offset)
+            f.write(data)
+        self.received[name] = offset + len(data)
+        if final:
+            self.add_file(self.paths[name], name)
+
+    def add_file(self, path: str, name: Optional[str]=None):
+        """Function to add an .arw file which is already on the server"""
+        if name is None:
+            name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            self.headers[name] = read_arw_header(f, name)
+        self.paths[name] = path
+
+    def add_folder(self, folder: str):
+        """Function to add every .arw file in a folder on the server"""
+        for path in sorted(glob.glob(os.path.join(folder, '*.arw'))):
+            self.add_file(path)
+
+    def get_sources(self) -> Tuple[List[str], Dict[str, List[float]]]:
+        """Function to get the data sources found in the files, for the data selection table
+
+        Returns:
+            List[str]: Unique data source tags, in the order they were found
+            Dict[str, List[float]]: Wavelengths/m/z values found for each 3D data source
+        """
+        sources = []
+        wavelengths = {}
+        for header in self.headers.values():
+            if header.tag not in sources:
+                sources.append(header.tag)
+            if header.content3d:
+                values = wavelengths.setdefault(header.tag, [])
+                seen = set(values)
+                values += [x for x in header.wavelengths.tolist() if x not in seen]
+        return sources, wavelengths
+
+    def iter_harvest(self, compounds: List[str], sources: List[str], targets: List[float], executor: Optional[Executor]=None) -> Iterator[Tuple[int, int, List[Tuple[str, str, str, str, np.ndarray, np.ndarray]]]]:
+        """Function to extract the requested compounds from every file, yielding each file's records as it's done
+
+        Args:
+            compounds (List[str]): Compound names
+            sources (List[str]): Data source tag to extract each compound from
+            targets (List[float]): Wavelength/m/z of each compound for 3D sources (ignored for 2D sources)
+            executor (Executor, optional): Executor to parse the files in parallel on, in which case records are
+                yielded in the order the files finish.  Defaults to parsing them one after another.
+
+        Yields:
+            (files processed, total files, list of (sample name, well, compound, source, time, intensity) records)
+        """
+        requests = list(zip(compounds, sources, targets))
+        files = [(self.paths[name], header) for name, header in self.headers.items()]
+        n_total = len(files)
+        if executor is None:
+            for i, (path, header) in enumerate(files):
+                yield i+1, n_total, harvest_arw_file(path, header, requests)
+            return
+        futures = [executor.submit(harvest_arw_file, path, header, requests) for path, header in files]
+        try:
+            for i, future in enumerate(as_completed(futures)):
+                yield i+1, n_total, future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def harvest(self, compounds: List[str], sources: List[str], targets: List[float], progress_callback: Optional[Callable[[int, int], None]]=None) -> List[Tuple[str, str, str, str, np.ndarray, np.ndarray]]:
+        """Function to extract the requested compounds from every file
+
+        Args:
+            compounds (List[str]): Compound names
+            sources (List[str]): Data source tag to extract each compound from
+            targets (List[float]): Wavelength/m/z of each compound for 3D sources (ignored for 2D sources)
+            progress_callback (Callable[[int, int], None], optional): Called with (processed, total) after each file
+
+        Returns:
+            List of (sample name, well, compound, source, time, intensity) records, with float32 time and intensity
+        """
+        records = []
+        for n_done, n_total, file_records in self.iter_harvest(compounds, sources, targets):
+            records += file_records
+            if progress_callback is not None:
+                progress_callback(n_done, n_total)
+        return records
@@ -0,0 +1,130 @@
+import io
+import importlib.util
+
+import numpy as np
+import pandas as pd
+
+from typing import BinaryIO, List
+
+from .PlateClass import Library, Plate
+from .plot_utils import parse_well_id
+
+#Rows per chunk when writing CSV, so the text of a large export is never built all at once
+EXPORT_CSV_CHUNK_ROWS = 50000
+#Parquet can be written by pyarrow or fastparquet, Feather only by pyarrow
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+HAS_FASTPARQUET = importlib.util.find_spec('fastparquet') is not None
+#Only the formats which can be written with the installed packages
+EXPORT_FORMATS = ('csv',) + (('parquet',) if HAS_PYARROW or HAS_FASTPARQUET else ()) + (('feather',) if HAS_PYARROW else ())
+
+#Exported column name of each table column
+EXPORT_RESULT_COLUMNS = {
+    'peak_area': 'area',
+    'peak_rt': 'rt',
+    'peak_height': 'height',
+    'peak_snr': 'snr',
+    'peak_stcurve_area': 'stcurve_area',
+    'peak_background': 'background',
+    'rt': 'target_rt',
+    'drift_offset': 'drift_offset',
+}
+
+def get_plate_results(plate_name: str, plate: Plate) -> List[pd.DataFrame]:
+    """Function to get the integration results of every compound in a plate, read straight from its tables
+
+    Args:
+        plate_name (str): Name of the plate
+        plate (Plate): Plate to be exported
+
+    Returns:
+        List[pd.DataFrame]: Tidy results of each compound, one row per well
+    """
+    frames = []
+    compounds = list(dict.fromkeys(compound for well in plate.wells.values() for compound in well.chromatograms))
+    for compound in compounds:
+        table = plate.get_table(compound)
+        n_rows = len(table)
+        bounds = table.get_column('peak_bound_inds')
+        drift = table.get_column('drift_offset')
+        #Bound times include the drift correction, like peak_rt
+        has_bounds = (bounds >= 0).all(axis=1) & (bounds < table.lengths[:,None]).all(axis=1)
+        safe_bounds = np.where(has_bounds[:,None], bounds, 0)
+        if table.shared_time:
+            bound_times = table.time[safe_bounds] if table.time.size > 0 else np.zeros((n_rows, 2))
+        else:
+            bound_times = np.take_along_axis(table.time, safe_bounds, axis=1)
+        bound_times = np.where(has_bounds[:,None], bound_times + drift[:,None], np.nan)
+        frame = {
+            'plate': np.full(n_rows, plate_name, dtype=object),
+            'well': np.array(table.well_ids, dtype=object),
+            'sample': np.array([chrom.sample_name for chrom in table.chromatograms], dtype=object),
+            'compound': np.full(n_rows, compound, dtype=object),
+        }
+        for key, name in EXPORT_RESULT_COLUMNS.items():
+            frame[name] = table.get_column(key)
+        frame['left_bound'] = bound_times[:,0]
+        frame['right_bound'] = bound_times[:,1]
+        frames.append(pd.DataFrame(frame))
+    return frames
+
+def get_results_frame(library: Library) -> pd.DataFrame:
+    """Function to get the integration results of a whole library as a tidy table
+
+    Every chromatogram gets a row, with NaN results where it hasn't been integrated.  Rows are ordered by
+    plate, then down each column of the plate in turn, then by compound.
+
+    Args:
+        library (Library): Library to be exported
+
+    Returns:
+        pd.DataFrame: Columns plate, well, sample, compound, area, rt, height, snr, stcurve_area, background,
+            target_rt, drift_offset, left_bound, right_bound
+    """
+    frames = [frame for plate in library for frame in get_plate_results(plate, library[plate])]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=['plate', 'well', 'sample', 'compound'] + list(EXPORT_RESULT_COLUMNS.values()) + ['left_bound', 'right_bound'])
+    results = pd.concat(frames, ignore_index=True)
+    #Sort on integer keys instead of strings
+    plate_order = {plate: i for i, plate in enumerate(library)}
+    well_positions = {well: parse_well_id(well) for well in results['well'].unique()}
+    compound_order = {compound: i for i, compound in enumerate(dict.fromkeys(results['compound']))}
+    #np.lexsort sorts by the last key first
+    keys = (
+        results['compound'].map(compound_order).to_numpy(),
+        results['well'].map({well: row for well, (row, _) in well_positions.items()}).to_numpy(),
+        results['well'].map({well: col for well, (_, col) in well_positions.items()}).to_numpy(),
+        results['plate'].map(plate_order).to_numpy(),
+    )
+    return results.iloc[np.lexsort(keys)].reset_index(drop=True)
+
+def write_results(results: pd.DataFrame, f: BinaryIO, file_format: str='csv') -> None:
+    """Function to write exported results to a binary file
+
+    CSV is written in chunks of EXPORT_CSV_CHUNK_ROWS rows.  Parquet needs pyarrow or fastparquet, and Feather
+    needs pyarrow, so they're only in EXPORT_FORMATS when those are installed.
+
+    Args:
+        results (pd.DataFrame): Results from get_results_frame()
+        f (BinaryIO): File to write to
+        file_format (str): One of EXPORT_FORMATS
+    """
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f"Can't export {file_format}, expected one of {', '.join(EXPORT_FORMATS)}")
+    if file_format == 'csv':
+        for start in range(0, max(len(results), 1), EXPORT_CSV_CHUNK_ROWS):
+            f.write(results.iloc[start:start+EXPORT_CSV_CHUNK_ROWS].to_csv(index=False, header=(start == 0)).encode('utf-8'))
+    elif file_format == 'parquet':
+        results.to_parquet(f, index=False)
+    elif file_format == 'feather':
+        results.to_feather(f)
+
+def export_results(library: Library, file_format: str='csv') -> io.BytesIO:
+    """Function to export a library's integration results for a FileDownload widget
+
+    Returns:
+        io.BytesIO: Exported file, rewound to the start
+    """
+    bio = io.BytesIO()
+    write_results(get_results_frame(library), bio, file_format)
+    bio.seek(0)
+    return bio
@@ -1,7 +1,14 @@
 import panel as pn
 import hashlib
+import threading
+import traceback
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, Future
+from panel.io.state import set_curdoc
 from bokeh.server.contexts import BokehSessionContext
 
+from typing import Any, Callable, Dict, Optional
+
 def get_pn_id_token() -> str:
     """Returns id token from cookie"""
     hash_obj = hashlib.md5()
@@ -13,4 +20,260 @@ def get_id_token(session_context: BokehSessionContext) -> str:
     """Returns id token from cookie"""
     hash_obj = hashlib.md5()
     hash_obj.update(session_context.request.cookies['id_token'].encode('utf-8'))
-    return hash_obj.hexdigest()[:16]
\ No newline at end of file
+    return hash_obj.hexdigest()[:16]
+
+class RefreshScheduler:
+    """Coalesces view refresh requests from one session into a single render per view
+
+    Views marked dirty are refreshed together on the next tick of the session's event loop, in the order they
+    were registered, so a user action that requests the same view several times only renders it once.  Requests
+    with a delay are debounced, restarting the delay each time they are requested again, which keeps numeric
+    inputs from rendering on every keystroke.  A view that is marked dirty again while a refresh is running is
+    skipped by that refresh, since the next tick will render it with the newer state.  Outside of a server
+    session (e.g. in scripts), views are refreshed immediately.
+
+    Args:
+        views (Dict[str, Callable[[], None]]): Refresh callbacks by view name, in the order they are refreshed
+        status_text (pn.widgets.TextInput): Status widget to report refresh errors to
+        debug_text (pn.widgets.TextAreaInput): Debug widget to write refresh tracebacks to
+    """
+    def __init__(self, views: Dict[str, Callable[[], None]], status_text, debug_text):
+        self.views = dict(views)
+        self.status_text = status_text
+        self.debug_text = debug_text
+        self.doc = pn.state.curdoc
+        self.dirty = set()
+        self.tick_scheduled = False
+        self.debounce_callbacks = {}
+        self.lock = threading.Lock()
+
+    def has_session(self) -> bool:
+        return (self.doc is not None) and (self.doc.session_context is not None)
+
+    def mark(self, *names: str, delay: Optional[int]=None):
+        """Function to request a refresh of views
+
+        Args:
+            names (str): Names of the views to refresh
+            delay (int, optional): Debounce delay in milliseconds.  Defaults to refreshing on the next tick.
+        """
+        if not self.has_session():
+            self.dirty.update(names)
+            self.flush()
+            return
+        with self.lock:
+            for name in names:
+                #A newer request replaces any pending debounced one
+                if name in self.debounce_callbacks:
+                    self.doc.remove_timeout_callback(self.debounce_callbacks.pop(name))
+                if delay:
+                    self.debounce_callbacks[name] = self.doc.add_timeout_callback(partial(self.debounced, name), delay)
+                else:
+                    self.dirty.add(name)
+            if (len(self.dirty) > 0) and (not self.tick_scheduled):
+                self.tick_scheduled = True
+                self.doc.add_next_tick_callback(self.flush)
+
+    def debounced(self, name: str):
+        with self.lock:
+            self.debounce_callbacks.pop(name, None)
+        self.mark(name)
+
+    def flush(self):
+        """Function to refresh all views marked dirty"""
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+            self.tick_scheduled = False
+        with set_curdoc(self.doc):
+            for name, callback in self.views.items():
+                if (name not in dirty) or (name in self.dirty):
+                    continue
+                try:
+                    callback()
+                except Exception as e:
+                    self.status_text.value = f"refresh {name}: " + str(e)
+                    self.debug_text.value += traceback.format_exc() + "\n\n"
+
+class JobCancelledError(Exception):
+    """Raised inside a background job once it has been cancelled"""
+    pass
+
+#Thread pool for background jobs, shared by all sessions on the server and created on first use
+_job_executor = None
+_job_executor_lock = threading.Lock()
+
+def get_job_executor() -> ThreadPoolExecutor:
+    """Returns the server-wide background job thread pool, creating it if needed"""
+    global _job_executor
+    with _job_executor_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='sips-job')
+        return _job_executor
+
+class Job:
+    """Handle of a background job started by a JobRunner
+
+    The job's work function gets this handle, and should call set_progress() (or check_cancelled()) regularly
+    so it can be cancelled part way through.
+    """
+    def __init__(self, name: str, runner: 'JobRunner'):
+        self.name = name
+        self.runner = runner
+        self.cancel_event = threading.Event()
+        self.future: Optional[Future] = None
+        self.n_done = 0
+        self.n_total = 0
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def done(self) -> bool:
+        return (self.future is None) or self.future.done()
+
+    def check_cancelled(self):
+        """Raises JobCancelledError if the job has been cancelled"""
+        if self.cancel_event.is_set():
+            raise JobCancelledError(f"{self.name} cancelled")
+
+    def set_progress(self, n_done: int, n_total: int):
+        """Function to report the job's progress, which also stops the job if it has been cancelled
+
+        Args:
+            n_done (int): Number of items processed so far
+            n_total (int): Total number of items
+        """
+        self.check_cancelled()
+        self.n_done = n_done
+        self.n_total = n_total
+        self.runner.report_progress()
+
+class JobRunner:
+    """Runs long computations for one session in a background thread, so the session stays responsive
+
+    Only one job runs per session at a time.  The job's work function runs on the job thread pool and must not
+    touch widgets or the library's displayed state; its result is handed to the apply function on the session's
+    event loop once the work completes, so the changes land all at once.  Progress is pushed to the progress bar
+    on the next tick, at most once per tick.  A cancelled or failed job applies nothing.  Outside of a server
+    session (e.g. in scripts), jobs run immediately in the calling thread.
+
+    Args:
+        status_text (pn.widgets.TextInput): Status widget to report job state to
+        progress_bar (pn.indicators.Progress): Progress bar to report job progress to
+        debug_text (pn.widgets.TextAreaInput): Debug widget to write job tracebacks to
+        cancel_button (pn.widgets.Button, optional): Button which cancels the running job, only enabled while one runs
+    """
+    def __init__(self, status_text, progress_bar, debug_text, cancel_button=None):
+        self.status_text = status_text
+        self.progress_bar = progress_bar
+        self.debug_text = debug_text
+        self.cancel_button = cancel_button
+        self.doc = pn.state.curdoc
+        self.job: Optional[Job] = None
+        self.progress_scheduled = False
+        self.lock = threading.Lock()
+        if cancel_button is not None:
+            cancel_button.disabled = True
+            cancel_button.on_click(lambda event: self.cancel())
+
+    def has_session(self) -> bool:
+        return (self.doc is not None) and (self.doc.session_context is not None)
+
+    def busy(self) -> bool:
+        return self.job is not None
+
+    def call_soon(self, callback: Callable[[], None]):
+        #Runs the callback on the session's event loop, from any thread
+        if self.has_session():
+            self.doc.add_next_tick_callback(partial(self.run_in_doc, callback))
+        else:
+            callback()
+
+    def run_in_doc(self, callback: Callable[[], None]):
+        with set_curdoc(self.doc):
+            callback()
+
+    def submit(self, name: str, work: Callable[[Job], Any], apply: Callable[[Any], None]) -> Optional[Job]:
+        """Function to start a background job
+
+        Args:
+            name (str): Name of the job shown in the status text (e.g. "Integrating plate")
+            work (Callable[[Job], Any]): Computation to run in the background, which gets the job handle
+            apply (Callable[[Any], None]): Called with the work's result on the session's event loop
+
+        Returns:
+            Job: Handle of the started job, or None if another job is still running
+        """
+        if self.busy():
+            self.status_text.value = f"{self.job.name} is still running, wait for it or cancel it first"
+            return None
+        job = Job(name, self)
+        self.job = job
+        self.progress_bar.value = 0
+        self.status_text.value = f"{name}..."
+        if self.cancel_button is not None:
+            self.cancel_button.disabled = False
+        if self.has_session():
+            job.future = get_job_executor().submit(self.run, job, work, apply)
+        else:
+            self.run(job, work, apply)
+        return job
+
+    def run(self, job: Job, work: Callable[[Job], Any], apply: Callable[[Any], None]):
+        result = None
+        error = None
+        try:
+            result = work(job)
+        except JobCancelledError:
+            pass
+        except Exception as e:
+            error = (e, traceback.format_exc())
+        self.call_soon(partial(self.finish, job, apply, result, error))
+
+    def finish(self, job: Job, apply: Callable[[Any], None], result: Any, error):
+        if self.job is job:
+            self.job = None
+        if self.cancel_button is not None:
+            self.cancel_button.disabled = True
+        if job.cancelled:
+            self.progress_bar.value = 0
+            self.status_text.value = f"{job.name} cancelled"
+            return
+        if error is not None:
+            self.status_text.value = f"{job.name}: " + str(error[0])
+            self.debug_text.value += error[1] + "\n\n"
+            return
+        self.progress_bar.value = 100
+        try:
+            apply(result)
+        except Exception as e:
+            self.status_text.value = f"{job.name}: " + str(e)
+            self.debug_text.value += traceback.format_exc() + "\n\n"
+
+    def report_progress(self):
+        if not self.has_session():
+            self.update_progress()
+            return
+        with self.lock:
+            if self.progress_scheduled:
+                return
+            self.progress_scheduled = True
+        self.call_soon(self.update_progress)
+
+    def update_progress(self):
+        with self.lock:
+            self.progress_scheduled = False
+        job = self.job
+        if (job is not None) and (not job.cancelled) and (job.n_total > 0):
+            self.progress_bar.value = int(round(100 * job.n_done / job.n_total))
+            self.status_text.value = f"{job.name}... ({job.n_done}/{job.n_total})"
+
+    def cancel(self):
+        """Function to cancel the running job, if there is one"""
+        if self.job is not None:
+            self.job.cancel()
+            self.status_text.value = f"Cancelling {self.job.name}..."
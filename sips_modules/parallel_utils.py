@@ -0,0 +1,112 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from typing import List, Tuple, Optional, Callable
+
+from .PlateClass import Chromatogram, batch_process_peaks, warmup_kernels
+
+#Process pool shared by all sessions on the server, created on first use
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Returns the server-wide process pool, creating it if needed"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            #Spawn workers fresh instead of forking the running server and its threads, and have them load the numba kernels up front
+            _process_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('spawn'), initializer=warmup_kernels)
+        return _process_pool
+
+def shutdown_process_pool() -> None:
+    """Shuts down the server-wide process pool, if it was started"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(cancel_futures=True)
+            _process_pool = None
+
+def process_peak_tasks(tasks: List[Tuple[np.ndarray, np.ndarray, dict]]) -> List[dict]:
+    """Worker function to process a chunk of chromatograms in a separate process
+
+    Args:
+        tasks: List of (time, intensity, processing parameters) tuples
+
+    Returns:
+        List of peak result dictionaries, in the same order as tasks
+    """
+    chromatograms = [Chromatogram(time, intensity, **parameters) for time, intensity, parameters in tasks]
+    #These chromatograms only live for this task, so there's nothing to gain from caching their smoothing
+    batch_process_peaks(chromatograms, use_cache=False)
+    return [chrom.get_peak_results() for chrom in chromatograms]
+
+def parallel_peak_results(tasks: List[Tuple[np.ndarray, np.ndarray, dict]], chunk_size: int=8, progress_callback: Optional[Callable[[int, int], None]]=None) -> List[dict]:
+    """Function to compute peak results for many chromatograms on the server process pool
+
+    Tasks are sent to workers in chunks.  If the progress callback raises (e.g. because the job was cancelled),
+    the chunks which haven't started yet are cancelled and the exception is passed on.
+
+    Args:
+        tasks: List of (time, intensity, processing parameters) tuples
+        chunk_size: Number of tasks sent to a worker at a time
+        progress_callback: Called with (processed, total) as each chunk completes
+
+    Returns:
+        List of peak result dictionaries, in the same order as tasks
+    """
+    n_total = len(tasks)
+    results = [None] * n_total
+    if n_total == 0:
+        return results
+    pool = get_process_pool()
+    futures = {}
+    for start in range(0, n_total, chunk_size):
+        futures[pool.submit(process_peak_tasks, tasks[start:start+chunk_size])] = start
+    n_done = 0
+    try:
+        for future in as_completed(futures):
+            chunk_results = future.result()
+            start = futures[future]
+            results[start:start+len(chunk_results)] = chunk_results
+            n_done += len(chunk_results)
+            if progress_callback is not None:
+                progress_callback(n_done, n_total)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    return results
+
+def compute_peak_results(chromatograms: List[Chromatogram], parameters: dict, use_pool: bool=True, progress_callback: Optional[Callable[[int, int], None]]=None) -> List[dict]:
+    """Function to integrate chromatograms with new processing parameters, without modifying them
+
+    Processing runs on detached copies of the chromatograms, so it can run in a background thread while the
+    originals are still on display.  The returned values are applied in one go with chrom.set_peak_results(),
+    which keeps a cancelled or failed job from leaving a plate half-integrated.
+
+    Args:
+        chromatograms: Chromatograms to integrate
+        parameters: Keyword arguments for Chromatogram.set_processing_parameters()
+        use_pool: Whether to use the server process pool, or process the chromatograms in this thread
+        progress_callback: Called with (processed, total) as chromatograms complete
+
+    Returns:
+        List of processing parameter and peak result dictionaries, in the same order as chromatograms
+    """
+    detached = []
+    for chrom in chromatograms:
+        copy = Chromatogram(chrom.time, chrom.intensity, **chrom.get_processing_parameters())
+        copy.set_processing_parameters(**parameters)
+        detached.append(copy)
+    if use_pool:
+        tasks = [(chrom.time, chrom.intensity, chrom.get_processing_parameters()) for chrom in detached]
+        results = parallel_peak_results(tasks, progress_callback=progress_callback)
+    else:
+        batch_process_peaks(detached, progress_callback=progress_callback)
+        results = [chrom.get_peak_results() for chrom in detached]
+    #Peak results go last, since processing updates the retention time and peak bounds
+    return [{**chrom.get_processing_parameters(), **result} for chrom, result in zip(detached, results)]
@@ -0,0 +1,194 @@
+import numpy as np
+
+from typing import Tuple, Optional, List
+
+#Maximum number of points sent to the browser for all of the overlaid chromatograms together
+OVERLAY_POINT_BUDGET = 100000
+
+def get_overlay_bins(n_curves: int, plot_width: int) -> int:
+    """Function to get the number of min/max bins per curve, so the overlay stays within the point budget
+
+    Args:
+        n_curves (int): Number of overlaid curves
+        plot_width (int): Width of the plot in pixels, beyond which extra bins aren't visible
+
+    Returns:
+        int: Number of bins per curve
+    """
+    return max(50, min(plot_width, OVERLAY_POINT_BUDGET // (2 * max(n_curves, 1))))
+
+def get_visible_range(time: np.ndarray, x_range: Optional[Tuple[float, float]], offsets: np.ndarray) -> Tuple[int, int]:
+    """Function to get the index range of a sorted time axis which is visible for any of the offsets
+
+    Args:
+        time (np.ndarray): Sorted time axis
+        x_range (Tuple[float, float], optional): Visible (start, end) of the plot, or None for everything
+        offsets (np.ndarray): Offsets added to the time axis for each curve (e.g. drift corrections)
+
+    Returns:
+        Tuple[int, int]: Start and (exclusive) end indices, padded by one point so lines reach the plot edges
+    """
+    if (x_range is None) or (x_range[0] is None) or (x_range[1] is None) or (offsets.size == 0):
+        return 0, time.size
+    start = np.searchsorted(time, x_range[0] - offsets.max(), side='left') - 1
+    end = np.searchsorted(time, x_range[1] - offsets.min(), side='right') + 1
+    return int(max(start, 0)), int(min(max(end, start + 1), time.size))
+
+def minmax_decimation_indices(y: np.ndarray, start: int, end: int, n_bins: int) -> np.ndarray:
+    """Function to pick the points to draw for each row of y, keeping the minimum and maximum of each bin
+
+    All rows are binned identically over [start, end), so a whole stack of curves is decimated at once.
+    Keeping both extremes of every bin preserves peaks and the overall envelope when the curve is drawn.
+
+    Args:
+        y (np.ndarray): 2D array of curves, one per row
+        start (int): First index of the range to draw
+        end (int): End (exclusive) index of the range to draw
+        n_bins (int): Number of bins, so up to 2*n_bins points are kept per row
+
+    Returns:
+        np.ndarray: 2D array of sorted column indices into y for each row, including start and end - 1
+    """
+    n_points = end - start
+    if n_points <= 2 * n_bins:
+        return np.broadcast_to(np.arange(start, end), (y.shape[0], n_points))
+    bin_size = -(-n_points // n_bins)
+    n_bins = -(-n_points // bin_size)
+    #Pad the last bin by repeating the final point, which can't change its min/max
+    segment = np.pad(y[:,start:end], ((0, 0), (0, n_bins * bin_size - n_points)), mode='edge').reshape(y.shape[0], n_bins, bin_size)
+    bin_starts = np.arange(n_bins) * bin_size
+    min_inds = np.argmin(segment, axis=2) + bin_starts
+    max_inds = np.argmax(segment, axis=2) + bin_starts
+    inds = np.stack((np.minimum(min_inds, max_inds), np.maximum(min_inds, max_inds)), axis=2).reshape(y.shape[0], 2 * n_bins)
+    inds = np.minimum(inds, n_points - 1) + start
+    #Keep the end points, so the curve still spans the whole range
+    edges = np.broadcast_to(np.array([start, end - 1]), (y.shape[0], 2))
+    return np.hstack((edges[:,:1], inds, edges[:,1:]))
+
+def get_segment_indices(starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Function to get the indices of a [start, end) segment from each row of a 2D array, flattened together
+
+    Args:
+        starts (np.ndarray): Start index of each row's segment
+        ends (np.ndarray): End (exclusive) index of each row's segment
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Row and column indices of every point, one segment after another
+    """
+    lengths = ends - starts
+    rows = np.repeat(np.arange(starts.size), lengths)
+    segment_starts = np.cumsum(lengths) - lengths
+    cols = np.arange(lengths.sum()) - np.repeat(segment_starts - starts, lengths)
+    return rows, cols
+
+def get_integration_geometry(time: np.ndarray, intensity: np.ndarray, offsets: np.ndarray, bounds: np.ndarray, rts: np.ndarray) -> Tuple[List[np.ndarray], np.ndarray]:
+    """Function to get the integrated areas, baselines and height markers of many chromatograms at once
+
+    The baseline of each peak runs straight between the intensities at its bounds, and the height marker runs
+    from the baseline up to the intensity at the point closest to the peak's retention time.  Peaks with less
+    than two points are left out.
+
+    Args:
+        time (np.ndarray): Time axis shared by all rows, or a 2D array with one time axis per row
+        intensity (np.ndarray): 2D array of intensities, one chromatogram per row
+        offsets (np.ndarray): Drift offset of each row
+        bounds (np.ndarray): (rows, 2) array of [left, right) peak bound indices
+        rts (np.ndarray): Peak retention time of each row
+
+    Returns:
+        List[np.ndarray]: (N, 2) polygon outlining each integrated area
+        np.ndarray: (N, 2) array of all of the baseline and height marker lines, separated by NaN rows
+    """
+    keep = (bounds[:,1] - bounds[:,0]) >= 2
+    if not keep.any():
+        return [], np.zeros((0, 2))
+    starts, ends, offsets, rts = bounds[keep,0], bounds[keep,1], offsets[keep], rts[keep]
+    rows, cols = get_segment_indices(starts, ends)
+    data_rows = np.flatnonzero(keep)[rows]
+    x = (time[cols] if time.ndim == 1 else time[data_rows, cols]) + offsets[rows]
+    y_top = intensity[data_rows, cols].astype(np.float64)
+    #Straight baseline between the first and last point of each segment
+    lengths = ends - starts
+    firsts = np.cumsum(lengths) - lengths
+    lasts = firsts + lengths - 1
+    slopes = (y_top[lasts] - y_top[firsts]) / (x[lasts] - x[firsts])
+    baseline_y = y_top[firsts][rows] + (slopes[rows] * (x - x[firsts][rows]))
+    #Height marker at the point closest to the retention time, taking the first point on ties like np.argmin
+    order = np.lexsort((np.abs(x - rts[rows]), rows))
+    midpoints = order[firsts]
+    #Outline each area along the top and back along the baseline
+    split_points = firsts[1:]
+    polygons = [np.column_stack((np.concatenate((seg_x, seg_x[::-1])), np.concatenate((seg_top, seg_base[::-1]))))
+        for seg_x, seg_top, seg_base in zip(np.split(x, split_points), np.split(y_top, split_points), np.split(baseline_y, split_points))]
+    #Baselines then height markers, each ended by a NaN row so they are drawn as separate lines
+    n_segments = starts.size
+    line_x = np.concatenate((np.insert(x, lasts + 1, np.nan), np.column_stack((x[midpoints], x[midpoints], np.full(n_segments, np.nan))).ravel()))
+    line_y = np.concatenate((np.insert(baseline_y, lasts + 1, np.nan), np.column_stack((baseline_y[midpoints], y_top[midpoints], np.full(n_segments, np.nan))).ravel()))
+    return polygons, np.column_stack((line_x, line_y))
+
+#(rows, columns) of the supported well plate formats, from smallest to largest
+WELL_PLATE_LAYOUTS = ((8, 12), (16, 24), (32, 48))
+
+def get_row_label(row: int) -> str:
+    """Returns the letter label of a plate row, continuing A-Z with AA, AB, ... for 1536-well plates"""
+    if row < 26:
+        return chr(65 + row)
+    return chr(64 + (row // 26)) + chr(65 + (row % 26))
+
+def get_well_id(row: int, col: int) -> str:
+    """Returns the well ID (e.g. A01) of a zero-indexed row and column"""
+    return f"{get_row_label(row)}{str(col + 1).zfill(2)}"
+
+def parse_well_id(well: str) -> Tuple[int, int]:
+    """Function to get the zero-indexed row and column of a well ID like A01 or AF48
+
+    Returns: row, col
+    """
+    n_letters = len(well) - len(well.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+    if n_letters == 1:
+        row = ord(well[0]) - 65
+    else:
+        row = (26 * (ord(well[0]) - 64)) + (ord(well[1]) - 65)
+    return row, int(well[n_letters:]) - 1
+
+def get_plate_layout(well_ids) -> Tuple[int, int]:
+    """Function to get the smallest standard plate layout which fits all of the wells
+
+    Returns: n_rows, n_cols
+    """
+    positions = [parse_well_id(well) for well in well_ids]
+    max_row = max([row for row, _ in positions], default=0)
+    max_col = max([col for _, col in positions], default=0)
+    for n_rows, n_cols in WELL_PLATE_LAYOUTS:
+        if (max_row < n_rows) and (max_col < n_cols):
+            return n_rows, n_cols
+    return max_row + 1, max_col + 1
+
+def palette_to_lut(palette) -> np.ndarray:
+    """Function to convert a palette of hex colors (e.g. bokeh's Viridis256) to an (N, 3) uint8 lookup table"""
+    return np.array([[int(color[i:i+2], 16) for i in range(1, 7, 2)] for color in palette], dtype=np.uint8)
+
+def colorize_plate(values: np.ndarray, present: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    """Function to color a plate's values through a lookup table
+
+    Values are normalized between their min and max over the plate.  Wells without the compound are grey, and
+    wells which haven't been integrated (NaN) are white.  A single integrated well gets the top color.
+
+    Args:
+        values (np.ndarray): (rows, columns) array of values, NaN where not integrated
+        present (np.ndarray): (rows, columns) boolean array of wells which have the compound
+        lut (np.ndarray): (N, 3) uint8 color lookup table
+
+    Returns:
+        np.ndarray: (rows, columns, 3) uint8 RGB image, with the first row at the top
+    """
+    rgb_data = np.full(values.shape + (3,), 127, dtype=np.uint8)
+    integrated = present & ~np.isnan(values)
+    rgb_data[present & ~integrated] = 255
+    if integrated.sum() == 1:
+        rgb_data[integrated] = lut[-1]
+    elif integrated.any():
+        acts = values[integrated]
+        inds = np.round((lut.shape[0] - 1) * (acts - acts.min()) / (acts.max() - acts.min() + 1E-32), 0).astype(np.int64)
+        rgb_data[integrated] = lut[inds]
+    return rgb_data
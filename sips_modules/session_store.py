@@ -0,0 +1,425 @@
+import os
+import time
+import shutil
+import threading
+import traceback
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import numpy as np
+
+from typing import Any, Callable, Optional
+
+from sips_modules.PlateClass import Library
+from sips_modules.archive_utils import ArchiveFormatError, load_archive, recover_archive
+from sips_modules.autosave import LibraryJournal
+from sips_modules.empower_utils import EmpowerIngest
+
+#Per-user archives are named after the user's id token
+SESSION_ARCHIVE_EXTENSION = ".sipsarc"
+
+def get_array_nbytes(arr: np.ndarray, counted: set) -> int:
+    """Function to get the memory held by an array, counting each underlying buffer once
+
+    Arrays which are views of a memory-mapped archive aren't counted, since those pages belong to the page
+    cache and can be dropped by the OS at any time.
+
+    Args:
+        arr (np.ndarray): Array to be measured
+        counted (set): IDs of the buffers already counted, updated in place
+
+    Returns:
+        int: Bytes not already counted
+    """
+    if not isinstance(arr, np.ndarray):
+        return 0
+    while isinstance(arr.base, np.ndarray):
+        arr = arr.base
+    if (arr.base is not None) and not isinstance(arr.base, (bytes, bytearray)):
+        return 0
+    if id(arr) in counted:
+        return 0
+    counted.add(id(arr))
+    return arr.nbytes
+
+def get_library_nbytes(library: Library) -> int:
+    """Function to estimate the memory held by a library's arrays
+
+    Chromatograms of a lazily loaded library which haven't been accessed yet aren't built, so they aren't counted.
+
+    Args:
+        library (Library): Library to be measured
+
+    Returns:
+        int: Estimated size in bytes
+    """
+    counted = set()
+    nbytes = 0
+    for plate in list(library.plates.values()):
+        nbytes += get_array_nbytes(plate.parent_alignment, counted)
+        for table in list(plate.tables.values()):
+            nbytes += get_array_nbytes(table.intensity, counted) + get_array_nbytes(table.time, counted)
+        for well in list(plate.wells.values()):
+            #Read through dict, so unloaded lazy chromatograms aren't built just to be measured
+            for chrom in list(dict.values(well.chromatograms)):
+                if chrom is not None:
+                    nbytes += get_array_nbytes(chrom.time, counted) + get_array_nbytes(chrom.intensity, counted)
+            if well.sequencing is not None:
+                for key in ('forward_alignment', 'forward_abi_traces', 'reverse_alignment', 'reverse_abi_traces'):
+                    nbytes += get_array_nbytes(getattr(well.sequencing, key), counted)
+    return nbytes
+
+class SessionStore:
+    """Keeps each user's library in the token cache, spilling idle libraries to a per-user archive on disk
+
+    Entries are the dictionaries in pn.state.cache['id_tokens'], so modules keep reading their library from
+    there.  Each library is autosaved to its archive in store_dir through a LibraryJournal, which the background
+    thread checkpoints every autosave_interval.  While a user has sessions open, the journal's changes are captured
+    on a session's event loop, since that's where the library changes, and only written out by the background
+    thread.  Once a user's last session closes, their library is checkpointed one more time.  If the libraries
+    in memory then exceed the memory budget, the least recently used idle ones are dropped from memory, and
+    are restored lazily from their archive when the user opens a new session.  Archives outlive a server
+    restart.  Tokens which stay idle past their lifetime are removed, along with their archive.
+
+    Raw uploads are spooled under store_dir, and deleted once they're loaded, once the user has been idle for
+    spool_lifetime, or when their library is evicted.  Spools left over from before a restart are swept by start().
+
+    Args:
+        entries (dict): Token entries, normally pn.state.cache['id_tokens']
+        store_dir (str): Folder of the per-user archives
+        memory_budget (int): Bytes of library data to keep in memory before idle libraries are evicted
+        lifetime (float): Seconds a token is kept after its last session closes
+        reap_interval (float): Seconds between reaper passes
+        autosave_interval (float): Seconds between autosave checkpoints
+        compact_ratio (float): Compact an archive once its replaced blocks exceed this multiple of its live data
+        spool_lifetime (float): Seconds an idle user's unfinished uploads are kept, so they can be resumed
+        session_timeout (float): Seconds to wait for a busy session's event loop before skipping its autosave
+    """
+    def __init__(self, entries: dict, store_dir: str, memory_budget: int, lifetime: float=1000000, reap_interval: float=300,
+        autosave_interval: float=30, compact_ratio: float=1.0, spool_lifetime: float=3600, session_timeout: float=10):
+        self.entries = entries
+        self.store_dir = store_dir
+        self.memory_budget = memory_budget
+        self.lifetime = lifetime
+        self.reap_interval = reap_interval
+        self.autosave_interval = autosave_interval
+        self.compact_ratio = compact_ratio
+        self.spool_lifetime = spool_lifetime
+        self.spool_dir = os.path.join(store_dir, 'spool')
+        self.session_timeout = session_timeout
+        self.lock = threading.RLock()
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.reaper = None
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def get_archive_path(self, id_token: str) -> str:
+        return os.path.join(self.store_dir, id_token + SESSION_ARCHIVE_EXTENSION)
+
+    def restore_library(self, id_token: str) -> Optional[Library]:
+        """Function to lazily load a user's library from their archive
+
+        Returns:
+            Library: Restored library, or None if there is no usable archive
+        """
+        file_path = self.get_archive_path(id_token)
+        if not os.path.exists(file_path):
+            return None
+        library = Library()
+        try:
+            try:
+                load_archive(library, file_path, lazy=True)
+            except ArchiveFormatError:
+                #An autosave may have been cut off, so fall back to the last complete checkpoint
+                if not recover_archive(file_path):
+                    raise
+                print(f"Recovered library for {id_token} from its last complete checkpoint")
+                load_archive(library, file_path, lazy=True)
+        except (ArchiveFormatError, ValueError, OSError):
+            #Keep the broken archive around for inspection, but don't try it again
+            print(f"Could not restore library for {id_token}:\n{traceback.format_exc()}")
+            os.replace(file_path, file_path + ".broken")
+            return None
+        return library
+
+    def open_session(self, id_token: str) -> bool:
+        """Function to get a user's entry ready for a new session, restoring their library if it was evicted
+
+        Args:
+            id_token (str): User's id token
+
+        Returns:
+            bool: Whether a previous library was found, in memory or on disk
+        """
+        with self.lock:
+            entry = self.entries.get(id_token)
+            if entry is None:
+                entry = self.entries[id_token] = {'library': None, 'journal': None, 'sessions': 0}
+            if 'ingest' not in entry:
+                entry['ingest'] = EmpowerIngest(spool_root=self.spool_dir)
+            found = entry['library'] is not None
+            if not found:
+                entry['library'] = self.restore_library(id_token)
+                found = entry['library'] is not None
+                if not found:
+                    entry['library'] = Library()
+                #A restored library already matches its archive, so only its changes need to be journaled
+                entry['journal'] = LibraryJournal(entry['library'], self.get_archive_path(id_token), clean=found, compact_ratio=self.compact_ratio)
+            entry['sessions'] += 1
+            entry['persisted'] = False
+            entry['last_used'] = time.time()
+            entry['lifetime'] = entry['last_used'] + self.lifetime
+        return found
+
+    def close_session(self, id_token: str):
+        """Function to release a user's session, letting the reaper save their library once they're idle"""
+        with self.lock:
+            entry = self.entries.get(id_token)
+            if entry is None:
+                return
+            entry['sessions'] = max(entry['sessions'] - 1, 0)
+            entry['last_used'] = time.time()
+            entry['lifetime'] = entry['last_used'] + self.lifetime
+            idle = entry['sessions'] == 0
+        if idle:
+            self.wake_event.set()
+
+    def attach_document(self, id_token: str, doc):
+        """Function to register the document of a user's session, whose event loop their library is read from"""
+        with self.lock:
+            entry = self.entries.get(id_token)
+            if entry is not None:
+                entry['documents'] = [d for d in entry.get('documents', []) if self.is_live(d)] + [doc]
+
+    @staticmethod
+    def is_live(doc) -> bool:
+        session_context = doc.session_context
+        return (session_context is not None) and not session_context.destroyed
+
+    def call_in_session(self, id_token: str, func: Callable[[], Any]) -> Any:
+        """Function to run a function on the event loop of a user's session, and wait for its result
+
+        The library of a user with open sessions is changed on their sessions' event loop, so reading it from
+        there never sees it half-changed.  The libraries of idle users don't change, so the function is run directly.
+
+        Args:
+            id_token (str): User's id token
+            func (Callable[[], Any]): Function to run
+
+        Returns:
+            Any: Result of the function
+
+        Raises:
+            TimeoutError: If the user's sessions are too busy to run the function within session_timeout
+        """
+        with self.lock:
+            entry = self.entries.get(id_token)
+            active = (entry is not None) and (entry['sessions'] > 0)
+            docs = [doc for doc in entry.get('documents', []) if self.is_live(doc)] if active else []
+        if not active:
+            return func()
+        if len(docs) == 0:
+            raise TimeoutError("The session hasn't started yet")
+        future = Future()
+        def run():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func())
+                except BaseException as e:
+                    future.set_exception(e)
+        #The only document method which is safe to call from another thread
+        docs[0].add_next_tick_callback(run)
+        try:
+            return future.result(timeout=self.session_timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError(f"The session was busy for over {self.session_timeout} s")
+
+    def persist(self, id_token: str, direct: bool=False) -> bool:
+        """Function to checkpoint a user's library to their archive
+
+        Args:
+            id_token (str): User's id token
+            direct (bool): Read the library from this thread even if the user has open sessions, e.g. once the
+                server has stopped running them
+
+        Returns:
+            bool: Whether the archive is up to date
+        """
+        with self.lock:
+            entry = self.entries.get(id_token)
+            journal = None if entry is None else entry['journal']
+        if journal is None:
+            return False
+        try:
+            plan = journal.prepare() if direct else self.call_in_session(id_token, journal.prepare)
+            journal.write(plan)
+        except TimeoutError as e:
+            #Saved on the next pass instead
+            print(f"Skipped saving library for {id_token}: {e}")
+            return False
+        except Exception:
+            print(f"Could not save library for {id_token}:\n{traceback.format_exc()}")
+            return False
+        return True
+
+    def autosave(self, direct: bool=False):
+        """Function to checkpoint every library in memory with unsaved changes
+
+        Args:
+            direct (bool): Read libraries from this thread, see persist()
+        """
+        with self.lock:
+            journals = [(id_token, entry['journal']) for id_token, entry in self.entries.items() if entry['journal'] is not None]
+        for id_token, journal in journals:
+            #Structural changes (new plates/wells) aren't recorded by watchers, so active users are always checked
+            self.persist(id_token, direct)
+
+    def evict(self, id_token: str, library: Library) -> bool:
+        """Function to drop an idle library from memory, along with any spooled uploads, as long as it hasn't been reopened since it was saved"""
+        with self.lock:
+            entry = self.entries.get(id_token)
+            if (entry is None) or (entry['sessions'] > 0) or (entry['library'] is not library) or not entry['persisted']:
+                return False
+            entry['library'] = None
+            journal, entry['journal'] = entry['journal'], None
+            ingest = entry.pop('ingest', None)
+        journal.close()
+        if ingest is not None:
+            ingest.reset()
+        return True
+
+    def drop_spool(self, id_token: str, now: float) -> bool:
+        """Function to delete an idle user's unfinished uploads once they're past the spool lifetime
+
+        Returns:
+            bool: Whether anything was deleted
+        """
+        with self.lock:
+            entry = self.entries.get(id_token)
+            if (entry is None) or (entry['sessions'] > 0) or (entry['last_used'] + self.spool_lifetime >= now):
+                return False
+            ingest = entry.get('ingest')
+            if (ingest is None) or (ingest.spool_dir is None):
+                return False
+            ingest.reset()
+        return True
+
+    def remove(self, id_token: str, now: Optional[float]=None) -> bool:
+        """Function to forget a user, deleting their archive and any spooled uploads
+
+        Args:
+            id_token (str): User's id token
+            now (float, optional): Only remove the user if they have expired by this time
+
+        Returns:
+            bool: Whether the user was removed
+        """
+        file_path = self.get_archive_path(id_token)
+        with self.lock:
+            entry = self.entries.get(id_token)
+            if now is not None:
+                if entry is None:
+                    expired = os.path.exists(file_path) and (os.path.getmtime(file_path) + self.lifetime < now)
+                else:
+                    expired = (entry['sessions'] == 0) and (entry['lifetime'] < now)
+                if not expired:
+                    return False
+            self.entries.pop(id_token, None)
+            if (entry is not None) and (entry['journal'] is not None):
+                entry['journal'].close()
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+        if (entry is not None) and ('ingest' in entry):
+            entry['ingest'].reset()
+        return True
+
+    def reap(self):
+        """Function to run one reaper pass: remove expired users, save idle libraries, then enforce the memory budget"""
+        now = time.time()
+        with self.lock:
+            snapshot = {id_token: dict(entry) for id_token, entry in self.entries.items()}
+
+        #Expired tokens, including archives left over from before a restart
+        id_tokens = set(snapshot) | {filename[:-len(SESSION_ARCHIVE_EXTENSION)] for filename in os.listdir(self.store_dir) if filename.endswith(SESSION_ARCHIVE_EXTENSION)}
+        for id_token in id_tokens:
+            if self.remove(id_token, now):
+                print(f"EXPIRED: {id_token}")
+
+        #Unfinished uploads which weren't resumed in time
+        for id_token in snapshot:
+            if self.drop_spool(id_token, now):
+                print(f"DROPPED UPLOADS: {id_token}")
+
+        #Save libraries which went idle since the last pass
+        idle = []
+        for id_token, entry in snapshot.items():
+            if (id_token not in self.entries) or (entry['library'] is None) or (entry['sessions'] > 0):
+                continue
+            if not entry['persisted']:
+                if not self.persist(id_token):
+                    continue
+                with self.lock:
+                    current = self.entries.get(id_token)
+                    if (current is not None) and (current['sessions'] == 0) and (current['library'] is entry['library']):
+                        current['persisted'] = True
+            idle.append((entry['last_used'], id_token, entry['library']))
+
+        #Evict the least recently used idle libraries until everything in memory fits the budget
+        total = sum(get_library_nbytes(entry['library']) for entry in snapshot.values() if entry['library'] is not None)
+        for _, id_token, library in sorted(idle, key=lambda x: x[0]):
+            if total <= self.memory_budget:
+                break
+            nbytes = get_library_nbytes(library)
+            if self.evict(id_token, library):
+                print(f"EVICTED: {id_token} ({nbytes / (1 << 20):.1f} MB)")
+                total -= nbytes
+
+    def run_reaper(self):
+        last_reap = 0
+        while not self.stop_event.is_set():
+            try:
+                self.autosave()
+                #Sessions closing wake the reaper early, so idle libraries are saved and evicted promptly
+                if self.wake_event.is_set() or (time.time() - last_reap >= self.reap_interval):
+                    self.wake_event.clear()
+                    self.reap()
+                    last_reap = time.time()
+            except Exception:
+                print(f"Session reaper failed:\n{traceback.format_exc()}")
+            self.wake_event.wait(min(self.autosave_interval, self.reap_interval))
+
+    def sweep_spool(self):
+        """Function to delete uploads spooled before a restart, which no session can resume"""
+        with self.lock:
+            active = {entry['ingest'].spool_dir for entry in self.entries.values() if entry.get('ingest') is not None}
+        if not os.path.isdir(self.spool_dir):
+            return
+        for filename in os.listdir(self.spool_dir):
+            path = os.path.join(self.spool_dir, filename)
+            if path not in active:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def start(self):
+        """Function to sweep leftover uploads, then start the background thread which autosaves libraries and runs the reaper"""
+        if (self.reaper is None) or not self.reaper.is_alive():
+            self.sweep_spool()
+            self.stop_event.clear()
+            self.reaper = threading.Thread(target=self.run_reaper, name="sips-session-reaper", daemon=True)
+            self.reaper.start()
+
+    def stop(self, persist: bool=True):
+        """Function to stop the reaper, saving every library still in memory so it survives a restart
+
+        Args:
+            persist (bool): Save libraries of idle and active users before returning
+        """
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.reaper is not None:
+            self.reaper.join()
+            self.reaper = None
+        if persist:
+            #The server isn't running sessions anymore, so nothing else changes the libraries
+            self.autosave(direct=True)
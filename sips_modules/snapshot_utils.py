@@ -0,0 +1,145 @@
+import io
+import os
+import mmap
+import pickle
+import struct
+
+import numpy as np
+
+from .PlateClass import Library, Plate, Well, Chromatogram, Sequencing
+
+#SIPS snapshot layout:
+#  Header:  magic (8s), version (uint16), reserved (uint16), buffer count (uint32), pickle length (uint64)
+#  Buffer lengths: uint64 per buffer
+#  Pickle:  protocol 5 pickle of the library state, made only of builtins and numpy arrays/scalars
+#  Buffers: the arrays' data, written out-of-band and each aligned to SNAPSHOT_ALIGNMENT
+#Arrays never pass through the pickle stream, so saving writes them straight from memory, and loading maps them
+#straight from the file without copying.
+SNAPSHOT_MAGIC = b'SIPSSNP\x00'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<8sHHIQ')
+SNAPSHOT_ALIGNMENT = 64
+
+#Globals a snapshot pickle is allowed to reference, which are all numpy array and scalar reconstructors
+SNAPSHOT_GLOBALS = {
+    ('numpy', 'dtype'), ('numpy', 'ndarray'),
+    ('numpy.core.numeric', '_frombuffer'), ('numpy._core.numeric', '_frombuffer'),
+    ('numpy.core.multiarray', '_reconstruct'), ('numpy._core.multiarray', '_reconstruct'),
+    ('numpy.core.multiarray', 'scalar'), ('numpy._core.multiarray', 'scalar'),
+}
+
+class SnapshotFormatError(Exception):
+    pass
+
+class SnapshotUnpickler(pickle.Unpickler):
+    """Unpickler which refuses anything besides builtins and numpy arrays/scalars, so loading a snapshot can't run code"""
+    def find_class(self, module: str, name: str):
+        if (module, name) not in SNAPSHOT_GLOBALS:
+            raise SnapshotFormatError(f"Snapshot references forbidden global {module}.{name}")
+        return super().find_class(module, name)
+
+def get_parameter_values(obj) -> dict:
+    """Returns all parameters of a Parameterized object besides its name, so new parameters are snapshotted automatically"""
+    return {key: value for key, value in obj.param.values().items() if key != 'name'}
+
+def get_library_state(library: Library) -> dict:
+    """Function to get a library's full state as plain dictionaries, lists, and arrays
+
+    Chromatogram arrays are referenced, not copied, and arrays shared between chromatograms (like a table's
+    time axis) are only stored once.
+
+    Args:
+        library (Library): Library to be snapshotted
+
+    Returns:
+        dict: Library state
+    """
+    plates = {}
+    for plate_name in library:
+        plate = library[plate_name]
+        wells = {}
+        for well_name in plate:
+            well = plate[well_name]
+            wells[well_name] = {
+                'sequencing': None if well.sequencing is None else get_parameter_values(well.sequencing),
+                'chromatograms': {compound: get_parameter_values(well[compound]) for compound in well},
+            }
+        plates[plate_name] = {'compounds': list(plate.compounds), 'parent_alignment': plate.parent_alignment, 'wells': wells}
+    return {'compounds': list(library.compounds), 'plates': plates}
+
+def build_plates(state: dict) -> dict:
+    """Function to build plates from a library state made by get_library_state()"""
+    plates = {}
+    for plate_name, plate_state in state['plates'].items():
+        plate = Plate(compounds=plate_state['compounds'], parent_alignment=plate_state['parent_alignment'])
+        for well_name, well_state in plate_state['wells'].items():
+            plate[well_name] = Well()
+            if well_state['sequencing'] is not None:
+                plate[well_name].sequencing = Sequencing(**well_state['sequencing'])
+            for compound, params in well_state['chromatograms'].items():
+                chrom = Chromatogram(params['time'], params['intensity'])
+                #Skip any parameters this version of SIPS doesn't know about
+                chrom.param.update(**{key: value for key, value in params.items() if (key in chrom.param) and (key not in ('time', 'intensity'))})
+                plate[well_name][compound] = chrom
+        plates[plate_name] = plate
+    return plates
+
+def save_snapshot(library: Library, file_path: str) -> None:
+    """Function to save a library's full state as a SIPS snapshot
+
+    Args:
+        library (Library): Library to be saved
+        file_path (str): Path of the snapshot, which is replaced if it exists
+    """
+    buffers = []
+    payload = pickle.dumps(get_library_state(library), protocol=5, buffer_callback=buffers.append)
+    raw_buffers = [buffer.raw() for buffer in buffers]
+    #Written to a temporary file first, since a loaded library may still be reading from file_path
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'wb', buffering=1 << 20) as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, len(raw_buffers), len(payload)))
+        f.write(np.array([raw.nbytes for raw in raw_buffers], dtype='<u8').tobytes())
+        f.write(payload)
+        for raw in raw_buffers:
+            f.write(bytes(-f.tell() % SNAPSHOT_ALIGNMENT))
+            f.write(raw)
+    os.replace(temp_path, file_path)
+
+def load_snapshot(library: Library, file_path: str) -> None:
+    """Function to replace a library's contents with a SIPS snapshot
+
+    The library object itself is kept, so every module holding it sees the loaded plates.  Arrays are
+    copy-on-write views of the memory-mapped snapshot, so they are only read in from disk as they're used.
+
+    Args:
+        library (Library): Library to load the snapshot into
+        file_path (str): Path of the snapshot
+    """
+    with open(file_path, 'rb') as f:
+        bin_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    if len(bin_data) < SNAPSHOT_HEADER.size:
+        raise SnapshotFormatError("File is too small to be a SIPS snapshot")
+    magic, version, _, n_buffers, payload_length = SNAPSHOT_HEADER.unpack_from(bin_data, 0)
+    if magic != SNAPSHOT_MAGIC:
+        raise SnapshotFormatError("File is not a SIPS snapshot")
+    if version > SNAPSHOT_VERSION:
+        raise SnapshotFormatError(f"Snapshot version {version} is newer than this version of SIPS supports")
+
+    offset = SNAPSHOT_HEADER.size
+    lengths = np.frombuffer(bin_data, dtype='<u8', count=n_buffers, offset=offset)
+    offset += lengths.nbytes
+    payload = bin_data[offset:offset+payload_length]
+    offset += payload_length
+    view = memoryview(bin_data)
+    buffers = []
+    for length in lengths.tolist():
+        offset += -offset % SNAPSHOT_ALIGNMENT
+        if offset + length > len(bin_data):
+            raise SnapshotFormatError("Snapshot is truncated")
+        buffers.append(view[offset:offset+length])
+        offset += length
+
+    #Build everything before touching the library, so a bad snapshot doesn't leave it half-loaded
+    state = SnapshotUnpickler(io.BytesIO(payload), buffers=buffers).load()
+    plates = build_plates(state)
+    library.param.update(plates=plates, compounds=list(state['compounds']))
@@ -0,0 +1,25 @@
+import numpy as np
+
+from sips_modules.alignment_utils import get_drift_offsets
+
+def make_drifted_traces(drifts: np.ndarray, peak_width: float=0.05, seed: int=0):
+    rng = np.random.default_rng(seed)
+    time = np.arange(0, 10, 0.005)
+    intensity = np.vstack([100*np.exp(-0.5*((time - 5 - drift)/peak_width)**2) + rng.normal(0, 1, time.size) for drift in drifts])
+    return time, intensity, np.full(len(drifts), time.size)
+
+def test_median_reference_drift_larger_than_peak_width():
+    #Drift of up to 8 peak widths, where an unaligned median of the traces is nearly flat
+    drifts = np.random.default_rng(3).uniform(-0.4, 0.4, 24)
+    time, intensity, lengths = make_drifted_traces(drifts)
+    offsets = get_drift_offsets(time, intensity, lengths, np.arange(drifts.size), 3.7, 6.3, 3)
+    residuals = drifts + offsets
+    assert np.ptp(residuals) < 0.01
+    assert np.abs(offsets).max() < 0.5
+
+def test_chosen_reference_gets_no_offset():
+    drifts = np.random.default_rng(4).uniform(-0.4, 0.4, 24)
+    time, intensity, lengths = make_drifted_traces(drifts)
+    offsets = get_drift_offsets(time, intensity, lengths, np.arange(drifts.size), 3.7, 6.3, 3, reference_row=5)
+    assert abs(offsets[5]) < 0.005
+    assert np.abs(drifts + offsets - drifts[5]).max() < 0.01
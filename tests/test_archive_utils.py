@@ -0,0 +1,167 @@
+import os
+
+import numpy as np
+import pytest
+
+from sips_modules.PlateClass import Library, Plate, Well, Chromatogram, Sequencing, LazyChromatogramDict
+from sips_modules.archive_utils import (
+    ArchiveFormatError, ArchiveChecksumError, read_toc, save_archive, append_archive, load_archive, recover_archive, list_archive_plates
+)
+from sips_modules.autosave import LibraryJournal
+
+def make_plate(seed: int, compounds=('A', 'B'), wells=('A1', 'A2', 'B1')) -> Plate:
+    rng = np.random.default_rng(seed)
+    plate = Plate(compounds=list(compounds), parent_alignment=rng.integers(0, 4, 30).astype(np.uint8))
+    time = np.linspace(0, 10, 200)
+    for i, well in enumerate(wells):
+        plate[well] = Well()
+        for compound in compounds:
+            chrom = Chromatogram(time, rng.normal(0, 1, time.size), sample_name=f"sample_{i}", source="test")
+            chrom.param.update(drift_offset=0.1*i, peak_area=float(i), peak_bound_inds=[i, i + 10], rt=5.0)
+            plate[well][compound] = chrom
+    plate[wells[0]].sequencing = Sequencing(forward_alignment=rng.integers(0, 4, 30).astype(np.uint8))
+    return plate
+
+def make_library(n_plates: int=2) -> Library:
+    library = Library()
+    for i in range(n_plates):
+        library[f"plate_{i}"] = make_plate(i)
+    library.compounds = ['A', 'B']
+    return library
+
+def assert_libraries_equal(expected: Library, actual: Library):
+    assert list(actual) == list(expected)
+    for plate in expected:
+        assert actual[plate].compounds == expected[plate].compounds
+        np.testing.assert_array_equal(actual[plate].parent_alignment, expected[plate].parent_alignment)
+        assert list(actual[plate]) == list(expected[plate])
+        for well in expected[plate]:
+            assert (actual[plate][well].sequencing is None) == (expected[plate][well].sequencing is None)
+            if expected[plate][well].sequencing is not None:
+                np.testing.assert_array_equal(actual[plate][well].sequencing.forward_alignment, expected[plate][well].sequencing.forward_alignment)
+            assert list(actual[plate][well]) == list(expected[plate][well])
+            for compound in expected[plate][well]:
+                chrom, loaded = expected[plate][well][compound], actual[plate][well][compound]
+                np.testing.assert_array_equal(loaded.time, chrom.time)
+                np.testing.assert_array_equal(loaded.intensity, chrom.intensity)
+                for key in ('sample_name', 'source', 'drift_offset', 'peak_area', 'rt'):
+                    assert getattr(loaded, key) == getattr(chrom, key)
+                assert list(loaded.peak_bound_inds) == list(chrom.peak_bound_inds)
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_save_load_round_trip(tmp_path, lazy):
+    library = make_library()
+    file_path = str(tmp_path / "library.sipsarc")
+    save_archive(library, file_path)
+    loaded = Library()
+    load_archive(loaded, file_path, lazy=lazy)
+    well = loaded['plate_0']['A1']
+    assert isinstance(well.chromatograms, LazyChromatogramDict) == lazy
+    if lazy:
+        assert dict.get(well.chromatograms, 'A') is None
+    assert_libraries_equal(library, loaded)
+    assert loaded.compounds == ['A', 'B']
+
+def test_load_selected_plates(tmp_path):
+    library = make_library(3)
+    file_path = str(tmp_path / "library.sipsarc")
+    save_archive(library, file_path)
+    loaded = Library()
+    load_archive(loaded, file_path, plates=['plate_2'])
+    assert list(loaded) == ['plate_2']
+    with pytest.raises(ValueError):
+        load_archive(loaded, file_path, plates=['missing'])
+
+def test_append_adds_and_replaces_plates(tmp_path):
+    library = make_library()
+    file_path = str(tmp_path / "library.sipsarc")
+    save_archive(library, file_path)
+    size = os.path.getsize(file_path)
+    library['plate_2'] = make_plate(2)
+    library['plate_0'] = make_plate(10)
+    append_archive(library, file_path, ['plate_2', 'plate_0'])
+    assert os.path.getsize(file_path) > size
+    assert list_archive_plates(file_path) == ['plate_0', 'plate_1', 'plate_2']
+    loaded = Library()
+    load_archive(loaded, file_path)
+    assert_libraries_equal(library, loaded)
+
+def test_journal_params_only_blocks(tmp_path):
+    library = make_library()
+    file_path = str(tmp_path / "library.sipsarc")
+    journal = LibraryJournal(library, file_path)
+    assert journal.checkpoint()
+    old_entry = journal.toc['plates']['plate_1']['wells']['B1']['chromatograms']['A']
+    chrom = library['plate_1']['B1']['A']
+    chrom.param.update(peak_area=42.0, peak_bound_inds=[7, 70])
+    assert journal.checkpoint()
+    #Only a parameter block is appended, the arrays aren't rewritten
+    entry = journal.toc['plates']['plate_1']['wells']['B1']['chromatograms']['A']
+    assert entry['offset'] == old_entry['offset']
+    assert entry['params']['length'] < chrom.intensity.nbytes
+    assert not journal.checkpoint()
+    journal.close()
+
+    for lazy in (False, True):
+        loaded = Library()
+        load_archive(loaded, file_path, lazy=lazy)
+        assert_libraries_equal(library, loaded)
+
+def test_journal_data_change_rewrites_arrays(tmp_path):
+    library = make_library(1)
+    file_path = str(tmp_path / "library.sipsarc")
+    journal = LibraryJournal(library, file_path)
+    journal.checkpoint()
+    size = os.path.getsize(file_path)
+    chrom = library['plate_0']['A2']['B']
+    chrom.intensity = chrom.intensity * 2
+    journal.checkpoint()
+    assert os.path.getsize(file_path) - size > chrom.intensity.nbytes
+    journal.close()
+    loaded = Library()
+    load_archive(loaded, file_path)
+    assert_libraries_equal(library, loaded)
+
+def test_recover_truncated_append(tmp_path):
+    library = make_library()
+    file_path = str(tmp_path / "library.sipsarc")
+    save_archive(library, file_path)
+    size = os.path.getsize(file_path)
+    library['plate_2'] = make_plate(2)
+    append_archive(library, file_path, ['plate_2'])
+    #Cut the append off partway, as if the server died while autosaving
+    with open(file_path, 'r+b') as f:
+        f.truncate(size + (os.path.getsize(file_path) - size) // 2)
+    with pytest.raises(ArchiveFormatError):
+        load_archive(Library(), file_path)
+    assert recover_archive(file_path)
+    assert os.path.getsize(file_path) == size
+    loaded = Library()
+    load_archive(loaded, file_path)
+    assert_libraries_equal(Library(plates={plate: library[plate] for plate in ('plate_0', 'plate_1')}), loaded)
+
+def test_recover_without_any_table_of_contents(tmp_path):
+    library = make_library(1)
+    file_path = str(tmp_path / "library.sipsarc")
+    save_archive(library, file_path)
+    with open(file_path, 'r+b') as f:
+        f.truncate(os.path.getsize(file_path) // 2)
+    assert not recover_archive(file_path)
+
+def test_corrupt_block_fails_checksum(tmp_path):
+    library = make_library(1)
+    file_path = str(tmp_path / "library.sipsarc")
+    save_archive(library, file_path)
+    with open(file_path, 'rb') as f:
+        entry = read_toc(f.read())['plates']['plate_0']['wells']['A2']['chromatograms']['B']
+    with open(file_path, 'r+b') as f:
+        f.seek(entry['offset'] + entry['length'] - 8)
+        f.write(b'\xff' * 8)
+    with pytest.raises(ArchiveChecksumError):
+        load_archive(Library(), file_path)
+    #Lazy loads only check a chromatogram's block once it's built
+    loaded = Library()
+    load_archive(loaded, file_path, lazy=True)
+    loaded['plate_0']['A1']['A']
+    with pytest.raises(ArchiveChecksumError):
+        loaded['plate_0']['A2']['B']
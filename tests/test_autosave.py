@@ -0,0 +1,46 @@
+import os
+
+from sips_modules.PlateClass import Library
+from sips_modules.archive_utils import load_archive
+from sips_modules.autosave import LibraryJournal
+
+from .test_archive_utils import make_library, assert_libraries_equal
+
+def count_unloaded(library: Library) -> int:
+    return sum(dict.get(library[plate][well].chromatograms, compound) is None for plate in library for well in library[plate] for compound in library[plate][well].chromatograms)
+
+def test_compaction_keeps_lazy_chromatograms_unloaded(tmp_path):
+    file_path = str(tmp_path / "library.sipsarc")
+    expected = make_library()
+    journal = LibraryJournal(expected, file_path)
+    journal.checkpoint()
+    journal.close()
+
+    library = Library()
+    load_archive(library, file_path, lazy=True)
+    n_unloaded = count_unloaded(library)
+    journal = LibraryJournal(library, file_path, clean=True, compact_ratio=0)
+    chrom = library['plate_0']['A1']['A']
+    chrom.param.update(peak_area=7.0)
+    expected['plate_0']['A1']['A'].param.update(peak_area=7.0)
+    #The table of contents replaced by this checkpoint is dead space, so it compacts straight away
+    assert journal.checkpoint()
+    assert journal.file_size == os.path.getsize(file_path) == journal.get_live_size()
+    assert count_unloaded(library) == n_unloaded - 1
+    journal.close()
+
+    reloaded = Library()
+    load_archive(reloaded, file_path)
+    assert_libraries_equal(expected, reloaded)
+    #Chromatograms which still weren't loaded read from the archive they were restored from
+    assert_libraries_equal(expected, library)
+
+def test_no_compaction_without_dead_space(tmp_path):
+    file_path = str(tmp_path / "library.sipsarc")
+    library = make_library()
+    journal = LibraryJournal(library, file_path, compact_ratio=0)
+    journal.checkpoint()
+    size = os.path.getsize(file_path)
+    assert not journal.checkpoint()
+    assert os.path.getsize(file_path) == size
+    journal.close()
@@ -0,0 +1,78 @@
+import os
+import queue
+import threading
+
+from sips_modules.PlateClass import Library
+from sips_modules.archive_utils import load_archive
+from sips_modules.session_store import SessionStore
+
+from .test_archive_utils import make_plate, assert_libraries_equal
+
+class FakeSessionContext:
+    destroyed = False
+
+class FakeDocument:
+    """Stands in for a Bokeh document, running next tick callbacks on its own event loop thread"""
+    def __init__(self):
+        self.session_context = FakeSessionContext()
+        self.callbacks = queue.Queue()
+        self.threads = set()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            callback = self.callbacks.get()
+            if callback is None:
+                return
+            callback()
+
+    def add_next_tick_callback(self, callback):
+        self.callbacks.put(callback)
+
+    def stop(self):
+        self.callbacks.put(None)
+        self.thread.join()
+
+def test_active_library_is_read_on_session_event_loop(tmp_path, monkeypatch):
+    store = SessionStore({}, str(tmp_path), memory_budget=1 << 30)
+    store.open_session('user')
+    doc = FakeDocument()
+    store.attach_document('user', doc)
+    library = store.entries['user']['library']
+    library['plate_0'] = make_plate(0)
+    journal = store.entries['user']['journal']
+
+    threads = {}
+    prepare, write = journal.prepare, journal.write
+    monkeypatch.setattr(journal, 'prepare', lambda: threads.setdefault('prepare', threading.current_thread()) and prepare())
+    monkeypatch.setattr(journal, 'write', lambda plan: threads.setdefault('write', threading.current_thread()) and write(plan))
+    try:
+        assert store.persist('user')
+    finally:
+        doc.stop()
+    assert threads['prepare'] is doc.thread
+    assert threads['write'] is threading.current_thread()
+
+    loaded = Library()
+    load_archive(loaded, store.get_archive_path('user'))
+    assert_libraries_equal(library, loaded)
+
+def test_busy_session_skips_autosave(tmp_path):
+    store = SessionStore({}, str(tmp_path), memory_budget=1 << 30, session_timeout=0.1)
+    store.open_session('user')
+    doc = FakeDocument()
+    store.attach_document('user', doc)
+    store.entries['user']['library']['plate_0'] = make_plate(0)
+    release = threading.Event()
+    doc.add_next_tick_callback(release.wait)
+    try:
+        assert not store.persist('user')
+        assert not os.path.exists(store.get_archive_path('user'))
+    finally:
+        release.set()
+        doc.stop()
+    #Once the user leaves, nothing else changes their library, so it's saved from this thread
+    store.close_session('user')
+    assert store.persist('user')
+    assert os.path.exists(store.get_archive_path('user'))